@@ -11,10 +11,17 @@ Rows with a blank/missing checkin are ignored (treated as bad data), per
 the chosen behavior. If the count column is absent only the games line is
 drawn.
 
+For big exports use --vectorized, which parses the timestamp columns in bulk
+and does the event sort and running totals with NumPy, and --max-points,
+which downsamples each line to its per-bucket maxima so the peaks are kept
+exactly. --no-show skips the window entirely (use with --save on a server).
+
 Usage:
     python3 checkouts_over_time.py library.csv
     python3 checkouts_over_time.py library.csv --checkout-col out --checkin-col in
     python3 checkouts_over_time.py library.csv --time-format "%Y-%m-%d %H:%M:%S"
+    python3 checkouts_over_time.py library.csv --vectorized --max-points 2000 \
+        --no-show --save checkouts.png
 """
 
 import argparse
@@ -23,8 +30,8 @@ import sys
 from datetime import datetime, timezone
 from zoneinfo import ZoneInfo
 
-import matplotlib.dates as mdates
-import matplotlib.pyplot as plt
+import matplotlib
+import numpy as np
 
 UTC = timezone.utc
 
@@ -52,6 +59,211 @@ def parse_time(raw, time_format, target_tz):
     return dt.astimezone(target_tz)
 
 
+def parse_times_array(raw, time_format, chunk_size=65536):
+    """Parse a column of UTC timestamp strings into a naive-UTC datetime64[us] array.
+
+    Returns (times, bad): blanks become NaT, and unparseable values become NaT
+    with bad set. Plain ISO-8601 is converted by NumPy a chunk at a time; custom
+    formats, explicit offsets, and any chunk NumPy rejects fall back to
+    parse_time() row by row.
+    """
+    raw = np.char.strip(np.asarray(raw, dtype=str))
+    blank = raw == ""
+    bad = np.zeros(len(raw), dtype=bool)
+    times = np.full(len(raw), np.datetime64("NaT"), dtype="datetime64[us]")
+
+    # A trailing 'Z' is just UTC; any other offset needs the slow path.
+    raw = np.char.rstrip(raw, "Z")
+    has_offset = (np.char.find(raw, "+", 19) >= 0) | (np.char.find(raw, "-", 19) >= 0)
+
+    for start in range(0, len(raw), chunk_size):
+        chunk = slice(start, start + chunk_size)
+        if time_format is None and not has_offset[chunk].any():
+            try:
+                times[chunk] = np.where(blank[chunk], "NaT", raw[chunk]).astype("datetime64[us]")
+                continue
+            except ValueError:
+                pass
+
+        for i in range(start, min(start + chunk_size, len(raw))):
+            if blank[i]:
+                continue
+            try:
+                dt = parse_time(raw[i], time_format, UTC)
+            except ValueError:
+                bad[i] = True
+                continue
+            times[i] = np.datetime64(dt.replace(tzinfo=None), "us")
+    return times, bad
+
+
+def parse_counts_array(raw):
+    """Parse a column of player counts; blanks are 0. Returns (counts, bad)."""
+    raw = np.char.strip(np.asarray(raw, dtype=str))
+    raw = np.where(raw == "", "0", raw)
+    try:
+        return raw.astype(float).astype(np.int64), np.zeros(len(raw), dtype=bool)
+    except ValueError:
+        pass
+
+    counts = np.zeros(len(raw), dtype=np.int64)
+    bad = np.zeros(len(raw), dtype=bool)
+    for i, value in enumerate(raw):
+        try:
+            counts[i] = int(float(value))
+        except ValueError:
+            bad[i] = True
+    return counts, bad
+
+
+def sweep_vectorized(times_out, times_in, counts):
+    """Sort the checkout/checkin events and return (times, game_counts, player_counts).
+
+    At an identical timestamp checkins (-1) sort before checkouts (+1), the
+    same as the row-by-row sweep.
+    """
+    n = len(times_out)
+    times = np.concatenate([times_out, times_in])
+    game_deltas = np.concatenate([np.ones(n, dtype=np.int64), -np.ones(n, dtype=np.int64)])
+    player_deltas = np.concatenate([counts, -counts])
+
+    order = np.lexsort((game_deltas, times))
+    return (times[order], np.cumsum(game_deltas[order]),
+            np.cumsum(player_deltas[order]))
+
+
+def downsample_max(times, values, max_points):
+    """Keep at most max_points points: the largest value in each of
+    max_points equal-width time buckets, plus the final point.
+
+    Every bucket's peak is an actual event, so the overall peak (value and
+    time) survives exactly.
+    """
+    if len(times) <= max_points:
+        return times, values
+
+    t = times.astype("datetime64[us]").astype(np.int64)
+    edges = np.linspace(t[0], t[-1], max_points)
+    bucket = np.searchsorted(edges, t, side="right") - 1
+
+    # sort by bucket, then by value descending; the first row of each bucket is its max
+    order = np.lexsort((-values, bucket))
+    first = np.ones(len(order), dtype=bool)
+    first[1:] = bucket[order][1:] != bucket[order][:-1]
+    keep = np.sort(order[first])
+    if keep[-1] != len(times) - 1:
+        keep = np.append(keep, len(times) - 1)
+    return times[keep], values[keep]
+
+
+def read_events(reader, args, has_count, target_tz):
+    """Read the rows one at a time and sweep the events. Returns
+    (times, game_counts, player_counts, total_rows, n_pairs, skipped_no_checkin, skipped_bad)
+    with times as target_tz datetimes.
+    """
+    # Each event: (timestamp, game_delta, player_delta).
+    # checkout -> (+1, +count); checkin -> (-1, -count).
+    events = []
+    total_rows = 0
+    skipped_no_checkin = 0
+    skipped_bad = 0
+    for row in reader:
+        total_rows += 1
+        try:
+            out = parse_time(row[args.checkout_col], args.time_format, target_tz)
+            cin = parse_time(row[args.checkin_col], args.time_format, target_tz)
+        except ValueError as e:
+            skipped_bad += 1
+            print(f"Skipping row {total_rows}: {e}", file=sys.stderr)
+            continue
+
+        if out is None:
+            skipped_bad += 1
+            continue
+        if cin is None:
+            # Checked out but never checked in: ignored per chosen behavior.
+            skipped_no_checkin += 1
+            continue
+
+        players = 0
+        if has_count:
+            raw_count = (row[args.count_col] or "").strip()
+            try:
+                players = int(float(raw_count)) if raw_count else 0
+            except ValueError:
+                skipped_bad += 1
+                print(
+                    f"Skipping row {total_rows}: bad player count "
+                    f"{raw_count!r}",
+                    file=sys.stderr,
+                )
+                continue
+
+        events.append((out, 1, players))
+        events.append((cin, -1, -players))
+
+    # Sort by time; at an identical timestamp apply checkins (-1) before
+    # checkouts (+1) so we don't draw a phantom spike.
+    events.sort(key=lambda e: (e[0], e[1]))
+
+    times = []
+    game_counts = []
+    player_counts = []
+    games_now = 0
+    players_now = 0
+    for ts, g_delta, p_delta in events:
+        games_now += g_delta
+        players_now += p_delta
+        times.append(ts)
+        game_counts.append(games_now)
+        player_counts.append(players_now)
+    return (times, game_counts, player_counts, total_rows, len(events) // 2,
+            skipped_no_checkin, skipped_bad)
+
+
+def read_events_vectorized(reader, args, has_count):
+    """Bulk version of read_events(). Returns
+    (times, game_counts, player_counts, total_rows, n_pairs, skipped_no_checkin, skipped_bad)
+    with times as naive-UTC datetime64.
+    """
+    # Read the underlying csv.reader by column index; building a dict per
+    # row costs more than everything else in this function put together.
+    i_out = reader.fieldnames.index(args.checkout_col)
+    i_in = reader.fieldnames.index(args.checkin_col)
+    i_count = reader.fieldnames.index(args.count_col) if has_count else None
+    raw_out, raw_in, raw_count = [], [], []
+    for row in reader.reader:
+        if not row:
+            continue
+        row.extend([""] * (len(reader.fieldnames) - len(row)))
+        raw_out.append(row[i_out])
+        raw_in.append(row[i_in])
+        if has_count:
+            raw_count.append(row[i_count])
+    total_rows = len(raw_out)
+
+    times_out, bad_out = parse_times_array(raw_out, args.time_format)
+    times_in, bad_in = parse_times_array(raw_in, args.time_format)
+    if has_count:
+        counts, bad_count = parse_counts_array(raw_count)
+    else:
+        counts, bad_count = np.zeros(total_rows, dtype=np.int64), np.zeros(total_rows, dtype=bool)
+
+    # Same precedence as the row loop: bad times, then no checkout, then no checkin, then bad count.
+    bad = bad_out | bad_in
+    no_out = ~bad & np.isnat(times_out)
+    no_in = ~bad & ~no_out & np.isnat(times_in)
+    bad_count &= ~(bad | no_out | no_in)
+    keep = ~(bad | no_out | no_in | bad_count)
+
+    times, game_counts, player_counts = sweep_vectorized(
+        times_out[keep], times_in[keep], counts[keep]
+    )
+    skipped_bad = int(bad.sum() + no_out.sum() + bad_count.sum())
+    return (times, game_counts, player_counts, total_rows, int(keep.sum()),
+            int(no_in.sum()), skipped_bad)
+
+
 def main():
     parser = argparse.ArgumentParser(
         description="Plot concurrent board game checkouts over time."
@@ -87,16 +299,34 @@ def main():
         default=None,
         help="Optional path to also save the figure as an image",
     )
+    parser.add_argument(
+        "--vectorized",
+        action="store_true",
+        help="Parse timestamps in bulk and sweep the events with NumPy",
+    )
+    parser.add_argument(
+        "--max-points",
+        default=None,
+        type=int,
+        help="Downsample each line to at most this many points, keeping peaks",
+    )
+    parser.add_argument(
+        "--no-show",
+        action="store_true",
+        help="Never open a plot window (headless; combine with --save)",
+    )
     args = parser.parse_args()
 
-    target_tz = ZoneInfo(args.tz)
+    if args.max_points is not None and args.max_points < 2:
+        parser.error("--max-points must be at least 2")
 
-    # Each event: (timestamp, game_delta, player_delta).
-    # checkout -> (+1, +count); checkin -> (-1, -count).
-    events = []
-    total_rows = 0
-    skipped_no_checkin = 0
-    skipped_bad = 0
+    # Pick a non-interactive backend before pyplot is imported.
+    if args.no_show:
+        matplotlib.use("Agg")
+    import matplotlib.dates as mdates
+    import matplotlib.pyplot as plt
+
+    target_tz = ZoneInfo(args.tz)
 
     with open(args.csv_path, newline="", encoding="utf-8-sig") as f:
         reader = csv.DictReader(f)
@@ -117,64 +347,42 @@ def main():
                 file=sys.stderr,
             )
 
-        for row in reader:
-            total_rows += 1
-            try:
-                out = parse_time(row[args.checkout_col], args.time_format, target_tz)
-                cin = parse_time(row[args.checkin_col], args.time_format, target_tz)
-            except ValueError as e:
-                skipped_bad += 1
-                print(f"Skipping row {total_rows}: {e}", file=sys.stderr)
-                continue
+        if args.vectorized:
+            (times, game_counts, player_counts, total_rows, n_pairs,
+             skipped_no_checkin, skipped_bad) = read_events_vectorized(reader, args, has_count)
+        else:
+            (times, game_counts, player_counts, total_rows, n_pairs,
+             skipped_no_checkin, skipped_bad) = read_events(reader, args, has_count, target_tz)
 
-            if out is None:
-                skipped_bad += 1
-                continue
-            if cin is None:
-                # Checked out but never checked in: ignored per chosen behavior.
-                skipped_no_checkin += 1
-                continue
-
-            players = 0
-            if has_count:
-                raw_count = (row[args.count_col] or "").strip()
-                try:
-                    players = int(float(raw_count)) if raw_count else 0
-                except ValueError:
-                    skipped_bad += 1
-                    print(
-                        f"Skipping row {total_rows}: bad player count "
-                        f"{raw_count!r}",
-                        file=sys.stderr,
-                    )
-                    continue
-
-            events.append((out, 1, players))
-            events.append((cin, -1, -players))
-
-    if not events:
+    if n_pairs == 0:
         sys.exit("No usable checkout/checkin pairs found.")
-
-    # Sort by time; at an identical timestamp apply checkins (-1) before
-    # checkouts (+1) so we don't draw a phantom spike.
-    events.sort(key=lambda e: (e[0], e[1]))
-
-    times = []
-    game_counts = []
-    player_counts = []
-    games_now = 0
-    players_now = 0
-    for ts, g_delta, p_delta in events:
-        games_now += g_delta
-        players_now += p_delta
-        times.append(ts)
-        game_counts.append(games_now)
-        player_counts.append(players_now)
-
-    games_peak = max(game_counts)
-    games_peak_time = times[game_counts.index(games_peak)]
-    players_peak = max(player_counts)
-    players_peak_time = times[player_counts.index(players_peak)]
+    if args.vectorized:
+        # argmax returns the first occurrence, like list.index in the row sweep
+        def as_local(t):
+            return t.item().replace(tzinfo=UTC).astimezone(target_tz)
+
+        games_peak = int(game_counts.max())
+        games_peak_time = as_local(times[game_counts.argmax()])
+        players_peak = int(player_counts.max())
+        players_peak_time = as_local(times[player_counts.argmax()])
+    else:
+        games_peak = max(game_counts)
+        games_peak_time = times[game_counts.index(games_peak)]
+        players_peak = max(player_counts)
+        players_peak_time = times[player_counts.index(players_peak)]
+
+    # Downsample each line separately so each keeps its own peaks.
+    game_times = player_times = times
+    if args.max_points is not None:
+        if not args.vectorized:
+            times = np.array(
+                [t.astimezone(UTC).replace(tzinfo=None) for t in times],
+                dtype="datetime64[us]",
+            )
+            game_counts = np.asarray(game_counts)
+            player_counts = np.asarray(player_counts)
+        game_times, game_counts = downsample_max(times, game_counts, args.max_points)
+        player_times, player_counts = downsample_max(times, player_counts, args.max_points)
 
     games_color = "tab:blue"
     players_color = "tab:orange"
@@ -182,11 +390,11 @@ def main():
     fig, ax = plt.subplots(figsize=(13, 6))
 
     (games_line,) = ax.step(
-        times, game_counts, where="post", linewidth=1.5,
+        game_times, game_counts, where="post", linewidth=1.5,
         color=games_color, label="Games checked out",
     )
     ax.fill_between(
-        times, game_counts, step="post", alpha=0.12, color=games_color
+        game_times, game_counts, step="post", alpha=0.12, color=games_color
     )
     ax.set_xlabel(f"Time ({args.tz})")
     ax.set_ylabel("Games checked out", color=games_color)
@@ -214,7 +422,7 @@ def main():
     if has_count:
         ax2 = ax.twinx()
         (players_line,) = ax2.step(
-            times, player_counts, where="post", linewidth=1.5,
+            player_times, player_counts, where="post", linewidth=1.5,
             color=players_color, label="Players in play",
         )
         ax2.set_ylabel("Players in play", color=players_color)
@@ -239,7 +447,7 @@ def main():
     fig.tight_layout()
 
     print(
-        f"Rows: {total_rows} | plotted pairs: {len(events) // 2} | "
+        f"Rows: {total_rows} | plotted pairs: {n_pairs} | "
         f"skipped (no checkin): {skipped_no_checkin} | "
         f"skipped (bad/no checkout): {skipped_bad}"
     )
@@ -257,7 +465,8 @@ def main():
         fig.savefig(args.save, dpi=150)
         print(f"Saved figure to {args.save}")
 
-    plt.show()
+    if not args.no_show:
+        plt.show()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,109 @@
+"""Time fetch + parse through pnw_api against a local replay server with a shaped network.
+
+    python benchmarks/bench_fetch.py --num_plays 200000 --latency_ms 50 --bandwidth_kbps 20000
+    python benchmarks/bench_fetch.py -g data/games.X.json -p data/plays.X.json --failure_rate 0.05 --failure reset
+
+Starts pnw_replay.py in its own process (so the server doesn't compete with the client for the
+GIL), serving the given snapshots or a create_mock_plays.py snapshot, and reports the median and
+best time of each scenario over --repeat runs:
+    auth                  the fake Auth0 token request
+    games                 the full games catalogue
+    games, cached         a conditional GET answered with 304 (pnw_api.HTTPCache)
+    plays                 the whole plays list in one response
+    plays, pages of N     retrieve_plays_paged, for each --page_sizes entry
+"""
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+root = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, root)
+import json
+import pnw_api
+
+def start_server(games_fn, plays_fn, shaping_args):
+    """Run pnw_replay.py serve on a free port. RETURNS: (process, url)"""
+    proc = subprocess.Popen([sys.executable, os.path.join(root,'pnw_replay.py'), 'serve', games_fn, plays_fn,
+                             '--port', '0'] + shaping_args,
+                            stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True)
+    line = proc.stdout.readline()
+    if not line.startswith('Serving on '):
+        proc.kill()
+        raise RuntimeError(f"replay server didn't start: {line!r}")
+    return proc, line.split()[-1]
+
+def mock_snapshot(out_dir, num_plays, seed=0):
+    prefix = os.path.join(out_dir, 'mock')
+    subprocess.run([sys.executable, os.path.join(root,'create_mock_plays.py'), prefix, '-n', str(num_plays),
+                    '--num_games', '1000', '--num_players', str(max(100, num_plays//20)), '--seed', str(seed)],
+                   check=True, stdout=subprocess.DEVNULL)
+    return prefix+'.games.json', prefix+'.plays.json'
+
+def timed(fn, repeat):
+    times = list()
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn()
+        times.append(time.perf_counter()-start)
+    return times, result
+
+def main():
+    p = argparse.ArgumentParser(description='Play & Win API fetch benchmark')
+    p.add_argument('-g', '--games_fn', default=None, help="games JSON to serve (default: a mock snapshot)")
+    p.add_argument('-p', '--plays_fn', default=None, help="plays JSON to serve (default: a mock snapshot)")
+    p.add_argument('-n', '--num_plays', default=100000, type=int, help="plays in the mock snapshot, default=100000")
+    p.add_argument('--repeat', default=3, type=int)
+    p.add_argument('--page_sizes', default=[5000, 20000], type=int, nargs='*')
+    p.add_argument('--latency_ms', default='50')
+    p.add_argument('--bandwidth_kbps', default=None)
+    p.add_argument('--chunked', action='store_true', default=False)
+    p.add_argument('--failure_rate', default='0')
+    p.add_argument('--failure', choices=['status','reset','mixed'], default='status')
+    args = p.parse_args()
+
+    shaping_args = ['--latency_ms', args.latency_ms, '--failure_rate', args.failure_rate, '--failure', args.failure]
+    if args.bandwidth_kbps is not None:
+        shaping_args += ['--bandwidth_kbps', args.bandwidth_kbps]
+    if args.chunked:
+        shaping_args += ['--chunked']
+    # the fake Auth0 endpoint takes any credentials
+    os.environ.setdefault('AUTH0_CLIENT_ID', 'replay')
+    os.environ.setdefault('AUTH0_CLIENT_SECRET', 'replay')
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        games_fn, plays_fn = args.games_fn, args.plays_fn
+        if games_fn is None or plays_fn is None:
+            games_fn, plays_fn = mock_snapshot(tmp_dir, args.num_plays)
+        proc, url = start_server(games_fn, plays_fn, shaping_args)
+        try:
+            print(f"Replaying {os.path.getsize(plays_fn)/1e6:.1f} MB of plays from {url} ({' '.join(shaping_args)})")
+            scenarios = list()
+            token = json.loads(pnw_api.get_auth(url))['access_token']
+            scenarios.append(('auth', lambda: pnw_api.get_auth(url)))
+            scenarios.append(('games', lambda: pnw_api.retrieve_data_api('games', url, access_token=token)))
+            cache = pnw_api.HTTPCache(os.path.join(tmp_dir,'http_cache'))
+            pnw_api.retrieve_data_api('games', url, access_token=token, cache=cache)
+            scenarios.append(('games, cached', lambda: pnw_api.retrieve_data_api('games', url, access_token=token, cache=cache)))
+            scenarios.append(('plays', lambda: pnw_api.retrieve_data_api('plays', url, access_token=token)))
+            for page_size in args.page_sizes:
+                scenarios.append((f'plays, pages of {page_size}',
+                                  lambda page_size=page_size: pnw_api.retrieve_data_api('plays', url, access_token=token, page_size=page_size)))
+
+            for name, fn in scenarios:
+                try:
+                    times, result = timed(fn, args.repeat)
+                except (IOError, pnw_api.http.client.HTTPException) as err:
+                    print(f"{name:>24}: failed ({err!r})")
+                    continue
+                n_plays = len(result['Result']['Plays']) if isinstance(result, dict) and 'Plays' in result.get('Result',{}) else ''
+                print(f"{name:>24}: median {statistics.median(times):7.3f}s  best {min(times):7.3f}s  {n_plays}")
+        finally:
+            proc.terminate()
+            proc.wait()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,50 @@
+"""Time the two label backends on the same synthetic winners.
+
+    python benchmarks/bench_labels.py -n 10000
+
+Writes both PDFs to a temporary directory and reports seconds per backend and the speedup.
+"""
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import pnw
+
+_game_names = ["Catan", "Ticket to Ride", "Spirit Island: Jagged Earth", "Café International",
+               "Twilight Imperium: Fourth Edition - Prophecy of Kings Expansion"]
+_player_names = ["Ann Lee", "Zoë Quinn", "Bartholomew Maximilian Featherstonehaugh-Smythe III"]
+
+def mock_wins(n, seed=0):
+    """n Win objects with a mix of short names and names long enough to be shrunk."""
+    rng = random.Random(seed)
+    wins = list()
+    for i in range(n):
+        game = pnw.Game(i, rng.choice(_game_names))
+        player = pnw.Player(i, rng.choice(_player_names))
+        wins.append(pnw.Win(game, f"{i:05d}A", player, None))
+    return wins
+
+def main():
+    p = argparse.ArgumentParser(description='Play & Win label backend benchmark')
+    p.add_argument('-n', '--num_labels', default=10000, type=int, help="labels to draw, default=10000")
+    p.add_argument('--backends', nargs='+', default=['pylabels', 'canvas'], choices=['pylabels', 'canvas'])
+    args = p.parse_args()
+
+    wins = mock_wins(args.num_labels)
+    seconds = dict()
+    with tempfile.TemporaryDirectory() as out_dir:
+        for backend in args.backends:
+            out_fn = os.path.join(out_dir, backend+'.pdf')
+            start = time.perf_counter()
+            pnw.output_winners_labels(wins, out_fn, backend=backend)
+            seconds[backend] = time.perf_counter()-start
+            print(f"{backend:>9}: {seconds[backend]:7.2f}s for {len(wins)} labels ({os.path.getsize(out_fn)/1e6:.1f} MB)")
+    if 'pylabels' in seconds and 'canvas' in seconds:
+        print(f"  speedup: {seconds['pylabels']/seconds['canvas']:.1f}x")
+
+if __name__ == '__main__':
+    main()
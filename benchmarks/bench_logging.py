@@ -0,0 +1,104 @@
+"""Time the picker's draw loop with its logger set up in different ways.
+
+    python benchmarks/bench_logging.py -n 200000 --method old_school
+
+Draws from a create_mock_plays.py snapshot (or -g/-p files) with pnw_picker.draw_winners, seeded,
+so every configuration awards the same winners, and reports the median and best of --repeat draws:
+    off         no handlers, level WARNING (debug and info calls return straight away)
+    sync        pnw.setup_logger(queued=False): the console and log files written in the draw's thread
+    queued      pnw.setup_logger(): records handed to a QueueListener thread (the picker's default)
+Log files go to a temporary directory and the console handler to a discarded stream. Since the
+draw itself can dominate, the cost of the logging calls alone is also reported: --records calls
+shaped like select_game_winners' per-game debug message, through each configuration.
+"""
+import argparse
+import contextlib
+import io
+import logging
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+root = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, root)
+os.makedirs('log', exist_ok=True)     # importing the picker sets up its own log files
+import pnw
+import pnw_picker
+
+def mock_snapshot(out_dir, num_plays, num_games, seed=0):
+    prefix = os.path.join(out_dir, 'mock')
+    subprocess.run([sys.executable, os.path.join(root,'create_mock_plays.py'), prefix, '-n', str(num_plays),
+                    '--num_games', str(num_games), '--num_players', str(max(100, num_plays//20)), '--seed', str(seed)],
+                   check=True, stdout=subprocess.DEVNULL)
+    return prefix+'.games.json', prefix+'.plays.json'
+
+def make_logger(kind, log_dir, n):
+    """A fresh logger for one configuration, named so each run gets its own files."""
+    name = f'bench-{kind}-{n}'
+    if kind=='off':
+        logger = logging.getLogger(name)
+        logger.setLevel(logging.WARNING)
+        logger.propagate = False
+        logger.addHandler(logging.NullHandler())
+        return logger
+    with contextlib.redirect_stderr(io.StringIO()):
+        return pnw.setup_logger(name, log_dir=log_dir, queued=(kind=='queued'))
+
+def main():
+    p = argparse.ArgumentParser(description='Play & Win draw loop logging benchmark')
+    p.add_argument('-g', '--games_fn', default=None, help="games JSON (default: a mock snapshot)")
+    p.add_argument('-p', '--plays_fn', default=None, help="plays JSON (default: a mock snapshot)")
+    p.add_argument('-n', '--num_plays', default=100000, type=int, help="plays in the mock snapshot, default=100000")
+    p.add_argument('--num_games', default=3000, type=int, help="games in the mock snapshot, default=3000")
+    p.add_argument('--method', choices=['standard', 'old_school'], default='old_school')
+    p.add_argument('--repeat', default=5, type=int)
+    p.add_argument('--records', default=100000, type=int, help="logging calls for the calls-only timing, default=100000")
+    p.add_argument('--loggers', nargs='+', default=['off', 'sync', 'queued'], choices=['off', 'sync', 'queued'])
+    args = p.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        games_fn, plays_fn = args.games_fn, args.plays_fn
+        if games_fn is None or plays_fn is None:
+            games_fn, plays_fn = mock_snapshot(tmp_dir, args.num_plays, args.num_games)
+        pnw_picker.logger.setLevel(logging.WARNING)
+        all_pnw_titles = pnw.filter_library_games(pnw.parse_games_json(games_fn))
+        titles_by_id = {g.game_id: g for g in all_pnw_titles}
+        plays_by_game, removed = pnw.filter_plays_columnar(pnw.parse_plays_json_columnar(plays_fn), titles_by_id)
+        print(f"Drawing {sum(g.num_copies() for g in all_pnw_titles)} copies of {len(plays_by_game)} games "
+              f"from {sum(len(plays) for plays in plays_by_game.values())} plays ({args.method})")
+
+        picker_logger = pnw_picker.logger
+        try:
+            for kind in args.loggers:
+                times = list()
+                for i in range(args.repeat):
+                    pnw_picker.logger = make_logger(kind, tmp_dir, i)
+                    start = time.perf_counter()
+                    wins, problem_plays = pnw_picker.draw_winners(titles_by_id, plays_by_game, list(), args.method, seed=i)
+                    times.append(time.perf_counter()-start)
+                    # the queued files are still being written in the background: not part of the draw
+                    pnw.flush_logger(pnw_picker.logger.name)
+                debug_fn = os.path.join(tmp_dir, f'bench-{kind}-0.debug.log')
+                lines = sum(1 for _ in open(debug_fn)) if os.path.exists(debug_fn) else 0
+                print(f"{kind:>8}: median {statistics.median(times):7.3f}s  best {min(times):7.3f}s  "
+                      f"{len(wins)} winners, {lines} debug log lines per draw")
+        finally:
+            pnw_picker.logger = picker_logger
+
+        print(f"{args.records} logging calls alone:")
+        for kind in args.loggers:
+            logger = make_logger(kind, tmp_dir, 'records')
+            start = time.perf_counter()
+            for i in range(args.records):
+                logger.debug("Game %s, with %d copies, has %d plays and %d non-unique players, %d unique players still eligible",
+                                "Spirit Island", 2, i, 3*i, i//2)
+            seconds = time.perf_counter()-start
+            pnw.flush_logger(logger.name)
+            print(f"{kind:>8}: {seconds:7.3f}s in the calling thread ({1e6*seconds/args.records:.1f}us per call), "
+                  f"{time.perf_counter()-start:7.3f}s until written")
+
+if __name__ == '__main__':
+    main()
@@ -1,17 +1,42 @@
-from pnw_picker import Game,Player
+"""Synthetic games and plays snapshots, shaped like api/games and api/plays.
+
+    python create_mock_plays.py data/mock --num_plays 2000000 --num_games 1500 --num_players 9000 --seed 7
+
+writes data/mock.games.json and data/mock.plays.json, which the picker reads with --local. The same
+seed and arguments always give the same files. Plays are generated in chunks and streamed to disk
+one at a time, so millions of plays need little memory.
+
+The plays are meant to look like a real con:
+    - game popularity is Zipf-like (a few games are played constantly, most rarely)
+    - mostly 2-4 players per play, with some solo plays and big groups
+    - check-outs are spread over the con days, busiest in the evening, and each game has its own
+      typical play length
+    - some players almost never want to win, and some players play far more than others
+    - on purpose: small groups hoarding several games at once, copies checked out again before
+      they were checked in, never-checked-in plays, very short and very long checkouts, and plays
+      with no players
+
+Games and players can come from CSV files instead (--games_csv, --players_csv). --tsv_fn also
+writes the plays as a TSV, or with --readable in the mock-entry format.
+"""
+from pnw import Game, Copy, Player
 import csv
-import random
-from collections import OrderedDict
 import argparse
 import json
+from datetime import datetime
+
+import numpy as np
 
+# share of plays by number of players (1 to 8)
+_group_size_weights = [0.08, 0.32, 0.22, 0.20, 0.10, 0.05, 0.02, 0.01]
+# relative number of check-outs per hour of the day (Central), busiest in the evening
+_hourly_weights = [4, 3, 2, 1, 0.5, 0.2, 0.2, 0.5, 2, 4, 6, 7, 7, 7, 7, 7, 8, 8, 9, 10, 10, 9, 8, 6]
 
 def import_games_csv(fn_csv):
-    """Returns a list of Games(). 
+    """Returns a list of Games().
     Assigns ids to each game title incrementally, assuming they're spelled exactly.
-    File format: GameTitle, LibraryID, OwnerName (unused).
+    File format: GameTitle, LibraryID, OwnerName (unused). Every copy is winnable.
     """
-    # fieldnames= ['GameTitle','LibraryID','OwnerName'] #not sure why I can't use this
     game_names = dict()
     games = []
     with open(fn_csv) as f:
@@ -27,12 +52,12 @@ def import_games_csv(fn_csv):
         game_id_counter+=1
         games.append(Game(game_id=game_id_counter,
                             game_name=title,
-                            copy_ids=game_names[title]))
-    
+                            copies=[Copy(game_id_counter, copy_id, True) for copy_id in game_names[title]]))
+
     return games
 
 def import_players_csv(fn_csv):
-    """Returns a list of Players(). 
+    """Returns a list of Players().
     File format: Name, BadgeID.
     """
     fieldnames= ['Name','BadgeID']
@@ -43,115 +68,216 @@ def import_players_csv(fn_csv):
             players.append(Player(player_id=row['BadgeID'],player_name=row['Name']))
     return players
 
-def create_mock_plays(players, games, num_plays, min_players, max_players, seed=None):
-    """Create a list of num_plays mock plays, from a list of Players() and Games()."""
-    # for each play:
-        # pick a game title 
-        # pick a copy ID
-        # pick players players
-    random.seed(a=seed)
-    all_plays = []
-    for n in range(0,num_plays):
-        p = OrderedDict()
-        game = random.choice(games)
-        p['play_id'] = n+1
-        p['game_title'] = game.game_name
-        p['game_id'] = game.game_id
-        p['copy_id'] = random.choice(game.copy_ids)
-        num_players = random.randint(min_players,max_players)
-        p['players'] = random.sample(players,num_players)
-        all_plays.append(p)
-    
-    return all_plays
+def mock_games(num_games, rng, pnw_fraction=0.6):
+    """Returns a list of num_games Games() with 1-4 copies each.
+    About pnw_fraction of the titles are Play & Win (winnable copies), the rest library copies.
+    """
+    games = []
+    n_copies = rng.choice([1,2,3,4], size=num_games, p=[0.6,0.25,0.1,0.05])
+    winnable = rng.random(num_games) < pnw_fraction
+    for i in range(num_games):
+        game_id = i+1
+        name = f"Mock Game {game_id}" if game_id % 50 else f"Jeu Mock n°{game_id}"   # some non-ASCII titles
+        copies = [Copy(game_id, f"{game_id:05d}{'ABCD'[c]}", bool(winnable[i])) for c in range(n_copies[i])]
+        games.append(Game(game_id=game_id, game_name=name, copies=copies))
+    return games
+
+def mock_players(num_players):
+    """Returns a list of num_players Players() with badge IDs 1 to num_players."""
+    return [Player(player_id=i, player_name=f"Mock Player {i}" if i % 40 else f"Zoë Mock {i}")
+            for i in range(1, num_players+1)]
+
+def generate_plays(games, players, num_plays, seed=None, start=datetime(2024,5,16), days=4,
+                    zipf_exponent=1.0, hoard_rate=0.005, overlap_rate=0.01, chunk_size=50000):
+    """Yield num_plays api/plays entries (dicts) in checkout ID order, which is also check-out order.
+
+    ARGUMENTS:
+        games, players = lists of Game() and Player(); plays use every game's copies, winnable or not
+        seed = for numpy.random.default_rng; the same seed and arguments give the same plays
+        start, days = the con's first day (Central) and its length
+        zipf_exponent = game popularity falls off as 1/rank**zipf_exponent
+        hoard_rate = chance per play that a group of 2-3 players starts checking out 2-4 games at once
+        overlap_rate = chance per play that it reuses the previous play's copy while that is still out
+    """
+    rng = np.random.default_rng(seed)
+    n_games = len(games)
+    n_players = len(players)
+
+    # game popularity: Zipf over a random ranking; each game has its own typical length (minutes)
+    popularity = 1.0/np.arange(1, n_games+1)**zipf_exponent
+    popularity = popularity[rng.permutation(n_games)]
+    popularity /= popularity.sum()
+    typical_minutes = np.clip(rng.lognormal(np.log(45), 0.6, n_games), 10, 240)
+    n_copies = np.array([g.num_copies() for g in games])
+
+    # players: some play far more than others, and some rarely want to win
+    activity = rng.lognormal(0, 1, n_players)
+    activity /= activity.sum()
+    wants_to_win_rate = np.where(rng.random(n_players) < 0.85, 0.95, 0.1)
+    # badge IDs are numbers in the API
+    player_ids = [int(p.player_id) if p.player_id.isdigit() else p.player_id for p in players]
+    player_names = [p.player_name for p in players]
+
+    # check-out times for the whole con, sorted so checkout IDs follow time (8 bytes per play)
+    hours = rng.choice(24, size=num_plays, p=np.array(_hourly_weights)/sum(_hourly_weights))
+    offsets = rng.integers(0, days, num_plays)*86400 + hours*3600 + rng.integers(0, 3600, num_plays)
+    offsets.sort()
+    # the API gives GMT times, the parser shifts them back to Central
+    first = np.datetime64(start, 's') + np.timedelta64(5, 'h')
+    last_offset = days*86400
+
+    burst = 0
+    burst_group = []
+    for chunk_start in range(0, num_plays, chunk_size):
+        chunk_offsets = offsets[chunk_start:chunk_start+chunk_size]
+        n = len(chunk_offsets)
+        game = rng.choice(n_games, size=n, p=popularity)
+        copy = (rng.random(n)*n_copies[game]).astype(np.int64)
+        minutes = typical_minutes[game]*rng.lognormal(0, 0.5, n)
+        # mistaken checkouts and forgotten check-ins
+        oddity = rng.random(n)
+        minutes[oddity < 0.01] = rng.uniform(0.2, 3, np.count_nonzero(oddity < 0.01))
+        minutes[oddity > 0.995] = rng.uniform(600, 1800, np.count_nonzero(oddity > 0.995))
+        # the same copy checked out again right after the previous play, before it came back
+        overlap = np.flatnonzero(rng.random(n) < overlap_rate)
+        overlap = overlap[overlap > 0]
+        game[overlap] = game[overlap-1]
+        copy[overlap] = copy[overlap-1]
+        time_in_offsets = chunk_offsets + (minutes*60).astype(np.int64)
+        time_out = np.datetime_as_string(first + chunk_offsets.astype('timedelta64[s]'), unit='ms')
+        time_in = np.datetime_as_string(first + time_in_offsets.astype('timedelta64[s]'), unit='ms')
+        # plays still out when the snapshot is taken have no check-in
+        still_out = time_in_offsets > last_offset
 
+        group_size = rng.choice(np.arange(0, 9), size=n, p=[0.01]+[0.99*w for w in _group_size_weights])
+        player_rows = rng.choice(n_players, size=int(group_size.sum()), p=activity)
+        row_offsets = np.concatenate([[0], np.cumsum(group_size)])
+        wants_to_win = rng.random(len(player_rows)) < wants_to_win_rate[player_rows]
+        rating = rng.choice([0,0,0,1,2,3,4,5], size=len(player_rows))
+        starts_burst = rng.random(n) < hoard_rate
+
+        # plain lists from here: indexing them per play is much faster than numpy scalars
+        game, copy, row_offsets, still_out = game.tolist(), copy.tolist(), row_offsets.tolist(), still_out.tolist()
+        player_rows, wants_to_win, rating = player_rows.tolist(), wants_to_win.tolist(), rating.tolist()
+        time_out, time_in, starts_burst = time_out.tolist(), time_in.tolist(), starts_burst.tolist()
+
+        for i in range(n):
+            g = games[game[i]]
+            rows = range(row_offsets[i], row_offsets[i+1])
+            if burst == 0 and starts_burst[i]:
+                burst = int(rng.integers(2, 5))
+                burst_group = [int(r) for r in rng.choice(n_players, size=int(rng.integers(2, 4)), replace=False, p=activity)]
+            if burst > 0 and row_offsets[i+1] > row_offsets[i]:
+                # a hoarding group holds this game too, alongside whoever else is playing it
+                burst -= 1
+                seen = set(burst_group)
+                rows = [(r, True, 0) for r in burst_group] + [(player_rows[r], wants_to_win[r], rating[r])
+                                                              for r in rows if player_rows[r] not in seen]
+            else:
+                rows = [(player_rows[r], wants_to_win[r], rating[r]) for r in rows]
+
+            checkout_id = chunk_start+i+1
+            play_players = list()
+            seen = set()
+            for r, wants, stars in rows:
+                if r in seen:
+                    continue
+                seen.add(r)
+                play_players.append(dict(ID=player_ids[r], Name=player_names[r],
+                                         WantsToWin=bool(wants), Rating=int(stars) if stars else None))
+            yield dict(ID=checkout_id, CheckoutID=checkout_id, GameID=g.game_id, GameName=g.game_name,
+                        Checkout=dict(TimeOut=time_out[i], TimeIn=None if still_out[i] else time_in[i],
+                                      Copy=dict(ID=g.copies[copy[i]].copy_id)),
+                        Players=play_players)
+
+def write_games_json(games, out_fn):
+    """Write a list of Games() as api/games JSON."""
+    j = dict(Errors=[], Result=dict(Games=list()))
+    for g in games:
+        copies = [dict(ID=c.copy_id, Winnable=c.allow_winning, IsCheckedOut=False, CurrentCheckout=None,
+                       Title=g.game_name, Game=dict(ID=g.game_id, Name=g.game_name, Copies=None))
+                  for c in g.copies]
+        j['Result']['Games'].append(dict(ID=g.game_id, Name=g.game_name, Copies=copies))
+    with open(out_fn,'w',newline='',encoding='utf-8') as f:
+        json.dump(j,f,ensure_ascii=False)
+
+def write_plays_json(plays, out_fn):
+    """Stream api/plays entries to out_fn as api/plays JSON, one play per line.
+        RETURNS: the number of plays written
+    """
+    n = 0
+    with open(out_fn,'w',newline='',encoding='utf-8') as f:
+        f.write('{"Errors": [], "Result": {"Plays": [\n')
+        for play in plays:
+            if n:
+                f.write(',\n')
+            f.write(json.dumps(play, ensure_ascii=False, separators=(',',':')))
+            n += 1
+        f.write('\n]}}\n')
+    return n
+
+def with_tsv_rows(plays, out_fn, readable=False):
+    """Pass plays through unchanged, writing them to out_fn as a TSV along the way.
+        With readable=True, use the mock-entry format (readable by people).
+    """
+    with open(out_fn,'w',newline='',encoding='utf-8') as f:
+        w = csv.writer(f,dialect='excel')
+        if not readable:
+            w.writerow(['PlayID','Game','GameID','CopyID','Player','PlayerID','Rating'])
+        for p in plays:
+            copy_id = p['Checkout']['Copy']['ID']
+            if readable:
+                w.writerow([p['CheckoutID'],'Game',p['GameName'],copy_id,'*'+copy_id+'*','Rating'])
+            num_players = len(p['Players'])
+            for n,player in enumerate(p['Players']):
+                if readable:
+                    last_col = '*'+str(player['ID'])+'*' if n==num_players-1 else None
+                    w.writerow([p['CheckoutID'],'Player',player['Name'],player['ID'],last_col,player['Rating']])
+                else:
+                    w.writerow([p['CheckoutID'],p['GameName'],p['GameID'],copy_id,player['Name'],player['ID'],player['Rating']])
+            if readable:
+                w.writerow([None]*6)
+            yield p
 
 if __name__ == '__main__':
     a = argparse.ArgumentParser(description='Play & Win Mock Plays Maker')
-    a.add_argument('all_games_source', action="store", 
-                    help="CSV source of game names and game copy ids")
-    a.add_argument('all_players_source', action="store", 
-                    help="CSV source of game checkouts and players")
-    a.add_argument('output_fn', action="store", 
-                    help="tsv filename for list of plays")
-    a.add_argument('-r', '--readable', action="store_true",default=False,
-                    help="Output in mock-entry format, otherwise straight tsv")
+    a.add_argument('output_prefix', action="store",
+                    help="writes <output_prefix>.games.json and <output_prefix>.plays.json")
     a.add_argument('-n', '--num_plays', action="store",default=1000,type=int,
                     help="Number of plays, default=1000")
-    a.add_argument('-j', '--json_fn', action="store",default=None,
-                    help="Output to a JSON file also (add a games prefix for the game list)")
+    a.add_argument('--num_games', action="store",default=400,type=int,
+                    help="Number of mock game titles, default=400 (ignored with --games_csv)")
+    a.add_argument('--num_players', action="store",default=2000,type=int,
+                    help="Number of mock players, default=2000 (ignored with --players_csv)")
+    a.add_argument('--games_csv', action="store",default=None,
+                    help="CSV source of game names and game copy ids (GameTitle, LibraryID, OwnerName)")
+    a.add_argument('--players_csv', action="store",default=None,
+                    help="CSV source of players (Name, BadgeID)")
+    a.add_argument('-s', '--seed', action="store",default=0,type=int,
+                    help="Random seed, default=0")
+    a.add_argument('--days', action="store",default=4,type=int,
+                    help="Length of the con in days, default=4")
+    a.add_argument('--zipf', action="store",default=1.0,type=float,
+                    help="Game popularity exponent, default=1.0 (0 is uniform)")
+    a.add_argument('--hoard_rate', action="store",default=0.005,type=float,
+                    help="Chance per play that a group starts hoarding games, default=0.005")
+    a.add_argument('--overlap_rate', action="store",default=0.01,type=float,
+                    help="Chance per play that a copy is checked out again before it came back, default=0.01")
+    a.add_argument('--tsv_fn', action="store",default=None,
+                    help="Also write the plays to this tsv file")
+    a.add_argument('-r', '--readable', action="store_true",default=False,
+                    help="With --tsv_fn, output in mock-entry format, otherwise straight tsv")
 
     args = a.parse_args()
 
-    games = import_games_csv(args.all_games_source)
-    players = import_players_csv(args.all_players_source)
-    plays = create_mock_plays(players,games,args.num_plays,1,6)
-
-    if args.readable==True: # output in mock-entry format (readable by people)
-        with open(args.output_fn,'w',newline='') as f:
-            w = csv.writer(f,dialect='excel')
-            for p in plays:
-                w.writerow(['PlayID','Game',p['game_title'],
-                            p['copy_id'],'*'+p['copy_id']+'*',
-                            'Rating'])
-
-                num_players = len(p['players'])
-                for n,player in enumerate(p['players']):
-                    last_col = None
-                    rating = random.choice([None,1,2,3,4,5])
-
-                    if n==num_players-1:
-                        last_col = '*'+player.player_id+'*'
-                    w.writerow([p['play_id'],'Player',player.player_name,
-                        player.player_id,last_col,rating])
-                
-                w.writerow([None]*6)
-
-    else: # output in regular TSV format
-        with open(args.output_fn,'w',newline='') as f:
-            w = csv.writer(f,dialect='excel')
-            w.writerow(['PlayID','Game','GameID','CopyID','Player','PlayerID','Rating'])
-            for p in plays:
-
-                num_players = len(p['players'])
-                for n,player in enumerate(p['players']):
-                    last_col = None
-                    rating = random.choice([None,1,2,3,4,5])
-
-                    w.writerow([p['play_id'],p['game_title'],p['game_id'],
-                            p['copy_id'],player.player_name,
-                            player.player_id,rating])
-    
-    if args.json_fn is not None:
-        # first make the game list
-        j = dict()
-        j['Errors']=[]
-        j['Result']=dict()
-        j['Result']['Games'] = list()
-
-        for g in games:
-            foo = dict(ID=int(g.game_id), Name=g.game_name)
-            foo['Copies'] = list()
-            for c in g.copy_ids:
-                bar = dict(ID=int(c), IsCheckedOut=False, CurrentCheckout=None)
-                bar['Game'] = dict(ID=g.game_id,Name=g.game_name,Copies=None)
-                foo['Copies'].append(bar)
-            j['Result']['Games'].append(foo)
-        with open(args.json_fn+'.games.json','w',newline='') as f:
-            json.dump(j,f,indent=3)
-
-        # Now make the plays json list
-        j['Errors']=[]
-        j['Result']=dict()
-        j['Result']['Plays']=list()
+    games_rng = np.random.default_rng([args.seed, 1])   # independent of the plays' stream
+    games = import_games_csv(args.games_csv) if args.games_csv is not None else mock_games(args.num_games, games_rng)
+    players = import_players_csv(args.players_csv) if args.players_csv is not None else mock_players(args.num_players)
+    write_games_json(games, args.output_prefix+'.games.json')
 
-        for p in plays:
-            foo = dict(ID=p['play_id'],CheckoutID=p['play_id'],
-                GameID=p['game_id'],GameName=p['game_title'])
-            foo['Players'] = list()
-            for player in p['players']:
-                foo['Players'].append(dict(ID=player.player_id,Name=player.player_name))
-            j['Result']['Plays'].append(foo)
-        with open(args.json_fn,'w',newline='') as f:
-            json.dump(j,f,indent=3)
-        
-        
\ No newline at end of file
+    plays = generate_plays(games, players, args.num_plays, seed=args.seed, days=args.days,
+                            zipf_exponent=args.zipf, hoard_rate=args.hoard_rate, overlap_rate=args.overlap_rate)
+    if args.tsv_fn is not None:
+        plays = with_tsv_rows(plays, args.tsv_fn, args.readable)
+    n = write_plays_json(plays, args.output_prefix+'.plays.json')
+    print(f"Wrote {len(games)} games to {args.output_prefix}.games.json and {n} plays to {args.output_prefix}.plays.json")
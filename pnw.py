@@ -1,13 +1,24 @@
 from collections import OrderedDict, defaultdict
-from datetime import datetime, timedelta, date
+from datetime import datetime, timedelta, date, timezone
 from copy import copy
+from decimal import Decimal
+import atexit
 import logging
+import logging.handlers
+import queue
 import json
 import csv
+import math
+import os
+import re
+import unicodedata
+import numpy as np
 import labels
 from reportlab.graphics import shapes
 from reportlab.pdfbase.pdfmetrics import stringWidth
 from reportlab.lib import colors
+from reportlab.lib.units import mm
+from reportlab.pdfgen import canvas
 
 logger = logging.getLogger(__name__)
 
@@ -25,6 +36,7 @@ class Game(object):
         self.game_id = game_id
         self.game_name = game_name
         self.copies = copies if copies is not None else list()
+        self.bgg = None     # a pnw_bgg.BGGGame, once pnw_bgg.BGGClient.resolve has looked the game up
 
     def num_copies(self):
         return len(self.copies)
@@ -54,6 +66,7 @@ class GameCheckout(object):
             - checkout_id: an integer ID, unique per checkout
             - time_out and time_in: GMT-5 (Central) times
             - duration: the amount of time checked out for this checkout
+            - copy_id: the barcode ID of the copy checked out, or None if the API didn't include it
             - game.game_id and game.game_name: ID should be exactly the same as library/P&W ID, and name is used for convenience
             - players: a list of Player objects
 
@@ -82,6 +95,10 @@ class GameCheckout(object):
             self.time_in = datetime.fromisoformat(time_in)-timedelta(hours=5)
             self.duration = (self.time_in-self.time_out).total_seconds()
 
+            # the copy's barcode ID, if the checkout includes it
+            copy_json = play_json['Checkout'].get('Copy') or dict()
+            self.copy_id = str(copy_json['ID']) if copy_json.get('ID') is not None else None
+
             # EXCEPTION DUE TO SERVER DOWNTIME ON FIRST DAY OF GEEKWAY 2023
             # bad_date = date(2023,5,18)
             # logger.info("Checkout ID {self.checkout_id} on date {self.time_out.day}")
@@ -126,6 +143,14 @@ class Player(object):
     def __hash__(self):
         return hash(self.player_id)
 
+def normalize_name(name):
+    """Case, accents, punctuation and extra spaces dropped, for matching names typed differently:
+        'Café  International!' -> 'cafe international', 'O'Brien, Pat' -> 'o brien pat'
+    """
+    text = unicodedata.normalize('NFKD', name)
+    text = ''.join(c for c in text if not unicodedata.combining(c)).lower()
+    return ' '.join(re.sub(r'[\W_]+', ' ', text).split())
+
 class Win(object):
     """A single win, containing info about the game, the player, and the play."""
 
@@ -155,6 +180,11 @@ class Win(object):
         """Use this for the header row of the TSV."""
         return Win._header_row
 
+    def __json__(self):
+        return OrderedDict([('game_id',self.game.game_id), ('game_name',self.game.game_name), ('copy_id',self.copy_id),
+                            ('player_id',self.player.player_id), ('player_name',self.player.player_name),
+                            ('n_plays',self.n_plays), ('notes',self.notes)])
+
 def parse_games_json(filename):
     """Deserialize a list of game copies input from JSON.
         If json_str is specified, parse the string, otherwise use the file
@@ -242,10 +272,86 @@ def parse_plays_json(filename):
     all_plays = [GameCheckout(play_json=play) for play in m['Plays']]
     return all_plays
 
-def filter_plays(all_plays, awardable_games_by_ID, min_duration=None, max_duration=None):
+class GamePlaytimes(object):
+    """Per-game duration bounds from BGG playing times, as arrays indexed by game ID:
+        lower[game_id] = min_scale * BGG minTime and upper[game_id] = max_scale * BGG maxTime,
+        in seconds, NaN where BGG has no time (so no per-game bound applies).
+    """
+    def __init__(self, min_minutes, max_minutes, min_scale=0.5, max_scale=3.0):
+        """min_minutes, max_minutes = dicts of BGG minTime/maxTime in minutes, keyed by game ID"""
+        self.min_scale = min_scale
+        self.max_scale = max_scale
+        size = max(list(min_minutes)+list(max_minutes)+[0])+1
+        self.lower = np.full(size, np.nan)
+        self.upper = np.full(size, np.nan)
+        for game_id,minutes in min_minutes.items():
+            self.lower[game_id] = min_scale*60.0*minutes
+        for game_id,minutes in max_minutes.items():
+            self.upper[game_id] = max_scale*60.0*minutes
+
+    @classmethod
+    def from_json(cls, filename, min_scale=0.5, max_scale=3.0):
+        """Read bgg-playtimes.json (as written by Random Scripts/hoarding-bgg-compare.js):
+            a list of {gameId, name, bggId, minTime, maxTime}, times in minutes or null.
+            A 0 time (BGG's "unknown") is treated as missing.
+        """
+        with open(filename, encoding='utf-8') as f:
+            records = json.load(f)
+        min_minutes = {int(r['gameId']): r['minTime'] for r in records if r.get('minTime')}
+        max_minutes = {int(r['gameId']): r['maxTime'] for r in records if r.get('maxTime')}
+        logger.info(f"Read BGG playing times for {len(set(min_minutes) | set(max_minutes))} games from {filename}")
+        return cls(min_minutes, max_minutes, min_scale, max_scale)
+
+    @classmethod
+    def from_games(cls, games, min_scale=0.5, max_scale=3.0):
+        """From Games resolved by pnw_bgg.BGGClient.resolve (game.bgg set), without a JSON file"""
+        resolved = [g for g in games if getattr(g, 'bgg', None) is not None]
+        min_minutes = {g.game_id: g.bgg.min_playtime for g in resolved if g.bgg.min_playtime}
+        max_minutes = {g.game_id: g.bgg.max_playtime for g in resolved if g.bgg.max_playtime}
+        return cls(min_minutes, max_minutes, min_scale, max_scale)
+
+    def bounds(self, game_ids):
+        """RETURNS: (lower, upper) arrays of seconds for an array of game IDs, NaN where unknown"""
+        game_ids = np.asarray(game_ids, dtype=np.int64)
+        known = (game_ids >= 0) & (game_ids < len(self.lower))
+        index = np.where(known, game_ids, 0)
+        return np.where(known, self.lower[index], np.nan), np.where(known, self.upper[index], np.nan)
+
+    def game_bounds(self, game_id):
+        """RETURNS: (lower, upper) seconds for one game, NaN where unknown"""
+        if 0 <= game_id < len(self.lower):
+            return self.lower[game_id], self.upper[game_id]
+        return np.nan, np.nan
+
+def play_removal_reason(p, awardable_games_by_ID, min_duration=None, max_duration=None, playtimes=None):
+    """The filter_plays rule that removes this play, or None if it counts.
+        Reasons: not_awardable, no_players, min_duration, max_duration, game_min_duration,
+        game_max_duration (outside the game's own bounds, if playtimes is a GamePlaytimes),
+        no_motivated_players
+    """
+    if playtimes is not None:
+        game_min, game_max = playtimes.game_bounds(p.game.game_id)
+    if p.game.game_id not in awardable_games_by_ID:
+        return 'not_awardable'
+    elif len(p.players)==0:
+        return 'no_players'
+    elif (min_duration is not None) and p.duration < min_duration:
+        return 'min_duration'
+    elif (max_duration is not None) and p.duration > max_duration:
+        return 'max_duration'
+    elif (playtimes is not None) and p.duration < game_min:
+        return 'game_min_duration'
+    elif (playtimes is not None) and p.duration > game_max:
+        return 'game_max_duration'
+    elif not any(player.wants_to_win==True for player in p.players):
+        return 'no_motivated_players'
+    return None
+
+def filter_plays(all_plays, awardable_games_by_ID, min_duration=None, max_duration=None, playtimes=None):
     """Given a list of plays and an OrderedDict of awardable games by ID, remove:
         - any plays of games not awardable
         - any play durations outside of the min and max
+        - any play durations outside of the game's own bounds, if playtimes is a GamePlaytimes
         - any players who do not want to win that game copy
         - any plays of games with no players
 
@@ -254,26 +360,289 @@ def filter_plays(all_plays, awardable_games_by_ID, min_duration=None, max_durati
     """
     filtered_plays = defaultdict(list)
     removed_plays = defaultdict(list)
-    num_not_want_to_win = 0
 
     for p in all_plays:
-        if p.game.game_id not in awardable_games_by_ID:
-            removed_plays['not_awardable'].append(p)
-        elif len(p.players)==0:
-            removed_plays['no_players'].append(p)
-        elif (min_duration is not None) and p.duration < min_duration:
-            removed_plays['min_duration'].append(p)
-        elif (max_duration is not None) and p.duration > max_duration:
-            removed_plays['max_duration'].append(p)
+        reason = play_removal_reason(p, awardable_games_by_ID, min_duration, max_duration, playtimes)
+        if reason is not None:
+            removed_plays[reason].append(p)
         else:
-            filtered_players = [player for player in p.players if player.wants_to_win==True]
-            if len(filtered_players)==0:
-                removed_plays['no_motivated_players'].append(p)
-            else:
-                num_not_want_to_win += (len(p.players) - len(filtered_players))
-                filtered_play = copy(p)
-                filtered_play.players = filtered_players
-                filtered_plays[p.game.game_id].append(filtered_play)
+            filtered_play = copy(p)
+            filtered_play.players = [player for player in p.players if player.wants_to_win==True]
+            filtered_plays[p.game.game_id].append(filtered_play)
+
+    return filtered_plays, removed_plays
+
+_columnar_format = 'pnw-columnar'
+_columnar_version = 1
+
+def _epoch_seconds(dt):
+    """Seconds since 1970-01-01 on the same (naive, Central) clock as the parsed times."""
+    return int(dt.replace(tzinfo=timezone.utc).timestamp())
+
+class ColumnarPlays(object):
+    """Parallel arrays for a snapshot of plays, as written by output_plays_columnar.
+        Per play (one row per checkout):
+            - checkout_id, game_id: int64
+            - game_name, copy_id: int32 indexes into strings (-1 if missing)
+            - time_out, time_in: int64 epoch seconds, same Central clock as GameCheckout
+            - duration: float64 seconds
+            - player_offsets: int64, players of play i are rows player_offsets[i]:player_offsets[i+1]
+        Per player row (one row per player per play):
+            - player_id, player_name: int32 indexes into strings
+            - wants_to_win: bool
+            - rating: float64, NaN if missing (whole numbers come back from to_plays as int)
+        strings is the shared string dictionary.
+    """
+    def __init__(self, columns, strings):
+        for name,values in columns.items():
+            setattr(self, name, values)
+        self.strings = strings
+
+    def num_plays(self):
+        return len(self.checkout_id)
+
+    def num_player_rows(self):
+        return len(self.player_id)
+
+    def play_index(self):
+        """Return the play row of every player row."""
+        return np.repeat(np.arange(self.num_plays()), np.diff(self.player_offsets))
+
+    def to_plays(self, indices=None):
+        """Rebuild the snapshot (or just the plays at indices) as a list of GameCheckout objects."""
+        epoch = datetime(1970,1,1)
+        strings = self.strings
+        indices = np.arange(self.num_plays()) if indices is None else np.asarray(indices, dtype=np.int64)
+        # gather every column once as plain lists; indexing numpy scalars per field is far slower
+        starts = self.player_offsets[indices]
+        n_players = self.player_offsets[indices+1] - starts
+        rows = np.repeat(starts - np.concatenate([[0], np.cumsum(n_players)[:-1]]), n_players) + np.arange(n_players.sum())
+        player_ids = [strings[i] for i in self.player_id[rows].tolist()]
+        player_names = [strings[i] for i in self.player_name[rows].tolist()]
+        wants_to_win = self.wants_to_win[rows].tolist()
+        # NaN is missing; whole numbers were ints in the JSON, so the TSVs match the object path
+        ratings = [None if r!=r else int(r) if r.is_integer() else r for r in self.rating[rows].tolist()]
+
+        all_plays = list()
+        r = 0
+        for checkout_id, game_id, game_name, copy_id, time_out, time_in, duration, n in zip(
+                self.checkout_id[indices].tolist(), self.game_id[indices].tolist(),
+                self.game_name[indices].tolist(), self.copy_id[indices].tolist(),
+                self.time_out[indices].tolist(), self.time_in[indices].tolist(),
+                self.duration[indices].tolist(), n_players.tolist()):
+            play = GameCheckout()
+            play.checkout_id = checkout_id
+            play.game = Game(game_id=game_id, game_name=strings[game_name])
+            play.copy_id = strings[copy_id] if copy_id >= 0 else None
+            play.time_out = epoch + timedelta(seconds=time_out)
+            play.time_in = epoch + timedelta(seconds=time_in)
+            play.duration = duration
+            play.players = [Player(player_id=player_ids[k], player_name=player_names[k],
+                                   wants_to_win=wants_to_win[k], rating=ratings[k])
+                            for k in range(r, r+n)]
+            r += n
+            all_plays.append(play)
+        return all_plays
+
+def plays_to_columns(all_plays):
+    """Convert a list of GameCheckout objects to columns (an OrderedDict of arrays laid out as
+        in ColumnarPlays) and a list of strings.
+    """
+    string_index = dict()
+    def intern(s):
+        if s is None:
+            return -1
+        return string_index.setdefault(s, len(string_index))
+
+    n_plays = len(all_plays)
+    n_rows = sum(len(p.players) for p in all_plays)
+    columns = OrderedDict([
+        ('checkout_id', np.empty(n_plays, dtype=np.int64)),
+        ('game_id', np.empty(n_plays, dtype=np.int64)),
+        ('game_name', np.empty(n_plays, dtype=np.int32)),
+        ('copy_id', np.empty(n_plays, dtype=np.int32)),
+        ('time_out', np.empty(n_plays, dtype=np.int64)),
+        ('time_in', np.empty(n_plays, dtype=np.int64)),
+        ('duration', np.empty(n_plays, dtype=np.float64)),
+        ('player_offsets', np.empty(n_plays+1, dtype=np.int64)),
+        ('player_id', np.empty(n_rows, dtype=np.int32)),
+        ('player_name', np.empty(n_rows, dtype=np.int32)),
+        ('wants_to_win', np.empty(n_rows, dtype=np.bool_)),
+        ('rating', np.empty(n_rows, dtype=np.float64)),
+    ])
+
+    r = 0
+    columns['player_offsets'][0] = 0
+    for i,p in enumerate(all_plays):
+        columns['checkout_id'][i] = p.checkout_id
+        columns['game_id'][i] = p.game.game_id
+        columns['game_name'][i] = intern(p.game.game_name)
+        columns['copy_id'][i] = intern(getattr(p, 'copy_id', None))
+        columns['time_out'][i] = _epoch_seconds(p.time_out)
+        columns['time_in'][i] = _epoch_seconds(p.time_in)
+        columns['duration'][i] = p.duration
+        for player in p.players:
+            columns['player_id'][r] = intern(player.player_id)
+            columns['player_name'][r] = intern(player.player_name)
+            columns['wants_to_win'][r] = player.wants_to_win
+            columns['rating'][r] = np.nan if player.rating is None else player.rating
+            r += 1
+        columns['player_offsets'][i+1] = r
+
+    return columns, list(string_index)
+
+def output_plays_columnar(all_plays, out_dir):
+    """Write a list of GameCheckout objects to out_dir as one .npy file per column.
+
+        The directory also gets strings.json (the string dictionary) and meta.json, which
+        describes the columns. See ColumnarPlays for the layout. Use load_plays_columnar to read it.
+    """
+    columns, strings = plays_to_columns(all_plays)
+    n_plays = len(all_plays)
+    n_rows = len(columns['player_id'])
+
+    os.makedirs(out_dir, exist_ok=True)
+    for name,values in columns.items():
+        np.save(os.path.join(out_dir, name+'.npy'), values)
+    with open(os.path.join(out_dir,'strings.json'),'w',encoding='utf-8') as f:
+        json.dump(strings, f, ensure_ascii=False)
+
+    # meta.json goes last, so a half-written directory is never mistaken for a complete one
+    meta = dict(format=_columnar_format, version=_columnar_version,
+                n_plays=n_plays, n_player_rows=n_rows,
+                columns=OrderedDict((name,str(values.dtype)) for name,values in columns.items()))
+    with open(os.path.join(out_dir,'meta.json'),'w') as f:
+        json.dump(meta, f, indent=3)
+
+    logger.info(f"Wrote {n_plays} plays ({n_rows} player rows, {len(strings)} strings) to {out_dir}")
+
+def load_plays_columnar(in_dir, mmap_mode='r'):
+    """Load a directory written by output_plays_columnar as a ColumnarPlays object.
+        The arrays are memory-mapped (read-only) unless mmap_mode=None.
+    """
+    with open(os.path.join(in_dir,'meta.json')) as f:
+        meta = json.load(f)
+    if meta.get('format') != _columnar_format or meta.get('version') != _columnar_version:
+        raise IOError(f"{in_dir} is not a version {_columnar_version} {_columnar_format} directory")
+
+    columns = dict()
+    for name in meta['columns']:
+        columns[name] = np.load(os.path.join(in_dir, name+'.npy'), mmap_mode=mmap_mode)
+    with open(os.path.join(in_dir,'strings.json'),encoding='utf-8') as f:
+        strings = json.load(f)
+
+    return ColumnarPlays(columns, strings)
+
+def parse_plays_json_columnar(filename):
+    """Deserialize api/plays JSON (see parse_plays_json) straight into a ColumnarPlays object,
+        without building a GameCheckout per play. Times are parsed in bulk by NumPy, with the
+        same truncation to the second and shift to Central as GameCheckout.
+    """
+    with open(filename,'r',newline='') as f:
+        m = json.load(f)
+
+    string_index = dict()
+    def intern(s):
+        if s is None:
+            return -1
+        return string_index.setdefault(s, len(string_index))
+
+    checkout_id, game_id, game_name, copy_id, time_out, time_in, n_players = [], [], [], [], [], [], []
+    player_id, player_name, wants_to_win, rating = [], [], [], []
+    for play in m['Result']['Plays']:
+        checkout = play['Checkout']
+        copy_json = checkout.get('Copy') or dict()
+        checkout_id.append(int(play['CheckoutID']))
+        game_id.append(play['GameID'])
+        game_name.append(intern(play['GameName']))
+        copy_id.append(intern(str(copy_json['ID'])) if copy_json.get('ID') is not None else -1)
+        time_out.append(checkout['TimeOut'].split('.')[0])
+        time_in.append((checkout['TimeIn'] or checkout['TimeOut']).split('.')[0])
+        n_players.append(len(play['Players']))
+        for p in play['Players']:
+            player_id.append(intern(str(p['ID'])))
+            player_name.append(intern(p['Name']))
+            wants_to_win.append(bool(p['WantsToWin']))
+            rating.append(np.nan if p['Rating'] is None else p['Rating'])
+
+    shift = np.timedelta64(5,'h')
+    epoch = np.datetime64('1970-01-01T00:00:00','s')
+    time_out = ((np.array(time_out, dtype='datetime64[s]') - shift) - epoch).astype(np.int64)
+    time_in = ((np.array(time_in, dtype='datetime64[s]') - shift) - epoch).astype(np.int64)
+    player_offsets = np.zeros(len(n_players)+1, dtype=np.int64)
+    np.cumsum(n_players, out=player_offsets[1:])
+    columns = OrderedDict([
+        ('checkout_id', np.array(checkout_id, dtype=np.int64)),
+        ('game_id', np.array(game_id, dtype=np.int64)),
+        ('game_name', np.array(game_name, dtype=np.int32)),
+        ('copy_id', np.array(copy_id, dtype=np.int32)),
+        ('time_out', time_out),
+        ('time_in', time_in),
+        ('duration', (time_in - time_out).astype(np.float64)),
+        ('player_offsets', player_offsets),
+        ('player_id', np.array(player_id, dtype=np.int32)),
+        ('player_name', np.array(player_name, dtype=np.int32)),
+        ('wants_to_win', np.array(wants_to_win, dtype=np.bool_)),
+        ('rating', np.array(rating, dtype=np.float64)),
+    ])
+    return ColumnarPlays(columns, list(string_index))
+
+# removal reasons in the order play_removal_reason checks them
+_removal_reasons = ['not_awardable', 'no_players', 'min_duration', 'max_duration',
+                    'game_min_duration', 'game_max_duration', 'no_motivated_players']
+
+def columnar_removal_reasons(columnar, awardable_games_by_ID, min_duration=None, max_duration=None, playtimes=None):
+    """play_removal_reason for every play of a ColumnarPlays object at once. The per-game bounds
+        of a GamePlaytimes are gathered by game ID in one go (NaN bounds never fail).
+        RETURNS: an int8 array, -1 where the play counts, otherwise an index into _removal_reasons
+    """
+    n_players = np.diff(columnar.player_offsets)
+    n_motivated = np.bincount(columnar.play_index(), weights=columnar.wants_to_win, minlength=columnar.num_plays())
+    game_min, game_max = playtimes.bounds(columnar.game_id) if playtimes is not None else (None, None)
+    failed = [~np.isin(columnar.game_id, np.fromiter(awardable_games_by_ID, dtype=np.int64)),
+              n_players==0,
+              columnar.duration < min_duration if min_duration is not None else None,
+              columnar.duration > max_duration if max_duration is not None else None,
+              columnar.duration < game_min if playtimes is not None else None,
+              columnar.duration > game_max if playtimes is not None else None,
+              n_motivated==0]
+
+    # each play gets the first rule it fails, so go from the last rule to the first
+    reasons = np.full(columnar.num_plays(), -1, dtype=np.int8)
+    for code in reversed(range(len(failed))):
+        if failed[code] is not None:
+            reasons[failed[code]] = code
+    return reasons
+
+def filter_plays_columnar(columnar, awardable_games_by_ID, min_duration=None, max_duration=None, playtimes=None):
+    """filter_plays for a ColumnarPlays object (from load_plays_columnar or
+        parse_plays_json_columnar): the rules are boolean masks over all plays at once, and
+        each game's plays come from one stable argsort.
+
+        RETURNS:
+            The same as filter_plays: a defaultdict of GameCheckout objects (motivated players
+            only) keyed by game ID, and a defaultdict of removed plays keyed by reason, both
+            keyed and ordered as filter_plays would.
+    """
+    reasons = columnar_removal_reasons(columnar, awardable_games_by_ID, min_duration, max_duration, playtimes)
+
+    filtered_plays = defaultdict(list)
+    kept = np.flatnonzero(reasons==-1)
+    kept = kept[np.argsort(columnar.game_id[kept], kind='stable')]
+    game_ids, starts = np.unique(columnar.game_id[kept], return_index=True)
+    ends = np.append(starts[1:], len(kept))
+    # dict order follows each game's first play, like filter_plays
+    for g in np.argsort(kept[starts], kind='stable') if len(kept) else []:
+        plays = columnar.to_plays(kept[starts[g]:ends[g]])
+        for play in plays:
+            play.players = [p for p in play.players if p.wants_to_win==True]
+        filtered_plays[int(game_ids[g])] = plays
+
+    removed_plays = defaultdict(list)
+    removed = np.flatnonzero(reasons >= 0)
+    codes, first = np.unique(reasons[removed], return_index=True)
+    for code in codes[np.argsort(first)]:
+        removed_plays[_removal_reasons[code]] = columnar.to_plays(removed[reasons[removed]==code])
 
     return filtered_plays, removed_plays
 
@@ -292,32 +661,59 @@ def parse_ineligible_players(ineligible_players_fn):
     # logger.debug(json.dumps(ineligible_players,cls=CustomJSONEncoder))
     return ineligible_players
 
+def _encodable_row(row, encoding='utf-8'):
+    """Replace whatever the file encoding can't hold (e.g. a lone surrogate in a name) with '?'."""
+    return [x.encode(encoding,'replace').decode(encoding) if isinstance(x,str) else x for x in row]
+
 def output_winners(wins,out_fn):
     """TSV output of winners to the specified file.
         ARGUMENTS:
             wins - a list of Game objects, each with a list of Players who won
             out_fn - the TSV file
     """
-    with open(out_fn,'w',newline='', encoding="utf-8") as f:
-        writer = csv.writer(f,delimiter='\t')
-        writer.writerow(Win._header_row)
-        for w in wins:
-            try:
-                writer.writerow(w.list_output())
-            except UnicodeEncodeError as err:
-                logger.warning(f"Exception {err} when giving away {w.game.game_name} ({w.copy_id}), check results...")
-                writer.writerow(w.list_output().encode('ascii', 'ignore').decode('ascii'))
-
-
-def output_winners_labels(wins,out_fn):
-    """label-formatted output of winners to the specified file.
-        ARGUMENTS:
-            wins - a list of Game objects, each with a list of Players who won
-            out_fn - the labels file
+    rows = [w.list_output() for w in wins]
+    try:
+        with open(out_fn,'w',newline='', encoding="utf-8") as f:
+            writer = csv.writer(f,delimiter='\t')
+            writer.writerow(Win._header_row)
+            writer.writerows(rows)
+    except UnicodeEncodeError as err:
+        # rewrite the whole file in one go, rather than finding the bad rows one at a time
+        logger.warning(f"Exception {err} when writing winners to {out_fn}, unencodable characters replaced with '?', check results...")
+        with open(out_fn,'w',newline='', encoding="utf-8") as f:
+            writer = csv.writer(f,delimiter='\t')
+            writer.writerow(Win._header_row)
+            writer.writerows(_encodable_row(row) for row in rows)
+
+def output_results_json(wins, problem_plays, out_fn, suffix=None):
+    """JSON output of the draw: every win, and the games that had problems being awarded."""
+    unawarded = OrderedDict()
+    for play in problem_plays:
+        unawarded.setdefault(play.game.game_id, play.game.game_name)
+    results = OrderedDict([('suffix', suffix), ('n_wins', len(wins)), ('wins', wins),
+                           ('problem_games', [dict(game_id=g, game_name=n) for g,n in unawarded.items()])])
+    with open(out_fn,'w',encoding='utf-8',errors='replace') as f:
+        json.dump(results, f, cls=CustomJSONEncoder, indent=3, ensure_ascii=False)
+
+def parse_winners_tsv(winners_fn):
+    """Parse a winners TSV written by output_winners back into Win objects.
+        Only the game ID and name are known for each game, and the winning play isn't kept.
+    """
+    wins = list()
+    with open(winners_fn,'r',newline='',encoding='utf-8') as f:
+        r = csv.DictReader(f, delimiter='\t')
+        for row in r:
+            game = Game(game_id=int(row['Game_ID']), game_name=row['Game_Name'])
+            player = Player(player_id=row['Winner_ID'], player_name=row['Winner_Name'])
+            wins.append(Win(game=game, copy_id=row['Copy_ID'], player=player, play=None,
+                            n_plays=int(row['N_plays']), notes=row['Notes']))
+    return wins
+
+def _avery_6460():
+    """The label sheet: Avery 6460 labels on 8.5"x11" (216mm x 279mm) sheets, with 3 columns of labels.
+        Each label is 1"x2-5/8" (25.4mm x 66.675mm) with a 2mm rounded corner. The gaps between
+        labels are calculated from the margins.
     """
-    # This uses Avery 6460 labels on 8.5"x11" (216mm x 279mm) sheets, with 3 columns of labels.
-    # Each label is 1"x2-5/8" (25.4mm x 66.675mm) with a 2mm rounded corner. The margins are
-    # automatically calculated.
     pw = 216   # actually 215.9
     ph = 279   # actually 279.4
     corner = 2
@@ -327,51 +723,106 @@ def output_winners_labels(wins,out_fn):
     lh = 25     # actually 25.4
     rows = 10
     cols = 3
-    specs = labels.Specification(pw, ph, cols, rows, lw, lh, corner_radius=corner,
+    return labels.Specification(pw, ph, cols, rows, lw, lh, corner_radius=corner,
         left_margin=side_margins, right_margin=side_margins, top_margin=front_margins,
         bottom_margin=front_margins)
 
-    # Measure the width of the name and shrink the font size until it fits.
-    def autosize_text(text, font, area_width, start_size):
-        """ Shrink text to fit into the given area. Returns the appropriate font size."""
-        font_size = start_size
-        text_width = stringWidth(text, font, font_size)
-        while text_width > area_width:
-            font_size *= 0.8
-            text_width = stringWidth(text, font, font_size)
-        return font_size
-
-    # Create a function to draw each label. This will be given the ReportLab drawing
-    # object to draw on, the dimensions (NB. these will be in points, the unit
-    # ReportLab uses) of the label, and the object to render.
-
-    def draw_label(label, width, height, text):
-        """ Expects a tuple: first entry is the winner, second is the game."""
-        font = "Helvetica"
-        lr_margins = 5
-        padded_width = width-(lr_margins*2)
-        winner_size = autosize_text(text[0],font,padded_width,14)
-        game_size = autosize_text(text[1],font,padded_width,winner_size)
-        winner_pos = height/2 + 5
-        game_pos =  height/2 - 5 - game_size
-
-        # Winner on top line, in blue
-        label.add(shapes.String(lr_margins, winner_pos, text[0], fontName=font,
-            fillColor=colors.blue, fontSize=winner_size))
-
-        # Game on bottom line, never bigger than winner.
-        label.add(shapes.String(lr_margins, game_pos, text[1], fontName=font,
-            fontSize=game_size))
-
-    # Create the sheet
-    sheet = labels.Sheet(specs, draw_label, border=False)
-
-    # Add the winners
-    sheet.add_labels([w.label_output() for w in wins])
-
-    # Save the file and we are done.
-    sheet.save(out_fn)
-    logger.info("{0:d} label(s) output on {1:d} page(s).".format(sheet.label_count, sheet.page_count))
+# pylabels measures in Decimal millimetres; convert the same way so labels land in the same place
+_label_mm = Decimal(mm)
+
+def _label_positions(specs):
+    """(left, bottom) of every label on a page in points, in the order pylabels fills them
+        (left to right, then top to bottom)."""
+    positions = list()
+    for row in range(1, specs.rows+1):
+        bottom = specs.sheet_height - specs.top_margin - specs.label_height*row - (specs.row_gap or 0)*(row-1)
+        for col in range(1, specs.columns+1):
+            left = specs.left_margin + (specs.label_width + (specs.column_gap or 0))*(col-1)
+            positions.append((float(left*_label_mm), float(bottom*_label_mm)))
+    return positions
+
+def _label_font_size(text, font, area_width, start_size):
+    """The font size the label has always used: start_size, shrunk by 0.8 until the text fits
+        area_width. String width is linear in font size, so the number of steps is solved
+        directly instead of measuring the text at every step.
+    """
+    width = stringWidth(text, font, start_size)
+    if width <= area_width:
+        return start_size
+    steps = math.ceil(math.log(width/area_width)/math.log(1/0.8))
+    # guard the rounding at the boundary, where the loop would have stopped a step apart
+    if width*0.8**steps > area_width:
+        steps += 1
+    elif steps > 1 and width*0.8**(steps-1) <= area_width:
+        steps -= 1
+    return start_size*0.8**steps
+
+def _label_lines(text, width, height):
+    """Layout of one label: (font, x, winner_y, winner_size, game_y, game_size) relative to its corner.
+        Expects a tuple: first entry is the winner, second is the game."""
+    font = "Helvetica"
+    lr_margins = 5
+    padded_width = width-(lr_margins*2)
+    winner_size = _label_font_size(text[0],font,padded_width,14)
+    game_size = _label_font_size(text[1],font,padded_width,winner_size)  # never bigger than winner
+    return font, lr_margins, height/2 + 5, winner_size, height/2 - 5 - game_size, game_size
+
+def output_winners_labels(wins,out_fn,backend='canvas'):
+    """label-formatted output of winners to the specified file.
+        ARGUMENTS:
+            wins - a list of Game objects, each with a list of Players who won
+            out_fn - the labels file
+            backend - 'canvas' draws each label straight onto the ReportLab canvas at positions
+                      computed once per sheet; 'pylabels' builds every label as a drawing through
+                      pylabels' Sheet first. Both produce the same sheets.
+    """
+    specs = _avery_6460()
+    if backend=='pylabels':
+        # Create a function to draw each label. This will be given the ReportLab drawing
+        # object to draw on, the dimensions (NB. these will be in points, the unit
+        # ReportLab uses) of the label, and the object to render.
+        def draw_label(label, width, height, text):
+            font, x, winner_pos, winner_size, game_pos, game_size = _label_lines(text, width, height)
+
+            # Winner on top line, in blue
+            label.add(shapes.String(x, winner_pos, text[0], fontName=font,
+                fillColor=colors.blue, fontSize=winner_size))
+
+            # Game on bottom line, never bigger than winner.
+            label.add(shapes.String(x, game_pos, text[1], fontName=font,
+                fontSize=game_size))
+
+        # Create the sheet
+        sheet = labels.Sheet(specs, draw_label, border=False)
+
+        # Add the winners
+        sheet.add_labels([w.label_output() for w in wins])
+
+        # Save the file and we are done.
+        sheet.save(out_fn)
+        label_count, page_count = sheet.label_count, sheet.page_count
+    else:
+        positions = _label_positions(specs)
+        width, height = float(specs.label_width*_label_mm), float(specs.label_height*_label_mm)
+        c = canvas.Canvas(out_fn, pagesize=(float(specs.sheet_width*_label_mm), float(specs.sheet_height*_label_mm)))
+        label_count = 0
+        for w in wins:
+            if label_count and label_count % len(positions)==0:
+                c.showPage()
+            left, bottom = positions[label_count % len(positions)]
+            text = w.label_output()
+            font, x, winner_pos, winner_size, game_pos, game_size = _label_lines(text, width, height)
+            c.setFillColor(colors.blue)
+            c.setFont(font, winner_size)
+            c.drawString(left+x, bottom+winner_pos, text[0])
+            c.setFillColor(colors.black)
+            c.setFont(font, game_size)
+            c.drawString(left+x, bottom+game_pos, text[1])
+            label_count += 1
+        c.save()
+        page_count = -(-label_count//len(positions))
+
+    logger.info("{0:d} label(s) output on {1:d} page(s).".format(label_count, page_count))
 
 def output_problem_file(problem_fn, problem_plays):
     """Output a TSV file of all plays for all games that have unawarded copies or other problems."""
@@ -381,17 +832,51 @@ def output_problem_file(problem_fn, problem_plays):
     for play in problem_plays:
             tsv_rows.extend(play.tsv_rows())
 
-    with open(problem_fn,'w',newline='') as f:
+    with open(problem_fn,'w',newline='',encoding='utf-8',errors='replace') as f:
         writer = csv.writer(f,delimiter='\t')
         writer.writerow(headers)
         writer.writerows(tsv_rows)
 
-def setup_logger(app_name):
+class _LocalQueueHandler(logging.handlers.QueueHandler):
+    """A QueueHandler for a listener in the same process: records are queued as they are, so even
+        their message is formatted on the listener's thread. Log values (numbers, strings), not
+        objects that may change before the listener gets to them.
+    """
+    def prepare(self, record):
+        return record
+
+_log_listeners = dict()
+
+def _stop_log_listeners():
+    for listener in _log_listeners.values():
+        listener.stop()
+    _log_listeners.clear()
+
+def _unqueue_after_fork():
+    """The listener thread doesn't survive a fork, so a forked child (e.g. a pnw_batch worker)
+        logs straight to the handlers instead.
+    """
+    for name,listener in _log_listeners.items():
+        logger = logging.getLogger(name)
+        for h in list(logger.handlers):
+            if isinstance(h, logging.handlers.QueueHandler):
+                logger.removeHandler(h)
+        for h in listener.handlers:
+            logger.addHandler(h)
+    _log_listeners.clear()
+
+atexit.register(_stop_log_listeners)
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_unqueue_after_fork)
+
+def setup_logger(app_name, log_dir='log', queued=True):
     """Creates debug and warning files based on the input app_name, in the log directory.
         By default files are appended, not overwritten.
+        With queued=True the logger only puts records on a queue, and a background thread
+        (a QueueListener, stopped at exit) formats them and writes the files and the console.
     """
-    fn_debug = 'log/'+app_name+'.debug.log'
-    fn_warning = 'log/'+app_name+'.warning.log'
+    fn_debug = os.path.join(log_dir, app_name+'.debug.log')
+    fn_warning = os.path.join(log_dir, app_name+'.warning.log')
 
     logger = logging.getLogger(app_name)
     logger.setLevel(logging.DEBUG)
@@ -410,14 +895,32 @@ def setup_logger(app_name):
     ch.setFormatter(formatter)
     fh.setFormatter(formatter)
     fh2.setFormatter(formatter)
-    # add the handlers to logger
-    logger.addHandler(ch)
-    logger.addHandler(fh)
-    logger.addHandler(fh2)
+    # add the handlers to logger, or to a listener the logger queues records for
+    if queued:
+        if app_name in _log_listeners:
+            _log_listeners.pop(app_name).stop()
+            for h in [h for h in logger.handlers if isinstance(h, _LocalQueueHandler)]:
+                logger.removeHandler(h)
+        log_queue = queue.SimpleQueue()
+        listener = logging.handlers.QueueListener(log_queue, ch, fh, fh2, respect_handler_level=True)
+        _log_listeners[app_name] = listener
+        logger.addHandler(_LocalQueueHandler(log_queue))
+        listener.start()
+    else:
+        logger.addHandler(ch)
+        logger.addHandler(fh)
+        logger.addHandler(fh2)
 
     datestr = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
     logger.debug(f'------------ {datestr} : {app_name} : DEBUG ------------')
     logger.info(f'------------ {datestr} : {app_name} : INFO ------------')
     logger.warning(f'------------ {datestr} : {app_name} : WARNINGS ------------')
 
-    return logger
\ No newline at end of file
+    return logger
+
+def flush_logger(app_name):
+    """Wait until everything a queued setup_logger logger has logged so far is written."""
+    listener = _log_listeners.get(app_name)
+    if listener is not None:
+        listener.stop()
+        listener.start()
@@ -1,12 +1,19 @@
+import hashlib
 import http.client
 import json
 import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 
-def get_auth():
+default_auth_url = "geekway.auth0.com"
+
+def get_auth(auth_url=None):
     """Authenticate to Auth0 via the client_credentials grant.
 
     Credentials are read from the environment so they never live in source:
       AUTH0_CLIENT_ID, AUTH0_CLIENT_SECRET
+    auth_url defaults to default_auth_url; see connect for the forms it can take.
     """
     client_id = os.environ.get("AUTH0_CLIENT_ID")
     client_secret = os.environ.get("AUTH0_CLIENT_SECRET")
@@ -15,7 +22,7 @@ def get_auth():
             "Missing AUTH0_CLIENT_ID and/or AUTH0_CLIENT_SECRET environment variables."
         )
 
-    conn = http.client.HTTPSConnection("geekway.auth0.com")
+    conn = connect(auth_url if auth_url is not None else default_auth_url)
     payload = json.dumps({
         "client_id": client_id,
         "client_secret": client_secret,
@@ -32,34 +39,310 @@ def get_auth():
 
     return decoded
 
-def get_api_resource(access_token, resource, url):
-    """5/4/19: Now uses HTTPS. Base endpoint was /pnw/service/api, now just /."""
-    # sub_endpoint = '/copycollections/2'
-    # sub_endpoint = '/api/legacy/org/1/con/273/coll/16/' #pnw
-    sub_endpoint = '/api/legacy/org/1/con/273/coll/17/' #playtest
-    conn = http.client.HTTPSConnection(url)
+# collection 16 is P&W, 17 is playtest
+default_sub_endpoint = '/api/legacy/org/1/con/273/coll/17/'
+
+def collection_sub_endpoint(org, con, coll):
+    """The API path for one org/con/collection."""
+    return f'/api/legacy/org/{org}/con/{con}/coll/{coll}/'
+
+class APIError(IOError):
+    """A non-200 answer from the API; status is the HTTP status."""
+    def __init__(self, status, reason):
+        super().__init__(f"Error parsing API: status {status} {reason}")
+        self.status = status
+
+def connect(url):
+    """A connection to the API host: a bare host name (or https://host) uses HTTPS, and
+        http://host:port is for a local stand-in server."""
+    if url.startswith('http://'):
+        return http.client.HTTPConnection(url[len('http://'):].rstrip('/'))
+    if url.startswith('https://'):
+        url = url[len('https://'):]
+    return http.client.HTTPSConnection(url.rstrip('/'))
+
+default_cache_dir = os.path.join('data','http_cache')
+
+class HTTPCache(object):
+    """On-disk cache of GET responses that came with an ETag or Last-Modified header, so the
+        next request for the same path can be conditional (If-None-Match / If-Modified-Since)
+        and a 304 reuses the stored body.
+
+        Each entry is <key>.json (validators and times) next to <key>.body (the raw payload).
+        Entries not revalidated within ttl seconds are dropped, and the least recently used
+        entries are evicted once the bodies add up to more than max_bytes.
+    """
+    def __init__(self, cache_dir=default_cache_dir, ttl=7*24*3600, max_bytes=256*2**20):
+        self.cache_dir = cache_dir
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self._parsed = dict()   # key: (stored time, parsed JSON) for reuse within one process
+        self._lock = threading.Lock()
+
+    def key(self, url, path):
+        """The cache key for a host and path. The access token is not part of it: it changes every run."""
+        return hashlib.sha256(f"{url}{path}".encode('utf-8')).hexdigest()[:32]
+
+    def _meta_fn(self, key):
+        return os.path.join(self.cache_dir, key+'.json')
+
+    def _body_fn(self, key):
+        return os.path.join(self.cache_dir, key+'.body')
+
+    def lookup(self, key):
+        """The entry's metadata, or None if there is no usable entry."""
+        try:
+            with open(self._meta_fn(key)) as f:
+                meta = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if time.time()-meta['validated'] > self.ttl or not os.path.exists(self._body_fn(key)):
+            self._remove(key)
+            return None
+        return meta
+
+    def conditional_headers(self, meta):
+        headers = dict()
+        if meta.get('etag'):
+            headers['If-None-Match'] = meta['etag']
+        if meta.get('last_modified'):
+            headers['If-Modified-Since'] = meta['last_modified']
+        return headers
+
+    def body(self, key):
+        with open(self._body_fn(key),'rb') as f:
+            return f.read()
+
+    def store(self, key, path, res, data):
+        """Keep a 200 response if it can be revalidated later. RETURNS: the metadata, or None"""
+        etag = res.getheader('ETag')
+        last_modified = res.getheader('Last-Modified')
+        if etag is None and last_modified is None:
+            return None
+        now = time.time()
+        meta = dict(path=path, etag=etag, last_modified=last_modified, size=len(data),
+                    stored=now, validated=now, used=now)
+        os.makedirs(self.cache_dir, exist_ok=True)
+        # body first and both atomically, so a crash never leaves metadata for a missing body
+        self._write(self._body_fn(key), data)
+        self._write(self._meta_fn(key), json.dumps(meta).encode('utf-8'))
+        self.evict()
+        return meta
+
+    def revalidated(self, key, meta, res):
+        """A 304 confirmed the entry: restart its TTL and pick up any new validators."""
+        meta = dict(meta)
+        meta['etag'] = res.getheader('ETag') or meta.get('etag')
+        meta['last_modified'] = res.getheader('Last-Modified') or meta.get('last_modified')
+        meta['validated'] = meta['used'] = time.time()
+        self._write(self._meta_fn(key), json.dumps(meta).encode('utf-8'))
+        return meta
+
+    def loads(self, key, meta, payload):
+        """json.loads(payload), reusing this process's parse if the body hasn't changed since."""
+        if meta is None:
+            return json.loads(payload)
+        with self._lock:
+            parsed = self._parsed.get(key)
+        if parsed is not None and parsed[0]==meta['stored']:
+            return parsed[1]
+        obj = json.loads(payload)
+        with self._lock:
+            self._parsed[key] = (meta['stored'], obj)
+        return obj
+
+    def evict(self):
+        """Drop expired entries, then the least recently used until under max_bytes."""
+        with self._lock:
+            entries = list()
+            now = time.time()
+            for fn in os.listdir(self.cache_dir):
+                if not fn.endswith('.json'):
+                    continue
+                key = fn[:-len('.json')]
+                try:
+                    with open(self._meta_fn(key)) as f:
+                        meta = json.load(f)
+                except (OSError, ValueError):
+                    continue
+                if now-meta['validated'] > self.ttl:
+                    self._remove(key)
+                else:
+                    entries.append((meta['used'], meta['size'], key))
+            total = sum(size for used,size,key in entries)
+            for used,size,key in sorted(entries):
+                if total <= self.max_bytes:
+                    break
+                self._remove(key)
+                total -= size
+
+    def _remove(self, key):
+        self._parsed.pop(key, None)
+        for fn in (self._meta_fn(key), self._body_fn(key)):
+            try:
+                os.remove(fn)
+            except FileNotFoundError:
+                pass
+
+    def _write(self, fn, data):
+        tmp_fn = f"{fn}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_fn,'wb') as f:
+            f.write(data)
+        os.replace(tmp_fn, fn)
+
+def _api_get(access_token, path, url, conn=None, cache=None, refresh=False):
+    """GET one API path. With a cache, the request is conditional on the cached entry (unless
+        refresh) and a 304 returns the cached body.
+        RETURNS: (payload bytes, cache metadata or None)
+    """
+    if conn is None:
+        conn = connect(url)
     headers = { 'authorization': "Bearer " + access_token }
-    conn.request("GET", sub_endpoint + resource, headers=headers)
+    key = meta = None
+    if cache is not None:
+        key = cache.key(url, path)
+        meta = None if refresh else cache.lookup(key)
+        if meta is not None:
+            headers.update(cache.conditional_headers(meta))
+    conn.request("GET", path, headers=headers)
 
     res = conn.getresponse()
+    data = res.read()   # read it all, even on errors, so the connection can be reused
+    if res.status == 304 and meta is not None:
+        return cache.body(key), cache.revalidated(key, meta, res)
     if res.status != 200:
-        raise(IOError(f"Error parsing API: status {res.status} {res.reason}"))
+        raise(APIError(res.status, res.reason))
+    if cache is not None:
+        meta = cache.store(key, path, res, data)
+    return data, meta
 
-    data = res.read()
+def get_api_resource(access_token, resource, url, sub_endpoint=None, conn=None, cache=None, refresh=False):
+    """5/4/19: Now uses HTTPS. Base endpoint was /pnw/service/api, now just /.
+
+    sub_endpoint defaults to default_sub_endpoint. Pass an open conn to reuse it (keep-alive)
+    across requests to the same host. Pass an HTTPCache to make the request conditional and reuse
+    the cached payload when the server answers 304 Not Modified; refresh=True skips the cache
+    (and replaces its entry).
+    """
+    # sub_endpoint = '/copycollections/2'
+    if sub_endpoint is None:
+        sub_endpoint = default_sub_endpoint
+    data, meta = _api_get(access_token, sub_endpoint + resource, url, conn, cache, refresh)
     payload = data.decode("utf-8")
 
     return payload
 
-def retrieve_data_api(endpoint, url='{}'):
-    """Get either plays or games from a remote api."""
+def _retryable(err):
+    """Worth another try: dropped connections, timeouts and server-side errors."""
+    status = getattr(err, 'status', None)
+    return status is None or status >= 500 or status == 429
+
+def retrieve_plays_paged(access_token, url, sub_endpoint=None, page_size=5000, max_workers=4, retries=3, on_page=None):
+    """Get the plays resource in pages of page_size (plays?offset=N&limit=page_size), up to
+        max_workers pages at a time.
+
+        Each page is parsed in its worker thread as soon as it arrives, and a failed page is
+        retried on its own (with backoff, up to retries times) on a fresh connection. The first
+        page is fetched alone. A short first page may be the whole snapshot, or the server's own
+        cap on limit, so the following offsets step by its length. Pages are requested until one
+        comes back empty, or repeats the first page (a server that ignores offset/limit sends
+        every play each time). They are merged in page order, dropping any play a later page
+        repeats (plays can shift between pages while they are being fetched).
+        on_page(n) is called with the number of plays in each page as it arrives (from the worker
+        threads), e.g. to report progress.
+
+        RETURNS: the same as retrieve_data_api('plays', ...)
+    """
+    if sub_endpoint is None:
+        sub_endpoint = default_sub_endpoint
+    local = threading.local()
+
+    def fetch_page(offset):
+        path = f"{sub_endpoint}plays?offset={offset}&limit={page_size}"
+        for attempt in range(retries+1):
+            if getattr(local, 'conn', None) is None:
+                local.conn = connect(url)
+            try:
+                data, meta = _api_get(access_token, path, url, conn=local.conn)
+                plays = json.loads(data)['Result']['Plays']
+                if on_page is not None:
+                    on_page(len(plays))
+                return plays
+            except (http.client.HTTPException, OSError, ValueError, KeyError) as err:   # a cut-off or garbled body too
+                local.conn.close()
+                local.conn = None
+                if attempt == retries or not _retryable(err):
+                    raise
+                time.sleep(0.5*2**attempt)
+
+    pages = {0: fetch_page(0)}
+    step = len(pages[0]) if 0 < len(pages[0]) < page_size else page_size
+    first_ids = set(p['CheckoutID'] for p in pages[0])
+
+    def is_end(plays):
+        """Empty, or nothing but page 0 again (the server ignores offset/limit)"""
+        return (len(plays)==0 or plays[0]['CheckoutID']==pages[0][0]['CheckoutID']
+                or all(p['CheckoutID'] in first_ids for p in plays))
+
+    end_page = 0 if len(pages[0])==0 else None      # the first page not to merge
+    if end_page is None:
+        with ThreadPoolExecutor(max_workers=max_workers) as pool:
+            next_page = 1
+            futures = dict()
+            while True:
+                while end_page is None and len(futures) < max_workers:
+                    futures[pool.submit(fetch_page, next_page*step)] = next_page
+                    next_page += 1
+                if not futures:
+                    break
+                done, pending = wait(futures, return_when=FIRST_COMPLETED)
+                for future in done:
+                    page = futures.pop(future)
+                    pages[page] = future.result()
+                    if is_end(pages[page]):
+                        end_page = page if end_page is None else min(end_page, page)
+
+    all_plays = list()
+    seen = set()
+    for page in range(end_page):
+        for play in pages[page]:
+            if play['CheckoutID'] not in seen:
+                seen.add(play['CheckoutID'])
+                all_plays.append(play)
+    return dict(Errors=[], Result=dict(Plays=all_plays))
+
+def retrieve_data_api(endpoint, url='{}', sub_endpoint=None, access_token=None, cache=None, refresh=False, page_size=None,
+                        auth_url=None, on_page=None):
+    """Get either plays or games from a remote api. Authenticates first unless given an access_token.
+
+    With a page_size, plays are fetched in concurrent pages (see retrieve_plays_paged), and
+    on_page(n) is called as each page of n plays arrives. Without one, it is called once with
+    every play.
+
+    With an HTTPCache (meant for 'games', which hardly changes during a con), reruns make one
+    conditional request, and a 304 reuses the cached catalogue: already parsed if this process
+    parsed it before, otherwise read from disk.
+    """
     if endpoint not in ['plays','games']:
         raise IOError("endpoint must be 'plays' or 'games'")
 
     # authenticate to get access_token
-    auth = json.loads(get_auth())
-    access_token = auth['access_token']
+    if access_token is None:
+        auth = json.loads(get_auth(auth_url))
+        access_token = auth['access_token']
+
+    if endpoint == 'plays' and page_size:
+        return retrieve_plays_paged(access_token, url, sub_endpoint, page_size, on_page=on_page)
 
     # fetch the endpoint
     # This serializes to a python object
     # Deserialize it with json.dump
-    return json.loads(get_api_resource(access_token,endpoint,url))
+    if sub_endpoint is None:
+        sub_endpoint = default_sub_endpoint
+    data, meta = _api_get(access_token, sub_endpoint + endpoint, url, cache=cache, refresh=refresh)
+    if cache is None:
+        result = json.loads(data)
+        if endpoint == 'plays' and on_page is not None:
+            on_page(len(result['Result']['Plays']))
+        return result
+    return cache.loads(cache.key(url, sub_endpoint + endpoint), meta, data)
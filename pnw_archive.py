@@ -0,0 +1,363 @@
+"""A multi-year archive of games and plays snapshots, for questions across cons.
+
+    python pnw_archive.py add archive/ 2024 data/games.2024.json data/plays.2024.json
+    python pnw_archive.py player archive/ 1234
+    python pnw_archive.py games archive/ --limit 25
+
+Each snapshot is compacted once (append-only: it is never rewritten, and the catalog only
+grows) into its own directory:
+
+    blocks.bin      the plays, sorted by check-out time, in zlib-compressed blocks of the
+                    ColumnarPlays columns, back to back
+    blocks.npy      per block: where it is in blocks.bin, its play and player-row ranges and
+                    its check-out time range
+    player_*.npy    per player (sorted by badge ID): plays logged and the blocks they're in
+    game_*.npy      per game (sorted by ID): plays, unique players and the blocks they're in
+    copies_*.npy    the games snapshot: copies and winnable copies per game
+    strings.json, meta.json
+
+Everything but blocks.bin is memory-mapped, and blocks.bin is memory-mapped and decompressed
+one block at a time, only for blocks the indexes say can match. Counting questions (a
+player's plays, a game's players) are answered from the indexes alone.
+"""
+import argparse
+import json
+import logging
+import mmap
+import os
+import zlib
+from collections import OrderedDict
+from datetime import datetime
+
+import numpy as np
+
+import pnw
+
+logger = logging.getLogger(__name__)
+
+_archive_format = 'pnw-archive'
+_archive_version = 1
+
+_play_columns = ['checkout_id','game_id','game_name','copy_id','time_out','time_in','duration']
+_row_columns = ['player_id','player_name','wants_to_win','rating']
+
+# blocks.npy columns
+_B_OFFSET, _B_LENGTH, _B_PLAY_START, _B_PLAY_END, _B_ROW_START, _B_ROW_END, _B_TIME_MIN, _B_TIME_MAX = range(8)
+
+def _csr(keys, values, n_keys):
+    """Group the distinct values seen with each key 0..n_keys-1.
+        RETURNS: (offsets, values) so key k's values are values[offsets[k]:offsets[k+1]]
+    """
+    pairs = np.unique(np.stack([keys, values]).astype(np.int64), axis=1)
+    offsets = np.zeros(n_keys+1, dtype=np.int64)
+    np.cumsum(np.bincount(pairs[0], minlength=n_keys), out=offsets[1:])
+    return offsets, pairs[1].copy()
+
+def _sort_by_time(columns):
+    """Reorder plays (and their player rows) by check-out time."""
+    offsets = columns['player_offsets']
+    order = np.argsort(columns['time_out'], kind='stable')
+    counts = np.diff(offsets)[order]
+    new_offsets = np.zeros(len(offsets), dtype=np.int64)
+    np.cumsum(counts, out=new_offsets[1:])
+    row_order = np.repeat(offsets[:-1][order] - new_offsets[:-1], counts) + np.arange(new_offsets[-1])
+    sorted_columns = OrderedDict()
+    for name in _play_columns:
+        sorted_columns[name] = columns[name][order]
+    sorted_columns['player_offsets'] = new_offsets
+    for name in _row_columns:
+        sorted_columns[name] = columns[name][row_order]
+    return sorted_columns
+
+def _write_snapshot(out_dir, all_games, all_plays, block_plays):
+    """Compact one games + plays snapshot into out_dir. RETURNS: its meta dict"""
+    columns, strings = pnw.plays_to_columns(all_plays)
+    columns = _sort_by_time(columns)
+    n_plays = len(columns['checkout_id'])
+    n_rows = len(columns['player_id'])
+    offsets = columns['player_offsets']
+    os.makedirs(out_dir)
+
+    # Compressed blocks, and which block every play and player row landed in
+    starts = list(range(0, n_plays, block_plays))
+    blocks = np.zeros((len(starts), 8), dtype=np.int64)
+    row_block = np.zeros(n_rows, dtype=np.int64)
+    with open(os.path.join(out_dir,'blocks.bin'),'wb') as f:
+        position = 0
+        for b,ps in enumerate(starts):
+            pe = min(ps+block_plays, n_plays)
+            rs, re = int(offsets[ps]), int(offsets[pe])
+            parts = [columns[name][ps:pe] for name in _play_columns]
+            parts.append(offsets[ps:pe+1]-rs)
+            parts.extend(columns[name][rs:re] for name in _row_columns)
+            data = zlib.compress(b''.join(np.ascontiguousarray(x).tobytes() for x in parts), 6)
+            f.write(data)
+            blocks[b] = [position, len(data), ps, pe, rs, re, columns['time_out'][ps], columns['time_out'][pe-1]]
+            row_block[rs:re] = b
+            position += len(data)
+    play_block = np.repeat(np.arange(len(starts)), blocks[:,_B_PLAY_END]-blocks[:,_B_PLAY_START])
+    arrays = OrderedDict(blocks=blocks)
+
+    # Players, sorted by badge ID so a lookup is a binary search of a memory-mapped array
+    player_strings = np.unique(columns['player_id'])
+    player_ids = np.array([strings[i] for i in player_strings], dtype=str)
+    order = np.argsort(player_ids, kind='stable')
+    rank = np.full(len(strings), -1, dtype=np.int64)
+    rank[player_strings[order]] = np.arange(len(order))
+    row_player = rank[columns['player_id']]
+    arrays['player_ids'] = player_ids[order]
+    arrays['player_strings'] = player_strings[order].astype(np.int32)
+    arrays['player_plays'] = np.bincount(row_player, minlength=len(order))
+    arrays['player_block_offsets'], arrays['player_blocks'] = _csr(row_player, row_block, len(order))
+
+    # Games
+    game_ids, first_play, play_game = np.unique(columns['game_id'], return_index=True, return_inverse=True)
+    row_game = np.repeat(play_game, np.diff(offsets))
+    game_players = _csr(row_game, row_player, len(game_ids))[0]
+    arrays['game_ids'] = game_ids
+    arrays['game_names'] = columns['game_name'][first_play]
+    arrays['game_plays'] = np.bincount(play_game, minlength=len(game_ids))
+    arrays['game_players'] = np.diff(game_players)
+    arrays['game_block_offsets'], arrays['game_blocks'] = _csr(play_game, play_block, len(game_ids))
+
+    # The games snapshot itself, with names added to the same string table
+    string_index = {s:i for i,s in enumerate(strings)}
+    for g in all_games:
+        string_index.setdefault(g.game_name, len(string_index))
+    strings = list(string_index)
+    arrays['copies_game_ids'] = np.array([g.game_id for g in all_games], dtype=np.int64)
+    arrays['copies_game_names'] = np.array([string_index[g.game_name] for g in all_games], dtype=np.int32)
+    arrays['copies_total'] = np.array([g.num_copies() for g in all_games], dtype=np.int64)
+    arrays['copies_winnable'] = np.array([sum(1 for c in g.copies if c.allow_winning) for g in all_games], dtype=np.int64)
+
+    for name,values in arrays.items():
+        np.save(os.path.join(out_dir, name+'.npy'), values)
+    with open(os.path.join(out_dir,'strings.json'),'w',encoding='utf-8') as f:
+        json.dump(strings, f, ensure_ascii=False)
+
+    meta = dict(format=_archive_format, version=_archive_version,
+                n_plays=n_plays, n_player_rows=n_rows, n_players=len(order), n_games=len(all_games),
+                n_blocks=len(starts), block_plays=block_plays,
+                time_min=int(columns['time_out'][0]) if n_plays else None,
+                time_max=int(columns['time_out'][-1]) if n_plays else None,
+                block_columns=OrderedDict((name,str(columns[name].dtype)) for name in _play_columns+['player_offsets']+_row_columns),
+                compressed_bytes=int(blocks[:,_B_LENGTH].sum()))
+    with open(os.path.join(out_dir,'meta.json'),'w') as f:
+        json.dump(meta, f, indent=3)
+    return meta
+
+class ArchiveSnapshot(object):
+    """One compacted snapshot. Arrays are memory-mapped on first use and blocks decompressed
+        on demand, keeping the last few in a small cache."""
+    def __init__(self, path, label, cache_blocks=8):
+        self.path = path
+        self.label = label
+        with open(os.path.join(path,'meta.json')) as f:
+            self.meta = json.load(f)
+        if self.meta.get('format')!=_archive_format or self.meta.get('version')!=_archive_version:
+            raise IOError(f"{path} is not a version {_archive_version} {_archive_format} snapshot")
+        self._arrays = dict()
+        self._strings = None
+        self._data = None
+        self._cache = OrderedDict()
+        self._cache_blocks = cache_blocks
+
+    def array(self, name):
+        if name not in self._arrays:
+            self._arrays[name] = np.load(os.path.join(self.path, name+'.npy'), mmap_mode='r')
+        return self._arrays[name]
+
+    def strings(self):
+        if self._strings is None:
+            with open(os.path.join(self.path,'strings.json'),encoding='utf-8') as f:
+                self._strings = json.load(f)
+        return self._strings
+
+    def _player_rank(self, player_id):
+        ids = self.array('player_ids')
+        i = int(np.searchsorted(ids, str(player_id)))
+        return i if i < len(ids) and ids[i]==str(player_id) else None
+
+    def _game_rank(self, game_id):
+        ids = self.array('game_ids')
+        i = int(np.searchsorted(ids, game_id))
+        return i if i < len(ids) and ids[i]==game_id else None
+
+    def player_plays(self, player_id):
+        """Plays this badge logged, from the index alone."""
+        i = self._player_rank(player_id)
+        return 0 if i is None else int(self.array('player_plays')[i])
+
+    def game_summary(self):
+        """(game_ids, game_names, plays, unique players) for every game played, from the index alone."""
+        strings = self.strings()
+        names = [strings[i] for i in self.array('game_names')]
+        return self.array('game_ids'), names, self.array('game_plays'), self.array('game_players')
+
+    def candidate_blocks(self, player_id=None, game_id=None, time_min=None, time_max=None):
+        """Blocks that can hold plays matching every filter that is set."""
+        blocks = self.array('blocks')
+        keep = np.ones(len(blocks), dtype=bool)
+        if time_min is not None:
+            keep &= blocks[:,_B_TIME_MAX] >= pnw._epoch_seconds(time_min)
+        if time_max is not None:
+            keep &= blocks[:,_B_TIME_MIN] < pnw._epoch_seconds(time_max)
+        for rank,prefix in [(self._player_rank(player_id) if player_id is not None else -1, 'player'),
+                            (self._game_rank(game_id) if game_id is not None else -1, 'game')]:
+            if rank is None:
+                return np.zeros(0, dtype=np.int64)
+            if rank >= 0:
+                offsets = self.array(prefix+'_block_offsets')
+                listed = np.zeros(len(blocks), dtype=bool)
+                listed[self.array(prefix+'_blocks')[offsets[rank]:offsets[rank+1]]] = True
+                keep &= listed
+        return np.flatnonzero(keep)
+
+    def block(self, b):
+        """Decompress block b as a ColumnarPlays object."""
+        if b in self._cache:
+            self._cache.move_to_end(b)
+            return self._cache[b]
+        if self._data is None:
+            with open(os.path.join(self.path,'blocks.bin'),'rb') as f:
+                self._data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        offset, length, ps, pe, rs, re = (int(x) for x in self.array('blocks')[b][:_B_TIME_MIN])
+        raw = zlib.decompress(self._data[offset:offset+length])
+        columns = dict()
+        position = 0
+        for name,dtype in self.meta['block_columns'].items():
+            n = (pe-ps+1) if name=='player_offsets' else (pe-ps) if name in _play_columns else (re-rs)
+            dtype = np.dtype(dtype)
+            columns[name] = np.frombuffer(raw, dtype=dtype, count=n, offset=position)
+            position += n*dtype.itemsize
+        plays = pnw.ColumnarPlays(columns, self.strings())
+        self._cache[b] = plays
+        if len(self._cache) > self._cache_blocks:
+            self._cache.popitem(last=False)
+        return plays
+
+    def plays(self, player_id=None, game_id=None, time_min=None, time_max=None):
+        """Yield GameCheckout objects matching every filter that is set (time_min <= check-out
+            time < time_max), decompressing only the blocks that can hold them."""
+        for b in self.candidate_blocks(player_id, game_id, time_min, time_max):
+            columnar = self.block(b)
+            keep = np.ones(columnar.num_plays(), dtype=bool)
+            if time_min is not None:
+                keep &= columnar.time_out >= pnw._epoch_seconds(time_min)
+            if time_max is not None:
+                keep &= columnar.time_out < pnw._epoch_seconds(time_max)
+            if game_id is not None:
+                keep &= columnar.game_id==game_id
+            if player_id is not None:
+                player_string = self.array('player_strings')[self._player_rank(player_id)]
+                rows = columnar.player_id==player_string
+                keep &= np.bincount(columnar.play_index()[rows], minlength=len(keep)) > 0
+            yield from columnar.to_plays(np.flatnonzero(keep))
+
+class Archive(object):
+    """A directory of compacted snapshots, listed in catalog.json in the order they were added."""
+    def __init__(self, path):
+        self.path = path
+        self._snapshots = dict()
+        catalog_fn = os.path.join(path,'catalog.json')
+        if os.path.exists(catalog_fn):
+            with open(catalog_fn) as f:
+                self.catalog = json.load(f)
+        else:
+            self.catalog = dict(format=_archive_format, version=_archive_version, snapshots=list())
+
+    def labels(self):
+        return [s['label'] for s in self.catalog['snapshots']]
+
+    def snapshot(self, label):
+        if label not in self._snapshots:
+            if label not in self.labels():
+                raise KeyError(f"No snapshot {label!r} in {self.path}")
+            self._snapshots[label] = ArchiveSnapshot(os.path.join(self.path,label), label)
+        return self._snapshots[label]
+
+    def add_snapshot(self, label, games_source, plays_source, block_plays=16384):
+        """Compact a games JSON and a plays JSON (or columnar directory) snapshot into the
+            archive under label (e.g. the year). Existing snapshots are never touched."""
+        if label in self.labels() or os.path.exists(os.path.join(self.path,label)):
+            raise ValueError(f"{label!r} is already in {self.path}; snapshots are append-only")
+        all_games = pnw.parse_games_json(games_source)
+        if os.path.isdir(plays_source):
+            all_plays = pnw.load_plays_columnar(plays_source).to_plays()
+        else:
+            all_plays = pnw.parse_plays_json(plays_source)
+        os.makedirs(self.path, exist_ok=True)
+        meta = _write_snapshot(os.path.join(self.path,label), all_games, all_plays, block_plays)
+
+        # the catalog is replaced in one step, so a failed add leaves only an unlisted directory
+        self.catalog['snapshots'].append(dict(label=label, games_source=games_source, plays_source=plays_source,
+                                              n_plays=meta['n_plays'], n_players=meta['n_players'],
+                                              added=datetime.now().isoformat(timespec='seconds')))
+        tmp_fn = os.path.join(self.path,'catalog.json.tmp')
+        with open(tmp_fn,'w') as f:
+            json.dump(self.catalog, f, indent=3)
+        os.replace(tmp_fn, os.path.join(self.path,'catalog.json'))
+        logger.info(f"Archived {meta['n_plays']} plays as {label!r}: {meta['n_blocks']} blocks, "+
+                    f"{meta['compressed_bytes']/1e6:.1f} MB compressed")
+        return self.snapshot(label)
+
+    def player_history(self, player_id):
+        """Plays logged by a badge in each snapshot, as an OrderedDict by label."""
+        return OrderedDict((label, self.snapshot(label).player_plays(player_id)) for label in self.labels())
+
+    def games_everyone_plays(self, limit=25):
+        """The games played by the largest share of each con's players, over every snapshot.
+            RETURNS: a list of (game_id, game_name, snapshots played in, players, share of players)
+        """
+        players = dict()
+        names = dict()
+        seen_in = dict()
+        total_players = 0
+        for label in self.labels():
+            snapshot = self.snapshot(label)
+            total_players += snapshot.meta['n_players']
+            for game_id,name,n_plays,n_players in zip(*snapshot.game_summary()):
+                game_id = int(game_id)
+                players[game_id] = players.get(game_id,0) + int(n_players)
+                seen_in[game_id] = seen_in.get(game_id,0) + 1
+                names[game_id] = name
+        ranked = sorted(players, key=lambda g: -players[g])[:limit]
+        return [(g, names[g], seen_in[g], players[g], players[g]/total_players if total_players else 0.0) for g in ranked]
+
+def main():
+    p = argparse.ArgumentParser(description='Play & Win multi-year archive')
+    sub = p.add_subparsers(dest='command', required=True)
+
+    a = sub.add_parser('add', help="compact a games and plays snapshot into the archive")
+    a.add_argument('archive', help="archive directory")
+    a.add_argument('label', help="name for this snapshot, e.g. the year")
+    a.add_argument('games_source', help="games JSON snapshot")
+    a.add_argument('plays_source', help="plays JSON snapshot, or a columnar snapshot directory")
+    a.add_argument('--block_plays', type=int, default=16384, help="plays per compressed block")
+
+    pl = sub.add_parser('player', help="plays a badge logged in each snapshot")
+    pl.add_argument('archive', help="archive directory")
+    pl.add_argument('player_id')
+
+    g = sub.add_parser('games', help="games played by the largest share of players, over every snapshot")
+    g.add_argument('archive', help="archive directory")
+    g.add_argument('--limit', type=int, default=25)
+
+    args = p.parse_args()
+    logging.basicConfig(level=logging.INFO, format='[%(levelname)10s] :\t %(message)s')
+
+    archive = Archive(args.archive)
+    if args.command=='add':
+        archive.add_snapshot(args.label, args.games_source, args.plays_source, args.block_plays)
+    elif args.command=='player':
+        history = archive.player_history(args.player_id)
+        for label,n in history.items():
+            print(f"{label}\t{n}")
+        print(f"total\t{sum(history.values())}")
+    elif args.command=='games':
+        print('\t'.join(['Game_ID','Game_Name','Snapshots','Players','Share_Of_Players']))
+        for game_id,name,n_snapshots,n_players,share in archive.games_everyone_plays(args.limit):
+            print(f"{game_id}\t{name}\t{n_snapshots}\t{n_players}\t{share:.3f}")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,173 @@
+"""Draw several collections in one run.
+
+    python pnw_batch.py output/2025 1/273/16 1/273/17 --method old_school --exclusive
+
+Authenticates once, fetches every collection's games and plays concurrently (one keep-alive
+connection per fetch thread), then runs pnw_picker.pick_all_winners for each collection in
+its own worker process. Each collection gets a directory under the output directory:
+
+    <out_dir>/<org>-<con>-<coll>/games.json, plays.json   the API snapshots
+    <out_dir>/<org>-<con>-<coll>/pnw.<stamp>.tsv, .pdf ... the usual picker output
+
+With --exclusive, a player can only win in one collection: the collections are drawn one after
+another in the order given, each treating the earlier winners as ineligible.
+"""
+import argparse
+import json
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+import http.client
+
+import pnw_api
+
+logger = logging.getLogger(__name__)
+
+class Collection(object):
+    """One org/con/collection to draw, and where its files go."""
+    def __init__(self, org, con, coll, out_dir):
+        self.org = org
+        self.con = con
+        self.coll = coll
+        self.label = f"{org}-{con}-{coll}"
+        self.out_dir = os.path.join(out_dir, self.label)
+        self.games_source = os.path.join(self.out_dir, 'games.json')
+        self.plays_source = os.path.join(self.out_dir, 'plays.json')
+
+    def sub_endpoint(self):
+        return pnw_api.collection_sub_endpoint(self.org, self.con, self.coll)
+
+def parse_collection(spec, out_dir):
+    """'1/273/16' -> Collection(1, 273, 16)"""
+    parts = spec.split('/')
+    if len(parts)!=3 or not all(x.isdigit() for x in parts):
+        raise ValueError(f"collection must look like org/con/coll, not {spec!r}")
+    org, con, coll = (int(x) for x in parts)
+    return Collection(org, con, coll, out_dir)
+
+def fetch_collections(collections, url, access_token, max_workers=8, cache=None, refresh_games=False):
+    """Download games and plays for every collection concurrently into its directory.
+        Each thread keeps one HTTPS connection open and reuses it for its requests. With a
+        pnw_api.HTTPCache, the games requests are conditional on the cached copies.
+    """
+    local = threading.local()
+
+    def fetch(collection, resource, out_fn):
+        if getattr(local, 'conn', None) is None:
+            local.conn = pnw_api.connect(url)
+        try:
+            payload = pnw_api.get_api_resource(access_token, resource, url, collection.sub_endpoint(), conn=local.conn,
+                                                cache=cache if resource=='games' else None, refresh=refresh_games)
+        except (http.client.HTTPException, OSError):
+            local.conn.close()
+            local.conn = None
+            raise
+        with open(out_fn,'w',newline='') as f:
+            json.dump(json.loads(payload),f,indent=3)
+        logger.info(f"...{collection.label} {resource} saved to {out_fn}")
+
+    jobs = list()
+    for c in collections:
+        os.makedirs(c.out_dir, exist_ok=True)
+        jobs.append((c,'games',c.games_source))
+        jobs.append((c,'plays',c.plays_source))
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(jobs))) as pool:
+        for future in [pool.submit(fetch, *job) for job in jobs]:
+            future.result()
+
+def _draw(collection, stamp, extra_ineligible_players, picker_args):
+    """Worker: one collection through parse, filter and draw, from its local snapshots."""
+    import pnw_picker   # sets up the picker's log files, so only where a draw actually runs
+    return pnw_picker.pick_all_winners(out_fn_prefix=os.path.join(collection.out_dir,'pnw'),
+                                        suffix=f"{stamp}.{collection.label}",
+                                        local_source=True,
+                                        all_plays_source=collection.plays_source,
+                                        all_game_copies_source=collection.games_source,
+                                        extra_ineligible_players=extra_ineligible_players,
+                                        **picker_args)
+
+def draw_collections(collections, picker_args, exclusive=False, max_workers=None, stamp=None):
+    """Draw every collection and return a list of Win lists, in the same order.
+
+    ARGUMENTS:
+        picker_args = keyword arguments for pnw_picker.pick_all_winners (ineligible_players_fn,
+                      pick_method, duration_min, duration_max, schedule, log_dir)
+        exclusive = if True, earlier collections' winners can't win later ones, so the draws
+                    run one at a time; otherwise they run in parallel processes
+    """
+    if stamp is None:
+        stamp = str(int(time.time()-1.5e9))
+    if exclusive or len(collections)==1:
+        all_wins = list()
+        winners = list()
+        for c in collections:
+            wins = _draw(c, stamp, list(winners) if exclusive else None, picker_args)
+            winners.extend(w.player for w in wins)
+            all_wins.append(wins)
+        return all_wins
+
+    with ProcessPoolExecutor(max_workers=max_workers) as pool:
+        futures = [pool.submit(_draw, c, stamp, None, picker_args) for c in collections]
+        return [f.result() for f in futures]
+
+def main():
+    p = argparse.ArgumentParser(description='Play & Win batch draw of several collections')
+    p.add_argument('out_dir', help="directory to hold one subdirectory per collection")
+    p.add_argument('collections', nargs='+', help="collections to draw, as org/con/coll (e.g. 1/273/16)")
+    p.add_argument('--local', action="store_true", dest="is_local", default=False,
+                    help="use the games.json and plays.json already in each collection's directory instead of the API")
+    p.add_argument('--url', default='library.geekway.com', help="API host")
+    p.add_argument('--ineligible_players_fn', default=None,
+                    help="a tsv file with ID,Player Name of all ineligible players (such as staff)")
+    p.add_argument('--method', choices=['standard', 'old_school', 'max_coverage'], default='old_school',
+                    help="standard (weighted by plays), old_school (choose play then player), or max_coverage")
+    p.add_argument('--duration_min', default=None, type=float,
+                    help="minimum duration (minutes) for a play to count")
+    p.add_argument('--duration_max', default=None, type=float,
+                    help="maximum duration (minutes) for a play to count")
+    p.add_argument('--playtimes_fn', default=None,
+                    help="bgg-playtimes.json: also bound each game's plays by its own BGG playing time")
+    p.add_argument('--playtime_scales', default=[0.5, 3.0], type=float, nargs=2, metavar=('MIN_SCALE','MAX_SCALE'),
+                    help="a play counts from MIN_SCALE x the BGG minimum time to MAX_SCALE x the maximum, default 0.5 3")
+    p.add_argument('--schedule', choices=['random', 'rarest_first'], default='random')
+    p.add_argument('--exclusive', action="store_true", default=False,
+                    help="a player can win in only one collection (draws run in the order given)")
+    p.add_argument('--refresh_games', action="store_true", default=False,
+                    help="download the games lists even if the local HTTP cache has current copies")
+    p.add_argument('--seed', default=None, type=int, help="seed for every draw, so reruns give the same winners")
+    p.add_argument('--no_cache', action="store_false", dest="use_cache", default=True,
+                    help="recompute every stage instead of reusing unchanged results from the stage cache")
+    p.add_argument('--workers', default=None, type=int, help="parallel draws (default: one per CPU)")
+    args = p.parse_args()
+    # not basicConfig: the picker's logger has its own console handler and would print twice
+    handler = logging.StreamHandler()
+    handler.setFormatter(logging.Formatter('[%(levelname)10s] :\t %(message)s'))
+    logger.addHandler(handler)
+    logger.setLevel(logging.INFO)
+
+    try:
+        collections = [parse_collection(spec, args.out_dir) for spec in args.collections]
+    except ValueError as err:
+        p.error(str(err))
+    if not args.is_local:
+        logger.info(f"Fetching {len(collections)} collections from {args.url}...")
+        access_token = json.loads(pnw_api.get_auth())['access_token']
+        fetch_collections(collections, args.url, access_token, cache=pnw_api.HTTPCache(), refresh_games=args.refresh_games)
+
+    picker_args = dict(ineligible_players_fn=args.ineligible_players_fn,
+                        pick_method=args.method,
+                        duration_min=args.duration_min*60.0 if args.duration_min is not None else None,
+                        duration_max=args.duration_max*60.0 if args.duration_max is not None else None,
+                        playtimes_fn=args.playtimes_fn,
+                        playtime_scales=args.playtime_scales,
+                        schedule=args.schedule,
+                        seed=args.seed,
+                        use_cache=args.use_cache)
+    all_wins = draw_collections(collections, picker_args, args.exclusive, args.workers)
+    for c,wins in zip(collections, all_wins):
+        logger.info(f"{c.label}: {len(wins)} copies awarded, output in {c.out_dir}")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,315 @@
+"""BoardGameGeek metadata (playing times, player counts) for library games, with a local cache.
+
+    BGG_TOKEN=... python pnw_bgg.py data/games.X.json bgg-playtimes.json
+
+Games are matched to BGG by library game ID (if resolved before) or by normalized name (pnw.normalize_name), through
+BGG's search API (an exact match first, then the first fuzzy result, like
+Random Scripts/hoarding-bgg-compare.js). Their records are then fetched with batched
+thing?id=1,2,... requests. Everything resolved goes in a JSON cache (data/bgg_cache.json), keyed
+by game ID, by normalized name and by BGG ID, for ttl seconds, so refreshing a catalogue only
+asks BGG about the titles it hasn't seen. Requests share a small pool of connections and are
+spaced interval seconds apart; BGG's 202 (request queued) and 429 (slow down) answers and
+dropped connections are retried with backoff.
+
+The output is the same bgg-playtimes.json the JS script writes, for the picker's --playtimes_fn.
+pnw_replay.BGGReplayServer serves recorded BGG XML, for running this offline.
+"""
+import argparse
+import http.client
+import json
+import logging
+import os
+import threading
+import time
+import xml.etree.ElementTree as ET
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import quote
+
+import pnw
+import pnw_api
+
+logger = logging.getLogger(__name__)
+
+default_url = 'boardgamegeek.com'
+default_prefix = '/xmlapi2'
+default_cache_fn = os.path.join('data','bgg_cache.json')
+
+class BGGGame(object):
+    """The BGG record of a game (times in minutes, None where BGG has nothing)."""
+    def __init__(self, bgg_id, name, year=None, min_players=None, max_players=None,
+                    playing_time=None, min_playtime=None, max_playtime=None):
+        self.bgg_id = bgg_id
+        self.name = name
+        self.year = year
+        self.min_players = min_players
+        self.max_players = max_players
+        self.playing_time = playing_time
+        self.min_playtime = min_playtime
+        self.max_playtime = max_playtime
+
+    def __json__(self):
+        return dict(self.__dict__)
+
+    @classmethod
+    def from_json(cls, record):
+        return cls(**record)
+
+def parse_things_xml(data):
+    """RETURNS: a BGGGame for every <item> of a thing?id=... response"""
+    def value(item, tag, convert=int):
+        el = item.find(tag)
+        if el is None or el.get('value') in (None, ''):
+            return None
+        return convert(el.get('value'))
+    games = list()
+    for item in ET.fromstring(data).iter('item'):
+        primary = item.find("name[@type='primary']")
+        # BGG reports an unknown time as 0
+        games.append(BGGGame(int(item.get('id')), primary.get('value') if primary is not None else None,
+                                year=value(item, 'yearpublished'),
+                                min_players=value(item, 'minplayers'), max_players=value(item, 'maxplayers'),
+                                playing_time=value(item, 'playingtime') or None,
+                                min_playtime=value(item, 'minplaytime') or None,
+                                max_playtime=value(item, 'maxplaytime') or None))
+    return games
+
+def parse_search_xml(data):
+    """RETURNS: the BGG IDs of the board games in a search response, in BGG's order"""
+    return [int(item.get('id')) for item in ET.fromstring(data).iter('item') if item.get('type')=='boardgame']
+
+class RateLimiter(object):
+    """Spaces calls to wait() at least interval seconds apart, across threads."""
+    def __init__(self, interval):
+        self.interval = interval
+        self._next = 0.0
+        self._lock = threading.Lock()
+
+    def wait(self):
+        with self._lock:
+            now = time.monotonic()
+            start = max(now, self._next)
+            self._next = start+self.interval
+        if start > now:
+            time.sleep(start-now)
+
+class BGGCache(object):
+    """BGG lookups kept in one JSON file:
+        - games: {library game ID: [BGG ID (None: not on BGG), time looked up]}
+        - names: {normalized name: [BGG ID (None: not on BGG), time looked up]}
+        - things: {BGG ID: [BGGGame record, time fetched]}
+    Entries older than ttl seconds are ignored, and dropped when the file is saved.
+    """
+    def __init__(self, cache_fn=default_cache_fn, ttl=30*24*3600):
+        self.cache_fn = cache_fn
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self.games, self.names, self.things = dict(), dict(), dict()
+        try:
+            with open(cache_fn, encoding='utf-8') as f:
+                saved = json.load(f)
+        except FileNotFoundError:
+            return
+        except ValueError as err:
+            logger.warning(f"Ignoring unreadable BGG cache {cache_fn}: {err!r}")
+            return
+        self.games = {int(k): v for k,v in saved.get('games',{}).items()}
+        self.names = dict(saved.get('names',{}))
+        self.things = {int(k): v for k,v in saved.get('things',{}).items()}
+
+    def _fresh(self, entry):
+        return entry is not None and time.time()-entry[1] < self.ttl
+
+    def bgg_id(self, game_id, name):
+        """RETURNS: (True, BGG ID or None) if the game, or another with the same normalized name,
+            was looked up within the ttl, otherwise (False, None)
+        """
+        with self._lock:
+            for entry in (self.games.get(game_id), self.names.get(pnw.normalize_name(name))):
+                if self._fresh(entry):
+                    return True, entry[0]
+        return False, None
+
+    def thing(self, bgg_id):
+        """RETURNS: the cached BGGGame, or None if it isn't cached or is too old"""
+        with self._lock:
+            entry = self.things.get(bgg_id)
+            return BGGGame.from_json(entry[0]) if self._fresh(entry) else None
+
+    def set_bgg_id(self, game_id, name, bgg_id):
+        with self._lock:
+            self.games[game_id] = [bgg_id, time.time()]
+            self.names[pnw.normalize_name(name)] = [bgg_id, time.time()]
+
+    def set_thing(self, record):
+        with self._lock:
+            self.things[record.bgg_id] = [record.__json__(), time.time()]
+
+    def save(self):
+        with self._lock:
+            saved = {table: {str(k): v for k,v in entries.items() if self._fresh(v)}
+                     for table,entries in (('games',self.games), ('names',self.names), ('things',self.things))}
+        if os.path.dirname(self.cache_fn):
+            os.makedirs(os.path.dirname(self.cache_fn), exist_ok=True)
+        tmp_fn = f"{self.cache_fn}.{os.getpid()}.tmp"
+        with open(tmp_fn,'w',encoding='utf-8') as f:
+            json.dump(saved, f)
+        os.replace(tmp_fn, self.cache_fn)
+
+class BGGClient(object):
+    """BGG XML API requests over at most max_workers connections, interval seconds apart.
+        Counts the requests it sends by kind ('search', 'thing') in self.requests.
+    """
+    def __init__(self, url=default_url, prefix=default_prefix, token=None, max_workers=4, interval=1.0,
+                    batch_size=20, retries=5, retry_wait=2.0, cache=None):
+        """url is a host name (HTTPS) or http://host:port (a local stand-in), as for pnw_api.connect.
+            token defaults to $BGG_TOKEN (a BGG application's bearer token). A 202 (queued) is asked again
+            after retry_wait seconds, a 429 or 5xx after 2.5 times that, doubling with each attempt.
+        """
+        self.url = url
+        self.prefix = prefix
+        self.token = token if token is not None else os.environ.get('BGG_TOKEN')
+        self.max_workers = max_workers
+        self.limiter = RateLimiter(interval)
+        self.batch_size = batch_size
+        self.retries = retries
+        self.retry_wait = retry_wait
+        self.cache = cache if cache is not None else BGGCache()
+        self.requests = Counter()
+        self._counts_lock = threading.Lock()
+        self._local = threading.local()
+
+    def _get(self, kind, path):
+        headers = {'Authorization': 'Bearer '+self.token} if self.token else {}
+        for attempt in range(self.retries+1):
+            if getattr(self._local, 'conn', None) is None:
+                self._local.conn = pnw_api.connect(self.url)
+            self.limiter.wait()
+            with self._counts_lock:
+                self.requests[kind] += 1
+            try:
+                self._local.conn.request('GET', self.prefix+path, headers=headers)
+                res = self._local.conn.getresponse()
+                data = res.read()
+            except (http.client.HTTPException, OSError) as err:
+                self._local.conn.close()
+                self._local.conn = None
+                if attempt == self.retries:
+                    raise
+                time.sleep(0.25*self.retry_wait*2**attempt)
+                continue
+            if res.status == 200:
+                return data
+            if res.status not in (202, 429) and res.status < 500 or attempt == self.retries:
+                raise pnw_api.APIError(res.status, res.reason)
+            # 202: BGG queued the request, ask again; 429 or 5xx: back off
+            time.sleep((1.0 if res.status == 202 else 2.5)*self.retry_wait*2**min(attempt, 3))
+
+    def search(self, name):
+        """RETURNS: the BGG ID of an exact name match, else of the first fuzzy match, else None"""
+        for exact in ('&exact=1', ''):
+            ids = parse_search_xml(self._get('search', f"/search?query={quote(name)}&type=boardgame{exact}"))
+            if ids:
+                return ids[0]
+        return None
+
+    def things(self, bgg_ids):
+        """RETURNS: a BGGGame for each of bgg_ids that BGG knows, from one request"""
+        return parse_things_xml(self._get('thing', "/thing?id="+",".join(str(i) for i in bgg_ids)))
+
+    def resolve(self, games, refresh=False):
+        """Find the BGG record of every pnw.Game, and set it as game.bgg (None if not found).
+            Only games (and BGG IDs) that aren't in the cache, or all of them with refresh, cost
+            requests: searches run concurrently, and records are fetched batch_size at a time.
+            RETURNS: a dict of BGGGame (or None) by game ID
+        """
+        bgg_ids = dict()
+        to_search = list()
+        for game in games:
+            found, bgg_id = (False, None) if refresh else self.cache.bgg_id(game.game_id, game.game_name)
+            if found:
+                bgg_ids[game.game_id] = bgg_id
+            else:
+                to_search.append(game)
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+            def search(game):
+                try:
+                    bgg_id = self.search(game.game_name)
+                except (IOError, http.client.HTTPException, ET.ParseError) as err:
+                    logger.warning(f"BGG search failed for {game.game_name} (game {game.game_id}): {err!r}")
+                    return None
+                self.cache.set_bgg_id(game.game_id, game.game_name, bgg_id)
+                return bgg_id
+            if to_search:
+                logger.info(f"Searching BGG for {len(to_search)} of {len(games)} games...")
+            for game,bgg_id in zip(to_search, pool.map(search, to_search)):
+                bgg_ids[game.game_id] = bgg_id
+
+            records = dict()
+            to_fetch = list()
+            for bgg_id in sorted(set(i for i in bgg_ids.values() if i is not None)):
+                record = None if refresh else self.cache.thing(bgg_id)
+                if record is not None:
+                    records[bgg_id] = record
+                else:
+                    to_fetch.append(bgg_id)
+            batches = [to_fetch[i:i+self.batch_size] for i in range(0, len(to_fetch), self.batch_size)]
+            def fetch(batch):
+                try:
+                    return self.things(batch)
+                except (IOError, http.client.HTTPException, ET.ParseError) as err:
+                    logger.warning(f"BGG records failed for {batch}: {err!r}")
+                    return list()
+            if batches:
+                logger.info(f"Fetching {len(to_fetch)} BGG records in {len(batches)} requests...")
+            for batch_records in pool.map(fetch, batches):
+                for record in batch_records:
+                    self.cache.set_thing(record)
+                    records[record.bgg_id] = record
+        self.cache.save()
+
+        resolved = dict()
+        for game in games:
+            game.bgg = records.get(bgg_ids.get(game.game_id))
+            resolved[game.game_id] = game.bgg
+        return resolved
+
+def output_playtimes_json(games, out_fn):
+    """Write resolved games (game.bgg set by BGGClient.resolve) as bgg-playtimes.json:
+        [{gameId, name, bggId, minTime, maxTime}], the format of Random Scripts/hoarding-bgg-compare.js
+    """
+    rows = list()
+    for game in games:
+        bgg = getattr(game, 'bgg', None)
+        rows.append(dict(gameId=game.game_id, name=game.game_name,
+                         bggId=bgg.bgg_id if bgg is not None else None,
+                         minTime=bgg.min_playtime if bgg is not None else None,
+                         maxTime=bgg.max_playtime if bgg is not None else None))
+    with open(out_fn,'w',encoding='utf-8') as f:
+        json.dump(rows, f, indent=2, ensure_ascii=False)
+
+def main():
+    p = argparse.ArgumentParser(description='Play & Win BGG playing times')
+    p.add_argument('games_source', help="games JSON snapshot (api/games)")
+    p.add_argument('out_fn', help="bgg-playtimes.json to write")
+    p.add_argument('--url', default=default_url, help="BGG host, or http://host:port for pnw_replay.py serve-bgg")
+    p.add_argument('--cache_fn', default=default_cache_fn)
+    p.add_argument('--ttl_days', default=30.0, type=float, help="how long cached lookups are trusted, default=30")
+    p.add_argument('--refresh', action="store_true", default=False, help="look every game up again, ignoring the cache")
+    p.add_argument('--workers', default=4, type=int, help="concurrent connections, default=4")
+    p.add_argument('--interval', default=1.0, type=float, help="seconds between requests, default=1")
+    p.add_argument('--batch_size', default=20, type=int, help="BGG IDs per thing request, default=20")
+    args = p.parse_args()
+    logging.basicConfig(level=logging.INFO, format='[%(levelname)10s] :\t %(message)s')
+
+    games = pnw.parse_games_json(args.games_source)
+    client = BGGClient(args.url, max_workers=args.workers, interval=args.interval, batch_size=args.batch_size,
+                        cache=BGGCache(args.cache_fn, ttl=args.ttl_days*24*3600))
+    resolved = client.resolve(games, refresh=args.refresh)
+    output_playtimes_json(games, args.out_fn)
+    logger.info(f"{sum(r is not None for r in resolved.values())} of {len(games)} games found on BGG "+
+                f"({client.requests['search']} searches, {client.requests['thing']} record requests), written to {args.out_fn}")
+
+if __name__ == '__main__':
+    main()
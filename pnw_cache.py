@@ -0,0 +1,169 @@
+"""Content-addressed cache of pipeline stage results, so a rerun only repeats the stages whose
+inputs or options changed.
+
+Each stage's key is a hash of its name, the code that computes it, its input files' contents,
+its parameters, and the keys of the stages it reads from. A change anywhere upstream therefore
+changes every key downstream, and nothing else. Results are pickled to <cache_dir>/<key>.pickle.
+A hit refreshes the file's mtime, and the least recently used entries are evicted once the cache
+holds more than max_bytes.
+
+Stages whose outputs are files rather than values (e.g. the picker's log/*.tsv dumps) record which
+files they wrote under their key (record_outputs); an unchanged stage copies those files to its
+new output names instead of running again (reuse_outputs).
+"""
+import hashlib
+import json
+import logging
+import os
+import pickle
+import shutil
+import threading
+
+logger = logging.getLogger(__name__)
+
+default_cache_dir = os.path.join('data','stage_cache')
+
+def file_digest(fn):
+    """sha256 of a file's contents (so a re-downloaded but unchanged snapshot hashes the same)."""
+    h = hashlib.sha256()
+    with open(fn,'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            h.update(block)
+    return h.hexdigest()
+
+def code_digest(*modules):
+    """sha256 of the modules' source files, so results computed by older code are never reused."""
+    h = hashlib.sha256()
+    for module in modules:
+        with open(module.__file__,'rb') as f:
+            h.update(f.read())
+    return h.hexdigest()
+
+class StageCache(object):
+    """Pickled stage results keyed by their inputs. See run()."""
+    def __init__(self, cache_dir=default_cache_dir, max_bytes=2*2**30, salt=''):
+        """salt is mixed into every key, e.g. a code_digest of the modules the stages run."""
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.salt = salt
+        self.hits = list()
+        self.misses = list()
+        self._lock = threading.Lock()
+
+    def key(self, stage, *parts):
+        """The key for a stage: parts can be anything json can encode (file digests, parameters, upstream keys)."""
+        blob = json.dumps([self.salt, stage, parts], sort_keys=True, default=str)
+        return hashlib.sha256(blob.encode('utf-8')).hexdigest()
+
+    def _fn(self, key):
+        return os.path.join(self.cache_dir, key+'.pickle')
+
+    def get(self, key):
+        """RETURNS: (True, value) on a hit, (False, None) on a miss"""
+        fn = self._fn(key)
+        try:
+            with open(fn,'rb') as f:
+                value = pickle.load(f)
+        except FileNotFoundError:
+            return False, None
+        except (OSError, pickle.UnpicklingError, EOFError, AttributeError, ImportError) as err:
+            logger.warning(f"Ignoring unreadable stage cache entry {fn}: {err!r}")
+            return False, None
+        try:
+            os.utime(fn)   # most recently used
+        except OSError:
+            pass
+        return True, value
+
+    def put(self, key, value):
+        os.makedirs(self.cache_dir, exist_ok=True)
+        fn = self._fn(key)
+        tmp_fn = f"{fn}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_fn,'wb') as f:
+            pickle.dump(value, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_fn, fn)
+        self.evict()
+
+    def run(self, stage, parts, compute):
+        """Return the cached result of a stage if one matches its key, otherwise compute() it and
+            store the result (before the caller can modify it).
+            RETURNS: (result, key, whether it was a cache hit); pass the key on as a part of
+                     downstream stages' keys
+        """
+        key = self.key(stage, *parts)
+        hit, value = self.get(key)
+        if hit:
+            self.hits.append(stage)
+            return value, key, True
+        self.misses.append(stage)
+        value = compute()
+        self.put(key, value)
+        return value, key, False
+
+    def _manifest_fn(self):
+        return os.path.join(self.cache_dir, 'outputs.json')
+
+    def _read_manifest(self):
+        try:
+            with open(self._manifest_fn()) as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            return dict()
+
+    @staticmethod
+    def _stamp(fn):
+        st = os.stat(fn)
+        return [os.path.abspath(fn), st.st_size, st.st_mtime_ns]
+
+    def reuse_outputs(self, key, fns):
+        """If a stage with this key already wrote its files, and they haven't been touched since,
+            copy them to fns (in the same order).
+            RETURNS: True if the files were copied, False if the stage needs to run
+        """
+        written = self._read_manifest().get(key)
+        if written is None or len(written) != len(fns):
+            return False
+        try:
+            if any(self._stamp(stamp[0]) != stamp for stamp in written):
+                return False
+            for stamp,fn in zip(written, fns):
+                if os.path.abspath(fn) != stamp[0]:
+                    shutil.copyfile(stamp[0], fn)
+        except OSError:
+            return False
+        return True
+
+    def record_outputs(self, key, fns):
+        """Note that a stage with this key just wrote fns (see reuse_outputs)."""
+        with self._lock:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            manifest = self._read_manifest()
+            manifest[key] = [self._stamp(fn) for fn in fns]
+            # forget stages whose files are gone
+            manifest = {k: stamps for k,stamps in manifest.items() if all(os.path.exists(stamp[0]) for stamp in stamps)}
+            tmp_fn = f"{self._manifest_fn()}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(tmp_fn,'w') as f:
+                json.dump(manifest, f)
+            os.replace(tmp_fn, self._manifest_fn())
+
+    def evict(self):
+        """Remove the least recently used entries until the cache fits in max_bytes."""
+        with self._lock:
+            entries = list()
+            for fn in os.listdir(self.cache_dir):
+                if not fn.endswith('.pickle'):
+                    continue
+                try:
+                    st = os.stat(os.path.join(self.cache_dir, fn))
+                except FileNotFoundError:
+                    continue
+                entries.append((st.st_mtime, st.st_size, fn))
+            total = sum(size for mtime,size,fn in entries)
+            for mtime,size,fn in sorted(entries):
+                if total <= self.max_bytes:
+                    break
+                try:
+                    os.remove(os.path.join(self.cache_dir, fn))
+                except FileNotFoundError:
+                    pass
+                total -= size
@@ -0,0 +1,330 @@
+"""Prize-desk lookup service: what did a badge play, did it count, and what did they win?
+
+Loads a games snapshot, a plays snapshot (JSON or a columnar directory) and the latest winners
+TSV once, builds in-memory indexes by badge ID, by name prefix and by copy ID, and serves them
+as JSON on a local port. Source files are polled and the indexes rebuilt and swapped in when
+any of them change, so a re-draw shows up without restarting.
+
+    python pnw_desk.py games.json plays.json 'output/pnw.*.tsv' --ineligible_players_fn staff.tsv
+
+    GET /badge/1234         plays, why each did or didn't count, eligibility and wins
+    GET /name?prefix=smi    badges whose first, middle or last name starts with the prefix
+    GET /copy/123A          the game, its winner and its checkouts
+    GET /status             the files currently loaded
+"""
+import argparse
+import bisect
+import glob
+import json
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict, defaultdict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qs, unquote
+
+import pnw
+
+logger = logging.getLogger(__name__)
+
+def _json_bytes(obj):
+    return json.dumps(obj, ensure_ascii=False).encode('utf-8')
+
+class DeskIndex(object):
+    """Prebuilt answers for the prize desk.
+        Contains:
+            - badges: JSON bytes per player_id
+            - copies: JSON bytes per copy_id
+            - names: sorted (lowercase name or trailing part of it, player_id) pairs for prefix search
+            - player_names: name per player_id
+            - sources: the files the index was built from
+
+        Every per-badge and per-copy answer is serialized when the index is built, so a lookup
+        is one dict access. A name search is a bisect into the sorted names.
+    """
+    def __init__(self, all_games, all_plays, wins, ineligible_players=None,
+                    duration_min=None, duration_max=None, playtimes=None, sources=None):
+        """Input: all_games from parse_games_json (every copy, winnable or not), all_plays
+            from parse_plays_json, wins from parse_winners_tsv, ineligible_players from
+            parse_ineligible_players, and the duration bounds (seconds) and per-game bounds
+            (a pnw.GamePlaytimes, or None) used for the draw.
+        """
+        self.sources = sources if sources is not None else dict()
+        ineligible_ids = set(p.player_id for p in ineligible_players) if ineligible_players is not None else set()
+
+        # Same filtering as the draw, remembering why each removed play was removed
+        all_pnw_titles_by_id = OrderedDict([(g.game_id,g) for g in pnw.filter_library_games(all_games)])
+        filtered_plays, removed_plays = pnw.filter_plays(all_plays, all_pnw_titles_by_id, duration_min, duration_max, playtimes)
+        removed_reason = dict()
+        for reason,plays in removed_plays.items():
+            for play in plays:
+                removed_reason[play.checkout_id] = reason
+
+        player_names = dict()
+        plays_by_player = defaultdict(list)
+        checkouts_by_copy = defaultdict(list)
+        for play in all_plays:
+            play_reason = removed_reason.get(play.checkout_id)
+            for p in play.players:
+                player_names.setdefault(p.player_id, p.player_name)
+                if play_reason is not None:
+                    reason = play_reason
+                elif p.wants_to_win!=True:
+                    reason = 'not_wants_to_win'
+                else:
+                    reason = 'counted'
+                plays_by_player[p.player_id].append(dict(
+                        checkout_id=play.checkout_id, game_id=play.game.game_id, game_name=play.game.game_name,
+                        copy_id=play.copy_id, time_out=play.time_out.isoformat(), time_in=play.time_in.isoformat(),
+                        minutes=round(play.duration/60.0,1), reason=reason))
+            if play.copy_id is not None:
+                checkouts_by_copy[play.copy_id].append(dict(
+                        checkout_id=play.checkout_id, time_out=play.time_out.isoformat(),
+                        minutes=round(play.duration/60.0,1), reason=play_reason or 'counted',
+                        players=[dict(player_id=p.player_id, player_name=p.player_name) for p in play.players]))
+
+        wins_by_player = defaultdict(list)
+        win_by_copy = dict()
+        for w in wins:
+            player_names.setdefault(w.player.player_id, w.player.player_name)
+            win = dict(game_id=w.game.game_id, game_name=w.game.game_name, copy_id=w.copy_id,
+                        player_id=w.player.player_id, player_name=w.player.player_name,
+                        n_plays=w.n_plays, notes=w.notes)
+            wins_by_player[w.player.player_id].append(win)
+            win_by_copy[w.copy_id] = win
+        if ineligible_players is not None:
+            for p in ineligible_players:
+                player_names.setdefault(p.player_id, p.player_name)
+
+        self.badges = dict()
+        for player_id,player_name in player_names.items():
+            plays = plays_by_player.get(player_id, list())
+            n_counted = sum(1 for play in plays if play['reason']=='counted')
+            if player_id in ineligible_ids:
+                eligibility = 'ineligible'
+            elif n_counted > 0:
+                eligibility = 'eligible'
+            else:
+                eligibility = 'no_counted_plays'
+            self.badges[player_id] = _json_bytes(dict(
+                    player_id=player_id, player_name=player_name, eligibility=eligibility,
+                    n_plays=len(plays), n_counted_plays=n_counted, plays=plays,
+                    wins=wins_by_player.get(player_id, list())))
+
+        self.copies = dict()
+        for game in all_games:
+            for c in game.copies:
+                self.copies[c.copy_id] = _json_bytes(dict(
+                        copy_id=c.copy_id, game_id=game.game_id, game_name=game.game_name,
+                        winnable=c.allow_winning, win=win_by_copy.get(c.copy_id),
+                        checkouts=checkouts_by_copy.get(c.copy_id, list())))
+
+        # "jane q smith" is found by "jane", "q s" and "smi"
+        names = set()
+        for player_id,player_name in player_names.items():
+            words = (player_name or '').lower().split()
+            for i in range(len(words)):
+                names.add((' '.join(words[i:]), player_id))
+        self.names = sorted(names)
+        self.player_names = player_names
+
+    def badge(self, player_id):
+        """JSON bytes for a badge, or None if it never played, won or was listed as ineligible."""
+        return self.badges.get(str(player_id))
+
+    def copy(self, copy_id):
+        """JSON bytes for a copy, or None if it isn't in the games snapshot."""
+        return self.copies.get(copy_id)
+
+    def name_search(self, prefix, limit=25):
+        """Up to limit (player_id, player_name) pairs with a name part starting with prefix."""
+        prefix = ' '.join(prefix.lower().split())
+        found = OrderedDict()
+        if not prefix:
+            return list()
+        i = bisect.bisect_left(self.names, (prefix,))
+        while i < len(self.names) and len(found) < limit and self.names[i][0].startswith(prefix):
+            player_id = self.names[i][1]
+            found[player_id] = self.player_names[player_id]
+            i += 1
+        return list(found.items())
+
+def _latest(pattern):
+    """The most recently modified file matching a glob pattern, or None. The unawarded plays
+        TSVs written next to each winners TSV (<prefix>.<suffix>.unawarded.tsv) are skipped."""
+    matches = [fn for fn in glob.glob(pattern) if not fn.endswith('.unawarded.tsv')]
+    if not matches:
+        return None
+    return max(matches, key=os.path.getmtime)
+
+def _signature(path):
+    """What to compare to spot a changed file (for a columnar directory, its meta.json,
+        which output_plays_columnar writes last)."""
+    if path is None:
+        return None
+    if os.path.isdir(path):
+        path = os.path.join(path,'meta.json')
+    st = os.stat(path)
+    return (path, st.st_mtime_ns, st.st_size)
+
+class DeskSources(object):
+    """The files the desk serves from. winners_pattern may be a glob, such as 'output/pnw.*.tsv',
+        in which case the newest winners TSV it matches is used. playtimes_fn and playtime_scales are the draw's
+        BGG playing times (see pnw.GamePlaytimes.from_json)."""
+    def __init__(self, games_source, plays_source, winners_pattern, ineligible_players_fn=None,
+                    duration_min=None, duration_max=None, playtimes_fn=None, playtime_scales=(0.5, 3.0)):
+        self.games_source = games_source
+        self.plays_source = plays_source
+        self.winners_pattern = winners_pattern
+        self.ineligible_players_fn = ineligible_players_fn
+        self.duration_min = duration_min
+        self.duration_max = duration_max
+        self.playtimes_fn = playtimes_fn
+        self.playtime_scales = playtime_scales
+
+    def resolve(self):
+        """Current file per source, and a signature that changes when any of them do."""
+        files = OrderedDict([('games',self.games_source), ('plays',self.plays_source),
+                             ('winners',_latest(self.winners_pattern)),
+                             ('ineligible_players',self.ineligible_players_fn),
+                             ('playtimes',self.playtimes_fn)])
+        return files, tuple(_signature(fn) for fn in files.values())
+
+    def load(self, files):
+        """Parse the sources and build a DeskIndex."""
+        all_games = pnw.parse_games_json(files['games'])
+        if os.path.isdir(files['plays']):
+            all_plays = pnw.load_plays_columnar(files['plays']).to_plays()
+        else:
+            all_plays = pnw.parse_plays_json(files['plays'])
+        wins = pnw.parse_winners_tsv(files['winners']) if files['winners'] is not None else list()
+        ineligible_players = None
+        if files['ineligible_players'] is not None:
+            ineligible_players = pnw.parse_ineligible_players(files['ineligible_players'])
+        playtimes = None
+        if files['playtimes'] is not None:
+            playtimes = pnw.GamePlaytimes.from_json(files['playtimes'], *self.playtime_scales)
+        return DeskIndex(all_games, all_plays, wins, ineligible_players,
+                            self.duration_min, self.duration_max, playtimes, sources=files)
+
+class DeskServer(ThreadingHTTPServer):
+    """Serves whichever DeskIndex is current; reload() swaps in a new one between requests."""
+    daemon_threads = True
+
+    def __init__(self, address, sources):
+        self.sources = sources
+        self.signature = None
+        self.index = None
+        self.reload()
+        super().__init__(address, DeskRequestHandler)
+
+    def reload(self):
+        """Rebuild the index if any source changed. A failed rebuild (say, a winners file that
+            is still being written) keeps the old index and is retried on the next poll."""
+        try:
+            files, signature = self.sources.resolve()
+            if signature==self.signature:
+                return False
+            start = time.time()
+            index = self.sources.load(files)
+        except (OSError, ValueError, KeyError) as err:
+            if self.index is None:
+                raise
+            logger.warning(f"Reload failed, still serving the previous results: {err!r}")
+            return False
+        self.index = index
+        self.signature = signature
+        logger.info(f"Loaded {len(index.badges)} badges and {len(index.copies)} copies in "+
+                    f"{time.time()-start:.2f}s from {', '.join(str(fn) for fn in files.values() if fn is not None)}")
+        return True
+
+    def watch(self, interval=2.0):
+        """Poll the sources every interval seconds, in a daemon thread."""
+        def poll():
+            while True:
+                time.sleep(interval)
+                self.reload()
+        t = threading.Thread(target=poll, name='pnw-desk-reload', daemon=True)
+        t.start()
+        return t
+
+class DeskRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'   # keep-alive, so a desk terminal doesn't reconnect per lookup
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        parts = [unquote(s) for s in url.path.split('/') if s]
+        index = self.server.index   # one index for the whole request, even mid-reload
+
+        if len(parts)==2 and parts[0]=='badge':
+            self._reply(index.badge(parts[1]), f"badge {parts[1]} not found")
+        elif len(parts)==2 and parts[0]=='copy':
+            self._reply(index.copy(parts[1]), f"copy {parts[1]} not found")
+        elif parts==['name']:
+            query = parse_qs(url.query)
+            prefix = query.get('prefix', [''])[0]
+            limit = query.get('limit', ['25'])[0]
+            if not limit.isdigit():
+                self._reply(None, f"limit must be a whole number, not {limit!r}", status=400)
+                return
+            matches = index.name_search(prefix, int(limit))
+            self._reply(_json_bytes([dict(player_id=i, player_name=n) for i,n in matches]))
+        elif parts==['status']:
+            self._reply(_json_bytes(dict(sources=index.sources, badges=len(index.badges), copies=len(index.copies))))
+        else:
+            self._reply(None, "use /badge/<id>, /name?prefix=<text>, /copy/<id> or /status")
+
+    def _reply(self, body, error=None, status=404):
+        """Send body as JSON, or if it is None, a JSON error with the status (not found by default)."""
+        if body is None:
+            self.send_response(status)
+            body = _json_bytes(dict(error=error))
+        else:
+            self.send_response(200)
+        self.send_header('Content-Type','application/json; charset=utf-8')
+        self.send_header('Content-Length',str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logger.debug(format % args)
+
+def main():
+    p = argparse.ArgumentParser(description='Play & Win prize desk lookup service')
+    p.add_argument('games_source', help="games JSON snapshot")
+    p.add_argument('plays_source', help="plays JSON snapshot, or a columnar snapshot directory")
+    p.add_argument('winners', help="winners TSV, or a quoted glob such as 'output/pnw.*.tsv' to always use the newest")
+    p.add_argument('--ineligible_players_fn', default=None,
+                    help="a tsv file with ID,Player Name of all ineligible players (such as staff)")
+    p.add_argument('--duration_min', default=None, type=float,
+                    help="minimum duration (minutes) for a play to count, as used for the draw")
+    p.add_argument('--duration_max', default=None, type=float,
+                    help="maximum duration (minutes) for a play to count, as used for the draw")
+    p.add_argument('--playtimes_fn', default=None,
+                    help="bgg-playtimes.json, if the draw also bounded each game's plays by its own BGG playing time")
+    p.add_argument('--playtime_scales', default=[0.5, 3.0], type=float, nargs=2, metavar=('MIN_SCALE','MAX_SCALE'),
+                    help="a play counts from MIN_SCALE x the BGG minimum time to MAX_SCALE x the maximum, default 0.5 3")
+    p.add_argument('--host', default='127.0.0.1')
+    p.add_argument('--port', default=8321, type=int)
+    p.add_argument('--poll', default=2.0, type=float, help="seconds between checks for changed sources")
+    args = p.parse_args()
+    logging.basicConfig(level=logging.INFO, format='[%(levelname)10s] :\t %(message)s')
+
+    duration_min = args.duration_min*60.0 if args.duration_min is not None else None
+    duration_max = args.duration_max*60.0 if args.duration_max is not None else None
+    sources = DeskSources(args.games_source, args.plays_source, args.winners,
+                            args.ineligible_players_fn, duration_min, duration_max,
+                            args.playtimes_fn, args.playtime_scales)
+    server = DeskServer((args.host, args.port), sources)
+    server.watch(args.poll)
+    logger.info(f"Prize desk listening on http://{args.host}:{args.port}/")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+if __name__ == '__main__':
+    main()
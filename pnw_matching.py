@@ -0,0 +1,192 @@
+"""The max_coverage pick method: award as many copies as is possible at all, one per player.
+
+Copies and distinct eligible players form a bipartite graph (a copy is joined to everyone
+eligible for its game; the copies of a game share one vertex with a capacity). A weighted
+random draw is made first, then Hopcroft-Karp augmenting paths grow it into a maximum
+matching, so a copy only goes unawarded if no assignment at all could have given it away.
+"""
+import logging
+import random
+from collections import OrderedDict, deque
+
+import pnw
+
+logger = logging.getLogger(__name__)
+
+def hopcroft_karp(adj, n_right, capacity=None, match_left=None, match_right=None):
+    """Maximum bipartite matching, where left vertex u may be matched to up to capacity[u]
+        right vertices (so all the copies of a game can be one left vertex).
+
+    ARGUMENTS:
+        adj = a list, per left vertex, of the right vertices (0..n_right-1) it may be matched to
+        capacity = a list of capacities per left vertex (default 1 each)
+        match_left, match_right = an optional starting matching to extend in place: a list of
+              matched right vertices per left vertex, and the left vertex per right vertex (-1
+              for unmatched). Every right vertex matched at the start stays matched.
+
+    RETURNS:
+        (match_left, match_right)
+
+    Each phase finds the shortest augmenting paths by BFS from the left vertices with capacity
+    to spare, then augments along them by DFS (iterative, so long paths can't hit the recursion
+    limit). O(E sqrt(V)).
+    """
+    n_left = len(adj)
+    if capacity is None:
+        capacity = [1]*n_left
+    if match_left is None:
+        match_left = [list() for u in range(n_left)]
+    if match_right is None:
+        match_right = [-1]*n_right
+    unreached = n_left+1
+
+    while True:
+        # BFS: layer the left vertices by alternating-path distance from one with room to spare
+        dist = [unreached]*n_left
+        queue = deque()
+        for u in range(n_left):
+            if len(match_left[u]) < capacity[u]:
+                dist[u] = 0
+                queue.append(u)
+        found = False
+        while queue:
+            u = queue.popleft()
+            for v in adj[u]:
+                w = match_right[v]
+                if w==-1:
+                    found = True
+                elif dist[w]==unreached:
+                    dist[w] = dist[u]+1
+                    queue.append(w)
+        if not found:
+            return match_left, match_right
+
+        # DFS: augment along shortest paths until each root is full or stuck
+        next_edge = [0]*n_left
+        for root in range(n_left):
+            while dist[root]==0 and len(match_left[root]) < capacity[root]:
+                stack = [root]
+                via = list()
+                while stack:
+                    u = stack[-1]
+                    if next_edge[u] < len(adj[u]):
+                        v = adj[u][next_edge[u]]
+                        next_edge[u] += 1
+                        w = match_right[v]
+                        if w==-1:
+                            break
+                        elif dist[w]==dist[u]+1:
+                            stack.append(w)
+                            via.append(v)
+                    else:
+                        dist[u] = unreached     # dead end for the rest of this phase
+                        stack.pop()
+                        if via:
+                            via.pop()
+                if not stack:
+                    break
+                # flip the path: each u on the stack takes the next right vertex along it,
+                # and gives up the one it was reached through
+                via.append(v)
+                for i,u in enumerate(stack):
+                    if i > 0:
+                        match_left[u].remove(via[i-1])
+                    match_left[u].append(via[i])
+                    match_right[via[i]] = u
+
+def max_coverage_winners(all_pnw_titles_by_id, all_awardable_plays_by_game, problem_plays, ineligible_players=None):
+    """Select the winners of every game at once, awarding the most copies possible.
+
+    ARGUMENTS:
+        all_pnw_titles_by_id = an OrderedDict of awardable Game objects, keyed by game ID
+        all_awardable_plays_by_game = a dict of filtered GameCheckout lists, keyed by game ID
+        problem_plays = a running list of plays for games that had problems with awarding
+        ineligible_players = a list of players who can't win; winners are appended to it
+
+    Games are drawn in random order, and each copy goes to a player picked like the standard
+    method (shuffle every eligible play's players, first one not yet a winner), so more plays
+    still means more chances. Hopcroft-Karp then reassigns as few copies as needed to reach a
+    maximum matching.
+
+    RETURNS:
+        a list of Win objects
+    """
+    if ineligible_players is None:
+        ineligible_players = list()
+    ineligible_ids = set(p.player_id for p in ineligible_players)
+
+    # Right vertices: distinct eligible players. Left vertices: games, with one unit of
+    # capacity per copy and a shuffled list of neighbours.
+    player_index = OrderedDict()
+    players = list()
+    game_tokens = dict()
+    adj = list()
+    capacity = list()
+    game_ids = list(all_awardable_plays_by_game.keys())
+    random.shuffle(game_ids)
+    for game_id in game_ids:
+        tokens = list()
+        for play in all_awardable_plays_by_game[game_id]:
+            for p in play.players:
+                if p.wants_to_win==True and p.player_id not in ineligible_ids:
+                    if p.player_id not in player_index:
+                        player_index[p.player_id] = len(players)
+                        players.append(p)
+                    tokens.append(player_index[p.player_id])
+        game_tokens[game_id] = tokens
+        neighbours = list(set(tokens))
+        random.shuffle(neighbours)
+        adj.append(neighbours)
+        capacity.append(all_pnw_titles_by_id[game_id].num_copies())
+
+    # Weighted random draw, game by game. Shuffling lazily (one Fisher-Yates swap per token
+    # looked at) gives the same draw as shuffling the whole list, without paying for tokens
+    # that are never reached.
+    match_left = [list() for game_id in game_ids]
+    match_right = [-1]*len(players)
+    for u,game_id in enumerate(game_ids):
+        tokens = game_tokens[game_id]
+        swapped = dict()
+        i = 0
+        while len(match_left[u]) < capacity[u] and i < len(tokens):
+            j = random.randrange(i, len(tokens))
+            v = tokens[swapped.get(j, j)]
+            swapped[j] = swapped.get(i, i)
+            i += 1
+            if match_right[v]==-1:
+                match_left[u].append(v)
+                match_right[v] = u
+    n_drawn = sum(len(m) for m in match_left)
+
+    hopcroft_karp(adj, len(players), capacity, match_left, match_right)
+    n_matched = sum(len(m) for m in match_left)
+    logger.info(f"Max coverage: the random draw awarded {n_drawn} of {sum(capacity)} copies, "+
+                f"augmenting paths raised that to {n_matched} (the most possible)")
+
+    # Build the wins, game by game; the copies of a game are interchangeable
+    wins = list()
+    winners_by_game = OrderedDict()
+    for u,game_id in enumerate(game_ids):
+        copy_ids = all_pnw_titles_by_id[game_id].copy_ids()
+        winners_by_game[game_id] = [(copy_id,players[v]) for copy_id,v in zip(copy_ids,match_left[u])]
+
+    for game_id,game_wins in winners_by_game.items():
+        game = all_pnw_titles_by_id[game_id]
+        plays = all_awardable_plays_by_game[game_id]
+        n_plays_by_player = dict()
+        for v in game_tokens[game_id]:
+            n_plays_by_player[v] = n_plays_by_player.get(v,0)+1
+        n_total_players = sum(len(play.players) for play in plays)
+        note = f"{len(plays)} total eligible plays, {n_total_players} total motivated players"
+        problem_flag = len(game_wins) < game.num_copies()
+        if problem_flag:
+            note = f"CHECK UNAWARDED GAMES FILE: {len(n_plays_by_player)} eligible players, "+note
+            problem_plays.extend(plays)
+            logger.warning(f"Check Problem File: only {len(game_wins)} copies of game {game.game_name}, ID {game.game_id} awarded")
+
+        for copy_id,winner in game_wins:
+            wins.append(pnw.Win(game=game, copy_id=copy_id, player=winner, play=None,
+                                n_plays=n_plays_by_player[player_index[winner.player_id]], notes=note))
+            ineligible_players.append(winner)
+
+    return wins
@@ -0,0 +1,315 @@
+"""Exact (or bounded-error) odds of each player winning a single game, under the
+old_school and standard methods of pnw_picker.select_game_winners.
+
+    python pnw_odds.py games.json plays.json 1234 --ineligible_players_fn staff.tsv
+"""
+import argparse
+import csv
+import logging
+import math
+import random
+import sys
+from collections import Counter, OrderedDict, defaultdict
+
+import pnw
+
+logger = logging.getLogger(__name__)
+
+class _TooExpensive(Exception):
+    """Raised when an exact computation would take more than max_work steps."""
+
+class WinOdds(object):
+    """Each eligible player's probability of winning at least one copy of a game.
+        Contains:
+            - game: the Game object
+            - method: 'standard' or 'old_school'
+            - exact: True if computed analytically, False if estimated by simulation
+            - error_bound: 0 if exact, otherwise every probability is within this of the truth
+              with confidence 1-delta
+            - players: OrderedDict of Player objects by player_id
+            - n_plays: number of eligible plays per player_id
+            - probabilities: win probability per player_id
+    """
+
+    _header_row = ['Game_ID','Game_Name','Copies','Method','Player_Name','Player_ID','N_plays','P_win','Exact','Error_Bound']
+
+    def __init__(self, game, method, players, n_plays, probabilities, exact=True, error_bound=0.0):
+        self.game = game
+        self.method = method
+        self.players = players
+        self.n_plays = n_plays
+        self.probabilities = probabilities
+        self.exact = exact
+        self.error_bound = error_bound
+
+    def expected_winners(self):
+        return sum(self.probabilities.values())
+
+    def tsv_rows(self):
+        """One row per eligible player, most likely winner first."""
+        rows = list()
+        for player_id in sorted(self.probabilities, key=lambda p: -self.probabilities[p]):
+            player = self.players[player_id]
+            rows.append([self.game.game_id, self.game.game_name, self.game.num_copies(), self.method,
+                        player.player_name, player_id, self.n_plays[player_id],
+                        round(self.probabilities[player_id],6), self.exact, self.error_bound])
+        return rows
+
+def _standard_top_k(counts, picks, max_work, memo):
+    """Probability that each player is among the first `picks` distinct players of a shuffled
+        list in which player j appears counts[j] times (the standard method).
+
+        Drawing distinct players from a shuffled multiset is the same as drawing without
+        replacement with probability proportional to counts, so players with equal counts are
+        interchangeable. The DP runs over how many players of each count are left, which is
+        at most C(#distinct counts + picks, picks) states.
+
+        RETURNS: a list of probabilities, parallel to counts.
+    """
+    classes = sorted(Counter(counts).items())
+    sizes = tuple(n for c,n in classes)
+    weights = [c for c,n in classes]
+    n_classes = len(classes)
+
+    def expected_picked(remaining, picks):
+        """Expected number of players picked from each class."""
+        if picks==0:
+            return (0.0,)*n_classes
+        if picks >= sum(remaining):
+            return tuple(float(r) for r in remaining)
+        key = (remaining, picks)
+        if key in memo:
+            return memo[key]
+        if len(memo)*n_classes >= max_work:
+            raise _TooExpensive()
+
+        total = sum(w*r for w,r in zip(weights,remaining))
+        expected = [0.0]*n_classes
+        for g in range(n_classes):
+            if remaining[g]==0:
+                continue
+            p = weights[g]*remaining[g]/total
+            sub = expected_picked(remaining[:g]+(remaining[g]-1,)+remaining[g+1:], picks-1)
+            for h in range(n_classes):
+                expected[h] += p*sub[h]
+            expected[g] += p
+        memo[key] = tuple(expected)
+        return memo[key]
+
+    # Recurse only picks deep, so the default recursion limit is plenty.
+    expected = expected_picked(sizes, picks)
+    per_player = {c:expected[g]/sizes[g] for g,(c,n) in enumerate(classes)}
+    return [per_player[c] for c in counts]
+
+def _standard_odds(counts, k, max_work):
+    """Exact standard-method odds, keyed like counts (a dict of player_id: eligible plays)."""
+    ids = list(counts)
+    probs = _standard_top_k([counts[i] for i in ids], k, max_work, dict())
+    return dict(zip(ids, probs))
+
+def _old_school_odds(play_sets, counts, k, max_work):
+    """Exact old_school odds.
+
+        The plays are shuffled and each play in turn yields one random eligible player who
+        hasn't won yet, until k players have won; if the plays run out first, the rest are
+        picked by the standard method from everyone left. Conditional on what has happened so
+        far, the unplayed plays are still in uniformly random order, so the state is just the
+        winners so far plus the multiset of unplayed plays, each reduced to its players who
+        haven't won. Plays with nobody left in them can never change the outcome and are
+        dropped, which lets different play orders share memoized states.
+
+        Few states are actually shared, so the work grows like (plays x players)^k; that is
+        checked up front and again as the DP runs.
+    """
+    plays = tuple(sorted(Counter(tuple(sorted(s)) for s in play_sets if s).items()))
+    branches = sum(len(set(residual)) for residual,mult in plays)
+    if branches**k > max_work:
+        raise _TooExpensive()
+
+    standard_memo = dict()
+    memo = dict()
+    work = [0]
+
+    def fallback(winners, picks):
+        left = [p for p in counts if p not in winners]
+        probs = _standard_top_k([counts[p] for p in left], picks, max_work, standard_memo)
+        return dict(zip(left, probs))
+
+    def remove_winner(plays, chosen, winner):
+        """The unplayed plays after playing `chosen` and awarding `winner`."""
+        remaining = Counter()
+        for residual,mult in plays:
+            if residual==chosen:
+                mult -= 1
+            if mult==0:
+                continue
+            residual = tuple(p for p in residual if p!=winner)
+            if residual:
+                remaining[residual] += mult
+        return tuple(sorted(remaining.items()))
+
+    def odds(winners, plays):
+        picks = k-len(winners)
+        if picks==0:
+            return dict()
+        if not plays:
+            return fallback(winners, picks)
+
+        work[0] += len(plays)
+        if work[0] > max_work:
+            raise _TooExpensive()
+
+        n_plays = sum(mult for residual,mult in plays)
+        result = defaultdict(float)
+        if picks==1:
+            # The next play decides it, whatever order the rest are in.
+            for residual,mult in plays:
+                for player,n in Counter(residual).items():
+                    result[player] += mult/n_plays * n/len(residual)
+            return result
+
+        key = (winners, plays)
+        if key in memo:
+            return memo[key]
+
+        for residual,mult in plays:
+            for player,n in Counter(residual).items():
+                p = mult/n_plays * n/len(residual)
+                result[player] += p
+                sub = odds(winners | frozenset([player]), remove_winner(plays, residual, player))
+                for other,q in sub.items():
+                    result[other] += p*q
+        memo[key] = result
+        return result
+
+    probs = odds(frozenset(), plays)
+    return {p:probs.get(p,0.0) for p in counts}
+
+def _shuffled(items, rng):
+    """Yield items in uniformly random order, shuffling lazily (Fisher-Yates, one swap per
+        item taken) so stopping after a few items costs only a few steps."""
+    swapped = dict()
+    for i in range(len(items)):
+        j = rng.randrange(i, len(items))
+        yield items[swapped.get(j, j)]
+        swapped[j] = swapped.get(i, i)
+
+def _simulate(play_sets, counts, k, method, n_trials, rng):
+    """Monte Carlo estimate of the same odds, following select_game_winners step by step."""
+    tokens = [p for p in counts for i in range(counts[p])]
+    wins = Counter()
+    for t in range(n_trials):
+        winners = set()
+        if method=='old_school':
+            for play in _shuffled(play_sets, rng):
+                eligible = [p for p in play if p not in winners]
+                if eligible:
+                    winners.add(rng.choice(eligible))
+                if len(winners)==k:
+                    break
+        if len(winners) < k:
+            for p in _shuffled(tokens, rng):
+                if p not in winners:
+                    winners.add(p)
+                    if len(winners)==k:
+                        break
+        wins.update(winners)
+    return {p:wins[p]/n_trials for p in counts}
+
+def game_win_odds(game, plays, ineligible_players=None, method='old_school',
+                    max_work=100000, epsilon=0.02, delta=0.01, seed=None):
+    """Each eligible player's chance of winning at least one copy of game, if it were awarded
+        now by select_game_winners with this method.
+
+    ARGUMENTS:
+        game = a Game object, which may have multiple copies
+        plays = a list of GameCheckout objects (optional: can be for all plays, or just this one)
+        ineligible_players = a list of players who can no longer win (staff, earlier winners)
+        method = "standard" or "old_school"
+        max_work = the most DP steps (states x plays) to spend on the exact answer, ~0.1s
+        epsilon, delta = if the exact answer is too expensive, simulate until every
+            probability is within epsilon of the truth with confidence 1-delta (Hoeffding
+            bound, union over players)
+        seed = random seed for the simulation
+
+    RETURNS:
+        a WinOdds object
+    """
+    if method not in ('standard','old_school'):
+        raise NotImplementedError()
+    ineligible_ids = set(p.player_id for p in ineligible_players) if ineligible_players is not None else set()
+
+    # Same eligibility rules as select_game_winners
+    play_sets = list()
+    players = OrderedDict()
+    counts = Counter()
+    for play in plays:
+        if play.game.game_id != game.game_id:
+            continue
+        eligible = [p for p in play.players if (p.wants_to_win==True and p.player_id not in ineligible_ids)]
+        play_sets.append(tuple(p.player_id for p in eligible))
+        for p in eligible:
+            players.setdefault(p.player_id, p)
+            counts[p.player_id] += 1
+
+    k = game.num_copies()
+    if k >= len(counts):
+        # Everyone eligible gets a copy (the "embarrassing" branch)
+        return WinOdds(game, method, players, counts, {p:1.0 for p in counts})
+
+    try:
+        if method=='standard':
+            probabilities = _standard_odds(counts, k, max_work)
+        else:
+            probabilities = _old_school_odds(play_sets, counts, k, max_work)
+        return WinOdds(game, method, players, counts, probabilities)
+    except _TooExpensive:
+        n_trials = math.ceil(math.log(2*len(counts)/delta)/(2*epsilon**2))
+        logger.info(f"Exact {method} odds for {game.game_name} need over {max_work} steps, "+
+                    f"simulating {n_trials} draws instead")
+        probabilities = _simulate(play_sets, counts, k, method, n_trials, random.Random(seed))
+        return WinOdds(game, method, players, counts, probabilities, exact=False, error_bound=epsilon)
+
+def main():
+    p = argparse.ArgumentParser(description='Play & Win per-player win odds for one game')
+    p.add_argument('games_source', help="games JSON snapshot")
+    p.add_argument('plays_source', help="plays JSON snapshot")
+    p.add_argument('game_id', type=int, help="the game to compute odds for")
+    p.add_argument('--ineligible_players_fn', default=None,
+                    help="a tsv file with ID,Player Name of all ineligible players (such as staff)")
+    p.add_argument('--method', choices=['standard','old_school','both'], default='both')
+    p.add_argument('--duration_min', default=None, type=float,
+                    help="minimum duration (minutes) for a play to count")
+    p.add_argument('--duration_max', default=None, type=float,
+                    help="maximum duration (minutes) for a play to count")
+    p.add_argument('--max_work', default=100000, type=int,
+                    help="largest exact computation before switching to simulation")
+    p.add_argument('--epsilon', default=0.02, type=float,
+                    help="error bound on each probability when simulating")
+    args = p.parse_args()
+    logging.basicConfig(level=logging.INFO, format='[%(levelname)10s] :\t %(message)s')
+
+    all_pnw_titles = pnw.filter_library_games(pnw.parse_games_json(args.games_source))
+    all_pnw_titles_by_id = OrderedDict([(g.game_id,g) for g in all_pnw_titles])
+    if args.game_id not in all_pnw_titles_by_id:
+        sys.exit(f"Game {args.game_id} has no awardable copies")
+    game = all_pnw_titles_by_id[args.game_id]
+
+    duration_min = args.duration_min*60.0 if args.duration_min is not None else None
+    duration_max = args.duration_max*60.0 if args.duration_max is not None else None
+    filtered_plays, removed_plays = pnw.filter_plays(pnw.parse_plays_json(args.plays_source),
+                                        all_pnw_titles_by_id, duration_min, duration_max)
+    ineligible_players = None
+    if args.ineligible_players_fn is not None:
+        ineligible_players = pnw.parse_ineligible_players(args.ineligible_players_fn)
+
+    methods = ['standard','old_school'] if args.method=='both' else [args.method]
+    writer = csv.writer(sys.stdout, delimiter='\t')
+    writer.writerow(WinOdds._header_row)
+    for method in methods:
+        odds = game_win_odds(game, filtered_plays[game.game_id], ineligible_players, method,
+                                max_work=args.max_work, epsilon=args.epsilon)
+        writer.writerows(odds.tsv_rows())
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,453 @@
+"""Out-of-core draws: pick_all_winners in bounded memory, for huge or combined snapshots.
+
+    python pnw_ooc.py output/decade/pnw -g data/games.json -p data/plays.2015.json data/plays.2016.json ... --memory_mb 256
+    python pnw_picker.py output/pnw --local -g games.json -p plays.json --memory_mb 256 ...
+
+The in-memory pipeline holds every play, every debug row and every win at once. Here:
+    1. plays are read one at a time from the api/plays JSON (iter_plays_json) and filtered by
+       the same rules (pnw.play_removal_reason); removed plays go straight to <log_dir>/filtered.*.tsv
+    2. kept plays are buffered up to the memory budget, then spilled to a run file sorted by
+       game ID; the runs are merged into one file of plays grouped by game, with an index of
+       where each game's plays start
+    3. the draw shuffles the games as pnw_picker.draw_winners does and reads one game's plays at
+       a time from that file; each win is appended to a spill file, and the plays of games that
+       couldn't be fully awarded go straight to the unawarded TSV
+    4. the winners TSV (by winner name) and labels (by game name) are produced by external merge
+       sorts of the wins; the results JSON is streamed from the draw-order wins
+
+With the same inputs and seed, the winners are the same as pnw_picker.pick_all_winners'. The
+budget (estimated from the serialized size of what is buffered) bounds the play and win
+buffers; the games catalogue, one game's plays and the players already ineligible (staff and
+winners) are always in memory. Only the random schedule and the standard and old_school
+methods can run this way, since rarest_first and max_coverage look at every game at once.
+"""
+import argparse
+import csv
+import heapq
+import json
+import logging
+import os
+import random
+import re
+import shutil
+import tempfile
+import time
+from datetime import datetime, timedelta
+from itertools import islice
+
+import pnw
+import pnw_picker
+import pnw_progress
+
+# a child of the picker's logger, so a run goes to the picker's console and log files
+logger = logging.getLogger(f"{pnw_picker.app_name}.ooc")
+
+default_memory_budget = 256*1024*1024
+# rough Python overhead of a buffered record, on top of its serialized size
+_record_overhead = 200
+
+_plays_start = re.compile(r'"Plays"\s*:\s*\[')
+_between = re.compile(r'[\s,]*')
+
+def iter_plays_json(filename, chunk_size=1<<20):
+    """Yield the play dicts of an api/plays JSON file ({..."Result": {"Plays": [...]}}) one at a
+        time, reading chunk_size characters at a go, so the file is never loaded whole.
+    """
+    decoder = json.JSONDecoder()
+    with open(filename, 'r', encoding='utf-8', newline='') as f:
+        buf = ''
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                raise ValueError(f"no Plays list in {filename}")
+            buf += chunk
+            m = _plays_start.search(buf)
+            if m:
+                buf = buf[m.end():]
+                break
+            buf = buf[-32:]    # the key may straddle two chunks
+
+        pos = 0
+        while True:
+            pos = _between.match(buf, pos).end()
+            if pos < len(buf) and buf[pos] == ']':
+                return
+            try:
+                if pos == len(buf):
+                    raise ValueError('need more')
+                play, end = decoder.raw_decode(buf, pos)
+            except ValueError:
+                # the next play runs past the buffer: read on
+                chunk = f.read(chunk_size)
+                if not chunk:
+                    raise ValueError(f"{filename} ends inside its Plays list")
+                buf = buf[pos:]+chunk
+                pos = 0
+                continue
+            yield play
+            pos = end
+            if pos > chunk_size:
+                buf = buf[pos:]
+                pos = 0
+
+def external_sort(records, key, tmp_dir, memory_budget=default_memory_budget, name='sort'):
+    """Yield JSON-serializable records sorted by key(record), stable, holding at most about
+        memory_budget bytes of them at once: sorted runs are spilled to tmp_dir and merged.
+    """
+    runs = list()
+    chunk = list()
+    size = 0
+    def spill():
+        chunk.sort(key=key)
+        run_fn = os.path.join(tmp_dir, f"{name}.{len(runs)}.jsonl")
+        with open(run_fn, 'w', encoding='utf-8') as f:
+            f.writelines(json.dumps(r, ensure_ascii=False)+'\n' for r in chunk)
+        runs.append(run_fn)
+        chunk.clear()
+    for record in records:
+        chunk.append(record)
+        size += _record_overhead+len(repr(record))
+        if size >= memory_budget:
+            spill()
+            size = 0
+    if not runs:
+        # it all fit: no files needed
+        chunk.sort(key=key)
+        yield from chunk
+        return
+    if chunk:
+        spill()
+    logger.debug("%s: merging %d sorted runs", name, len(runs))
+
+    def read_run(run_fn):
+        with open(run_fn, encoding='utf-8') as f:
+            for line in f:
+                yield json.loads(line)
+    try:
+        # heapq.merge prefers the earlier run on ties, so the sort stays stable
+        yield from heapq.merge(*(read_run(fn) for fn in runs), key=key)
+    finally:
+        for run_fn in runs:
+            os.remove(run_fn)
+
+def _compact_play(play):
+    """A filtered play (motivated players only) as a JSON-able list, for the spill files"""
+    return [play.checkout_id, play.game.game_id, play.game.game_name, play.copy_id,
+            pnw._epoch_seconds(play.time_out), pnw._epoch_seconds(play.time_in), play.duration,
+            [[p.player_id, p.player_name, p.rating] for p in play.players if p.wants_to_win==True]]
+
+_epoch = datetime(1970,1,1)
+
+def _expand_play(compact):
+    checkout_id, game_id, game_name, copy_id, time_out, time_in, duration, players = compact
+    play = pnw.GameCheckout()
+    play.checkout_id = checkout_id
+    play.game = pnw.Game(game_id=game_id, game_name=game_name)
+    play.copy_id = copy_id
+    play.time_out = _epoch + timedelta(seconds=time_out)
+    play.time_in = _epoch + timedelta(seconds=time_in)
+    play.duration = duration
+    play.players = [pnw.Player(player_id=pid, player_name=name, wants_to_win=True, rating=rating)
+                    for pid,name,rating in players]
+    return play
+
+def _compact_win(win):
+    return [win.game.game_id, win.game.game_name, win.copy_id, win.player.player_id,
+            win.player.player_name, win.n_plays, win.notes]
+
+def _expand_win(compact):
+    game_id, game_name, copy_id, player_id, player_name, n_plays, notes = compact
+    return pnw.Win(game=pnw.Game(game_id=game_id, game_name=game_name), copy_id=copy_id,
+                   player=pnw.Player(player_id=player_id, player_name=player_name), play=None,
+                   n_plays=n_plays, notes=notes)
+
+class GamePlaysFile(object):
+    """Filtered plays grouped by game in one JSON-lines file, with where each game's plays start.
+        Contains:
+            - fn: the file
+            - index: {game_id: (offset, number of plays)}
+            - order: game IDs in the order of their first kept play (the order filter_plays keys them in)
+    """
+    def __init__(self, fn):
+        self.fn = fn
+        self.index = dict()
+        self.order = list()
+        self._f = None
+
+    def plays(self, game_id):
+        """RETURNS: a list of GameCheckout objects, the game's plays in snapshot order"""
+        if self._f is None:
+            self._f = open(self.fn, 'rb')
+        offset, n = self.index[game_id]
+        self._f.seek(offset)
+        return [_expand_play(json.loads(line)) for line in islice(self._f, n)]
+
+    def close(self):
+        if self._f is not None:
+            self._f.close()
+            self._f = None
+
+def spill_filtered_plays(plays_sources, awardable_games_by_ID, tmp_dir, memory_budget=default_memory_budget,
+                            min_duration=None, max_duration=None, playtimes=None,
+                            awardable_fn=None, filtered_fn=None, progress=None):
+    """Stream the plays of every file in plays_sources through filter_plays' rules into a
+        GamePlaysFile in tmp_dir. Removed plays are written to filtered_fn (with their reason) as
+        they are found, and the kept plays to awardable_fn (with their game ID), grouped by game.
+        RETURNS: (the GamePlaysFile, a dict of the number of plays removed per reason)
+    """
+    removed = dict()
+    first_seen = dict()
+    n_plays = 0
+    filtered_f = open(filtered_fn, 'w', newline='', encoding='utf-8', errors='replace') if filtered_fn else None
+    try:
+        filtered_writer = csv.writer(filtered_f, delimiter='\t') if filtered_f else None
+        def kept_plays():
+            nonlocal n_plays
+            for plays_source in plays_sources:
+                for play_json in iter_plays_json(plays_source):
+                    play = pnw.GameCheckout(play_json)
+                    n_plays += 1
+                    if progress is not None and n_plays % 1000 == 0:
+                        progress.advance(1000)
+                    reason = pnw.play_removal_reason(play, awardable_games_by_ID, min_duration, max_duration, playtimes)
+                    if reason is not None:
+                        removed[reason] = removed.get(reason, 0)+1
+                        if filtered_writer is not None:
+                            filtered_writer.writerows(row+[reason] for row in play.tsv_rows())
+                        continue
+                    first_seen.setdefault(play.game.game_id, n_plays)
+                    yield _compact_play(play)
+            if progress is not None:
+                progress.advance(n_plays % 1000)
+
+        plays_file = GamePlaysFile(os.path.join(tmp_dir, 'plays_by_game.jsonl'))
+        awardable_f = open(awardable_fn, 'w', newline='', encoding='utf-8', errors='replace') if awardable_fn else None
+        try:
+            awardable_writer = csv.writer(awardable_f, delimiter='\t') if awardable_f else None
+            with open(plays_file.fn, 'wb') as f:
+                for compact in external_sort(kept_plays(), lambda c: c[1], tmp_dir, memory_budget, name='plays'):
+                    game_id = compact[1]
+                    if game_id not in plays_file.index:
+                        plays_file.index[game_id] = (f.tell(), 0)
+                    offset, n = plays_file.index[game_id]
+                    plays_file.index[game_id] = (offset, n+1)
+                    f.write(json.dumps(compact, ensure_ascii=False).encode('utf-8')+b'\n')
+                    if awardable_writer is not None:
+                        awardable_writer.writerows(row+[game_id] for row in _expand_play(compact).tsv_rows())
+        finally:
+            if awardable_f is not None:
+                awardable_f.close()
+    finally:
+        if filtered_f is not None:
+            filtered_f.close()
+
+    plays_file.order = sorted(first_seen, key=first_seen.get)
+    logger.info(f"Filtered {n_plays} plays from {len(plays_sources)} files: {sum(n for _,n in plays_file.index.values())} "+
+                f"awardable plays of {len(plays_file.index)} games kept, removed {removed}")
+    return plays_file, removed
+
+def draw_winners_ooc(all_pnw_titles_by_id, plays_file, ineligible_players, wins_fn, problem_fn,
+                        pick_method='old_school', seed=None, progress=None, weight=None):
+    """pnw_picker.draw_winners (random schedule) one game at a time from a GamePlaysFile. Each win
+        is appended to wins_fn as a JSON line, and each problem game's plays to problem_fn.
+        RETURNS: (the number of wins, [(game_id, game_name) of the problem games])
+    """
+    if pick_method not in ('standard', 'old_school'):
+        raise ValueError(f"the {pick_method} method needs every game at once: use standard or old_school out of core")
+    if seed is not None:
+        random.seed(seed)
+    awardable_game_ids = list(plays_file.order)
+    if progress is not None:
+        progress.phase('draw', total=len(awardable_game_ids), unit='games')
+    random.shuffle(awardable_game_ids)
+
+    n_wins = 0
+    problem_games = list()
+    problem_f = None
+    try:
+        with open(wins_fn, 'w', encoding='utf-8') as wins_f:
+            for game_id in awardable_game_ids:
+                game = all_pnw_titles_by_id[game_id]
+                problem_plays = list()
+                wins = pnw_picker.select_game_winners(game, plays_file.plays(game_id), problem_plays, ineligible_players,
+                                                      method=pick_method, weight=weight)
+                wins_f.writelines(json.dumps(_compact_win(w), ensure_ascii=False)+'\n' for w in wins)
+                n_wins += len(wins)
+                if problem_plays:
+                    if problem_f is None:
+                        problem_f = open(problem_fn, 'w', newline='', encoding='utf-8', errors='replace')
+                        problem_writer = csv.writer(problem_f, delimiter='\t')
+                        problem_writer.writerow(['CheckoutID','GameName','GameID','PlayerName','PlayerID','WantsToWin',
+                                                 'Rating','TimeOut','TimeIn','Duration(min)'])
+                    for play in problem_plays:
+                        problem_writer.writerows(play.tsv_rows())
+                    problem_games.append((game.game_id, game.game_name))
+                if progress is not None:
+                    progress.advance()
+    finally:
+        if problem_f is not None:
+            problem_f.close()
+        plays_file.close()
+    return n_wins, problem_games
+
+def _read_wins(wins_fn):
+    with open(wins_fn, encoding='utf-8') as f:
+        for line in f:
+            yield json.loads(line)
+
+def output_draw_results_ooc(wins_fn, n_wins, problem_games, out_fn_prefix, suffix, tmp_dir,
+                            memory_budget=default_memory_budget, progress=None):
+    """pnw_picker.output_draw_results from a wins spill file: the winners TSV and the labels are
+        ordered by external merge sorts, and the results JSON is streamed in draw order.
+    """
+    out_fn = ".".join([out_fn_prefix,suffix,"tsv"])
+    labels_fn = ".".join([out_fn_prefix,suffix,"pdf"])
+    results_fn = ".".join([out_fn_prefix,suffix,"json"])
+    if progress is not None:
+        progress.phase('output', total=3, unit='files')
+
+    logger.info(f"Outputting winners to file {out_fn}...")
+    with open(out_fn, 'w', newline='', encoding='utf-8', errors='replace') as f:
+        writer = csv.writer(f, delimiter='\t')
+        writer.writerow(pnw.Win._header_row)
+        for compact in external_sort(_read_wins(wins_fn), lambda c: (c[4], c[1]), tmp_dir, memory_budget, name='by_player'):
+            writer.writerow(_expand_win(compact).list_output())
+    if progress is not None:
+        progress.advance()
+
+    logger.info(f"Outputting winners to labels file {labels_fn}...")
+    pnw.output_winners_labels((_expand_win(c) for c in external_sort(_read_wins(wins_fn), lambda c: (c[1], c[4]),
+                                                                       tmp_dir, memory_budget, name='by_game')), labels_fn)
+    if progress is not None:
+        progress.advance()
+
+    logger.info(f"Outputting results to file {results_fn}...")
+    with open(results_fn, 'w', encoding='utf-8', errors='replace') as f:
+        f.write('{\n   "suffix": %s,\n   "n_wins": %d,\n   "wins": [' % (json.dumps(suffix), n_wins))
+        for i,compact in enumerate(_read_wins(wins_fn)):
+            f.write((',' if i else '')+'\n      '+json.dumps(_expand_win(compact), cls=pnw.CustomJSONEncoder, ensure_ascii=False))
+        f.write('\n   ],\n   "problem_games": %s\n}' % json.dumps([dict(game_id=g, game_name=n) for g,n in problem_games],
+                                                               ensure_ascii=False))
+    if progress is not None:
+        progress.advance()
+
+def pick_all_winners_ooc(ineligible_players_fn, out_fn_prefix, all_game_copies_source, all_plays_sources,
+                            suffix=None, memory_budget=default_memory_budget, pick_method='old_school',
+                            duration_min=None, duration_max=None, playtimes_fn=None, playtime_scales=(0.5, 3.0),
+                            extra_ineligible_players=None, draw_rules=None, seed=None, progress=None, spill_dir=None,
+                            log_dir='log'):
+    """pnw_picker.pick_all_winners for local snapshots, in bounded memory (see the module docstring).
+        all_plays_sources is one api/plays JSON file or a list of them, drawn as one snapshot.
+        memory_budget is in bytes; spill files go in a temporary directory under spill_dir
+        (default: the system's), removed at the end. The outputs are the same files, with the
+        debug TSVs in log_dir.
+
+    Returns:
+        The number of wins
+    """
+    if pick_method not in ('standard', 'old_school'):
+        raise ValueError(f"the {pick_method} method needs every game at once: use standard or old_school out of core")
+    if suffix is None:
+        suffix = str(int(time.time()-1.5e9))
+    if progress is None:
+        progress = pnw_progress.Progress()
+    if isinstance(all_plays_sources, str):
+        all_plays_sources = [all_plays_sources]
+
+    progress.phase('parse games')
+    all_game_titles = pnw.parse_games_json(all_game_copies_source)
+    all_pnw_titles = pnw.filter_library_games(all_game_titles)
+    all_pnw_titles_by_id = {g.game_id: g for g in all_pnw_titles}
+    logger.info(f"Parsed {len(all_game_titles)} total game titles from {all_game_copies_source}")
+    logger.info(f"Awarding {len(all_pnw_titles)} game titles with {sum(g.num_copies() for g in all_pnw_titles)} copies "+
+                f"out of core, in a {memory_budget/2**20:.0f} MB budget")
+    for titles,fn in ((all_game_titles, os.path.join(log_dir, ".".join(['all_games',suffix,"tsv"]))),
+                      (all_pnw_titles, os.path.join(log_dir, ".".join(['pnw_games',suffix,"tsv"])))):
+        with open(fn, 'w', newline='', encoding='utf-8', errors='replace') as f:
+            writer = csv.writer(f, delimiter='\t')
+            for title in titles:
+                writer.writerows(title.tsv_copies())
+
+    playtimes = None
+    if playtimes_fn is not None:
+        playtimes = pnw.GamePlaytimes.from_json(playtimes_fn, *playtime_scales)
+
+    ineligible_players = list()
+    if ineligible_players_fn is not None:
+        ineligible_players = pnw.parse_ineligible_players(ineligible_players_fn)
+    else:
+        logger.warning("No filename provided for ineligible players, everyone starts eligible")
+    if extra_ineligible_players is not None:
+        ineligible_players.extend(extra_ineligible_players)
+    weight = None
+    if draw_rules is not None:
+        ineligible_players.extend(draw_rules.ineligible_players())
+        weight = draw_rules.weight if draw_rules.weighted() else None
+
+    tmp_dir = tempfile.mkdtemp(prefix='pnw-ooc-', dir=spill_dir)
+    try:
+        progress.phase('filter', unit='plays')
+        plays_file, removed = spill_filtered_plays(all_plays_sources, all_pnw_titles_by_id, tmp_dir, memory_budget,
+                                                   duration_min, duration_max, playtimes,
+                                                   awardable_fn=os.path.join(log_dir, ".".join(['awardable',suffix,"tsv"])),
+                                                   filtered_fn=os.path.join(log_dir, ".".join(['filtered',suffix,"tsv"])),
+                                                   progress=progress)
+
+        wins_fn = os.path.join(tmp_dir, 'wins.jsonl')
+        problem_fn = ".".join([out_fn_prefix,suffix,"unawarded.tsv"])
+        n_wins, problem_games = draw_winners_ooc(all_pnw_titles_by_id, plays_file, ineligible_players, wins_fn, problem_fn,
+                                                 pick_method, seed, progress, weight)
+        n_prizes = sum(g.num_copies() for g in all_pnw_titles)
+        logger.info(f"We have {n_wins} winners!")
+        if n_wins!=n_prizes:
+            logger.error("Something may have gone wrong, not all games have been given away:")
+            logger.error(f"\t{n_wins} prizes, but {n_prizes} were expected")
+        if problem_games:
+            logger.info(f"Some problem games were detected (dagnabbit!); all plays for these games are in {problem_fn}")
+
+        output_draw_results_ooc(wins_fn, n_wins, problem_games, out_fn_prefix, suffix, tmp_dir, memory_budget, progress)
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    logger.info(f"--- Done awarding games for file stamp {suffix}! ---")
+    return n_wins
+
+def main():
+    p = argparse.ArgumentParser(description='Play & Win out-of-core draw')
+    p.add_argument('output_fn_prefix', help="filename as prefix for final winner output")
+    p.add_argument('-g', '--games_source', required=True, help="games JSON snapshot")
+    p.add_argument('-p', '--plays_sources', required=True, nargs='+', help="plays JSON snapshots, drawn as one")
+    p.add_argument('--ineligible_players_fn', default=None,
+                    help="a tsv file with ID,Player Name of all ineligible players (such as staff)")
+    p.add_argument('--method', choices=['standard', 'old_school'], default='old_school',
+                    help="standard (weighted by plays) or old_school (choose play then player)")
+    p.add_argument('--duration_min', default=None, type=float, help="minimum duration (minutes) for a play to count")
+    p.add_argument('--duration_max', default=None, type=float, help="maximum duration (minutes) for a play to count")
+    p.add_argument('--playtimes_fn', default=None,
+                    help="bgg-playtimes.json: also bound each game's plays by its own BGG playing time")
+    p.add_argument('--playtime_scales', default=[0.5, 3.0], type=float, nargs=2, metavar=('MIN_SCALE','MAX_SCALE'),
+                    help="a play counts from MIN_SCALE x the BGG minimum time to MAX_SCALE x the maximum, default 0.5 3")
+    p.add_argument('--memory_mb', default=default_memory_budget/2**20, type=float,
+                    help="memory budget for buffered plays and wins, default=256")
+    p.add_argument('--spill_dir', default=None, help="where the temporary spill files go (default: the system's)")
+    p.add_argument('--seed', default=None, type=int, help="seed for the draw: the same inputs and seed always give the same winners")
+    p.add_argument('--log_dir', default='log', help="directory for the picker's log files and debug TSVs, default=log")
+    p.add_argument('--no_debug_log', action="store_false", dest="debug_log", default=True,
+                    help="skip the per-game debug messages (the debug log gets info and up only)")
+    args = p.parse_args()
+    # this module logs through the picker's logger, so give it the picker's console and log files
+    picker_logger = pnw.setup_logger(pnw_picker.app_name, log_dir=args.log_dir)
+    if not args.debug_log:
+        picker_logger.setLevel(logging.INFO)
+
+    job = pnw_progress.Job(pick_all_winners_ooc, args.ineligible_players_fn, args.output_fn_prefix,
+                            args.games_source, args.plays_sources,
+                            memory_budget=int(args.memory_mb*2**20), pick_method=args.method,
+                            duration_min=args.duration_min*60.0 if args.duration_min is not None else None,
+                            duration_max=args.duration_max*60.0 if args.duration_max is not None else None,
+                            playtimes_fn=args.playtimes_fn, playtime_scales=args.playtime_scales,
+                            seed=args.seed, spill_dir=args.spill_dir, log_dir=args.log_dir)
+    job.start().wait(pnw_progress.default_reporter())
+
+if __name__ == '__main__':
+    main()
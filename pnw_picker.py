@@ -2,16 +2,26 @@
 import pnw
 from pnw import logger
 import pnw_api
+import pnw_matching
+import pnw_cache
+import pnw_progress
+import pnw_winners_db
 
 
 import time
+import os
+import sys
+import datetime
+import logging
 import random
+import heapq
 import requests
 import csv
 import argparse
 import json
 from gooey import Gooey
-from collections import OrderedDict
+from collections import OrderedDict, defaultdict
+from concurrent.futures import ThreadPoolExecutor
 from copy import copy
 
 
@@ -36,7 +46,11 @@ logger = pnw.setup_logger(app_name)
 
 def pick_all_winners(ineligible_players_fn, out_fn_prefix, suffix=None,
                         local_source=False, all_plays_source=None, all_game_copies_source=None,
-                        pick_method='old_school', duration_min=None, duration_max=None):
+                        pick_method='old_school', duration_min=None, duration_max=None, schedule='random',
+                        sub_endpoint=None, extra_ineligible_players=None, refresh_games=False,
+                        page_size=None, seed=None, use_cache=True, progress=None,
+                        playtimes_fn=None, playtime_scales=(0.5, 3.0), draw_rules=None, memory_budget=None,
+                        log_dir='log'):
     """The master function: Given all play-and-win entries, pick and return the winners.
     Keyword arguments:
 
@@ -49,9 +63,28 @@ def pick_all_winners(ineligible_players_fn, out_fn_prefix, suffix=None,
         local_source = True if using previously-downloaded JSON source files, otherwise use api endpoints
         all_plays_source -- if local_source=True, JSON file of all game plays
         all_game_copies_source -- if local_source=True, JSON file of all game copies
-        pick_method -- standard (weighted by plays) or old_school (choose play then player)
+        pick_method -- standard (weighted by plays), old_school (choose play then player), or max_coverage (standard, then reassign so the most copies possible are awarded)
         duration_min -- minimum duration (minutes) for a play to count
         duration_max -- maximum duration (minutes) for a play to count
+        schedule -- random (award games in random order) or rarest_first (always award the game with the fewest eligible players left)
+        sub_endpoint -- if local_source=False, the API collection path (default pnw_api.default_sub_endpoint)
+        extra_ineligible_players -- Player objects who also can't win, on top of ineligible_players_fn (eg winners in another collection)
+        refresh_games -- if local_source=False, download the games catalogue even if the HTTP cache (pnw_api.default_cache_dir) has it
+        page_size -- if local_source=False, fetch plays in concurrent pages of this many plays (None: one request)
+        seed -- seed for the draw, so the same inputs give the same winners (None: a different draw every run)
+        use_cache -- reuse stage results (parsed games, filtered plays, ineligible players and, with a seed, the draw)
+                     from the stage cache (pnw_cache.default_cache_dir) when their inputs and options haven't changed
+        progress -- a pnw_progress.Progress to keep up to date with the phase of the run and how far through it is
+        playtimes_fn -- bgg-playtimes.json (from Random Scripts/hoarding-bgg-compare.js): also bound each game's
+                        plays by its own BGG playing time, on top of duration_min and duration_max
+        playtime_scales -- (min_scale, max_scale): with playtimes_fn, a play counts from min_scale x the game's
+                           BGG minimum time to max_scale x its maximum time
+        draw_rules -- a pnw_winners_db.DrawRules from the prior winners store: badges at its win cap can't win,
+                      and last year's winners are drawn with its prior_weight
+        memory_budget -- if local_source=True, run out of core in about this many bytes (pnw_ooc.pick_all_winners_ooc):
+                         plays are filtered as a stream and spilled to disk, and games drawn one at a time from there.
+                         The stage cache isn't used, and only the random schedule with standard or old_school can run this way
+        log_dir -- directory for the debug TSVs (all_games, pnw_games, awardable and filtered .[suffix].tsv)
 
     Outputs:
         games.[suffix].json -- If local_source=False, list of P&W games from the API
@@ -59,20 +92,39 @@ def pick_all_winners(ineligible_players_fn, out_fn_prefix, suffix=None,
         out_fn.[suffix].tsv -- TSV list of winners and the games they won, sorted by winner name
         out_fn.[suffix].pdf -- PDF of labels to stick on P&W games, sorted by game name (Avery 6460 style)
         out_fn.[suffix].unawarded.tsv -- TSV list of plays for games that could not be awarded, due to e.g. not enough eligible players
+        out_fn.[suffix].json -- JSON of every win and the games with problems
 
     Returns:
         A tsv list of the winner of each played copy, one copy per row.
+        The list of Win objects.
     """
 
     # Set the suffix if not provided (accurate to second)
     if suffix is None:
         suffix = str(int(time.time()-1.5e9))
+    if progress is None:
+        progress = pnw_progress.Progress()
+
+    if memory_budget is not None:
+        if not local_source:
+            raise ValueError("an out-of-core run reads local snapshots: download them first, or drop memory_budget")
+        if schedule!='random':
+            raise ValueError(f"the {schedule} schedule needs every game at once, so it can't run out of core")
+        import pnw_ooc      # it builds on this module
+        pnw_ooc.pick_all_winners_ooc(ineligible_players_fn, out_fn_prefix, all_game_copies_source, all_plays_source,
+                                     suffix=suffix, memory_budget=memory_budget, pick_method=pick_method,
+                                     duration_min=duration_min, duration_max=duration_max,
+                                     playtimes_fn=playtimes_fn, playtime_scales=playtime_scales,
+                                     extra_ineligible_players=extra_ineligible_players, draw_rules=draw_rules,
+                                     seed=seed, progress=progress, log_dir=log_dir)
+        return pnw.parse_winners_tsv(".".join([out_fn_prefix,suffix,"tsv"]))
 
     # Parse the inputs
     all_plays_json= None
     all_game_copies_json = None
     g = requests.session()
     p = requests.session()
+    plays_fetch = None
     if local_source is False:
         # hard code the URL for now
         # will output to files, then parse those files
@@ -80,18 +132,49 @@ def pick_all_winners(ineligible_players_fn, out_fn_prefix, suffix=None,
         logger.info(f"Attempting api retrieval from {url}...")
         all_game_copies_source = ".".join(['data/games',suffix,'json'])
         all_plays_source = ".".join(['data/plays',suffix,'json'])
-        games = pnw_api.retrieve_data_api('games',url)
-        plays = pnw_api.retrieve_data_api('plays',url)
+        progress.phase('fetch', unit='plays')
+        # the plays (by far the bigger download) come in the background, while the games are fetched and parsed
+        def fetch_plays():
+            plays = pnw_api.retrieve_data_api('plays',url,sub_endpoint,page_size=page_size,on_page=progress.advance)
+            with open(all_plays_source,'w',newline='') as f:
+                json.dump(plays,f,indent=3)
+        fetch_pool = ThreadPoolExecutor(max_workers=1)
+        plays_fetch = fetch_pool.submit(fetch_plays)
+        fetch_pool.shutdown(wait=False)
+        # the games hardly change during a con, so usually the cached copy is confirmed with a 304
+        games = pnw_api.retrieve_data_api('games',url,sub_endpoint,cache=pnw_api.HTTPCache(),refresh=refresh_games)
         with open(all_game_copies_source,'w',newline='') as f:
             json.dump(games,f,indent=3)
-        with open(all_plays_source,'w',newline='') as f:
-            json.dump(plays,f,indent=3)
-        logger.info(f"...API data output to {all_game_copies_source} and {all_plays_source}")
+
+    # Each stage below is keyed by its inputs, so a rerun only repeats what an input or option changed
+    cache = None
+    if use_cache:
+        cache = pnw_cache.StageCache(pnw_cache.default_cache_dir, salt=pnw_cache.code_digest(pnw, pnw_matching, sys.modules[__name__]))
+    def stage(name, parts, compute):
+        if cache is None:
+            return compute(), None
+        start = time.time()
+        value, key, hit = cache.run(name, parts, compute)
+        if hit:
+            logger.info(f"...{name}: unchanged, reused from the stage cache ({time.time()-start:.2f}s)")
+        return value, key
+    def output_stage(name, key, fns, write):
+        if cache is not None and cache.reuse_outputs(key, fns):
+            logger.info(f"...{name}: unchanged, copied from the last run")
+            return
+        write()
+        if cache is not None:
+            cache.record_outputs(key, fns)
 
     # Create the list of game copies, and a dict keyed by game ID
     # Only care about the list of awardable copies
-    all_game_titles = pnw.parse_games_json(all_game_copies_source)
-    all_pnw_titles = pnw.filter_library_games(all_game_titles)
+    if plays_fetch is None:
+        progress.phase('parse games')
+    def parse_games():
+        all_game_titles = pnw.parse_games_json(all_game_copies_source)
+        return all_game_titles, pnw.filter_library_games(all_game_titles)
+    games_digest = pnw_cache.file_digest(all_game_copies_source) if cache is not None else None
+    (all_game_titles, all_pnw_titles), games_key = stage('games', [games_digest], parse_games)
     num_pnw_copies = sum([g.num_copies() for g in all_pnw_titles])
     all_pnw_titles_by_id = OrderedDict([(g.game_id,g) for g in all_pnw_titles])
 
@@ -99,119 +182,279 @@ def pick_all_winners(ineligible_players_fn, out_fn_prefix, suffix=None,
     logger.info(f"Awarding {len(all_pnw_titles)} game titles with {num_pnw_copies} copies")
 
     # DEBUG
-    all_games_fn = ".".join(['log/all_games',suffix,"tsv"])
-    pnw_games_fn = ".".join(['log/pnw_games',suffix,"tsv"])
-
-    with open(all_games_fn,'w',newline='') as f:
-        tsv_rows = list()
-        for title in all_game_titles:
-            tsv_rows.extend(title.tsv_copies())
-        writer = csv.writer(f,delimiter='\t')
-        try:
+    all_games_fn = os.path.join(log_dir, ".".join(['all_games',suffix,"tsv"]))
+    pnw_games_fn = os.path.join(log_dir, ".".join(['pnw_games',suffix,"tsv"]))
+
+    def write_games_logs():
+        with open(all_games_fn,'w',newline='') as f:
+            tsv_rows = list()
+            for title in all_game_titles:
+                tsv_rows.extend(title.tsv_copies())
+            writer = csv.writer(f,delimiter='\t')
+            try:
+                writer.writerows(tsv_rows)
+            except UnicodeEncodeError as e:
+                logger.error("There is some Unicode problem with one of these records, trying one at a time:")
+                for row in tsv_rows:
+                    logger.error(row)
+                    writer.writerow(row)
+                raise e
+
+        with open(pnw_games_fn,'w',newline='') as f:
+            tsv_rows = list()
+            for title in all_pnw_titles:
+                tsv_rows.extend(title.tsv_copies())
+            writer = csv.writer(f,delimiter='\t')
             writer.writerows(tsv_rows)
-        except UnicodeEncodeError as e:
-            logger.error("There is some Unicode problem with one of these records, trying one at a time:")
-            for row in tsv_rows:
-                logger.error(row)
-                writer.writerow(row)
-            raise e
-
-    with open(pnw_games_fn,'w',newline='') as f:
-        tsv_rows = list()
-        for title in all_pnw_titles:
-            tsv_rows.extend(title.tsv_copies())
-        writer = csv.writer(f,delimiter='\t')
-        writer.writerows(tsv_rows)
-
-    # Create the list of plays
-    all_plays = pnw.parse_plays_json(all_plays_source)
-    logger.info(f"Parsed {len(all_plays)} total plays from {all_plays_source}")
+    output_stage('games logs', games_key, [all_games_fn, pnw_games_fn], write_games_logs)
+
+    if plays_fetch is not None:
+        plays_fetch.result()
+        logger.info(f"...API data output to {all_game_copies_source} and {all_plays_source}")
+
+    # Create the list of plays (only parsed if the filter stage isn't cached)
+    plays_digest = pnw_cache.file_digest(all_plays_source) if cache is not None else None
+    def parse_plays():
+        progress.phase('parse plays')
+        all_plays = pnw.parse_plays_json_columnar(all_plays_source)
+        logger.info(f"Parsed {all_plays.num_plays()} total plays from {all_plays_source}")
+        return all_plays
 
     # Only keep the plays of awardable games
     # This includes removing games with no plays, and plays outside the allowable durations
-    all_awardable_plays_by_game, removed_plays = pnw.filter_plays(all_plays, all_pnw_titles_by_id, duration_min, duration_max)
-
-    # Output the awardable plays for later use
-    awardable_fn = ".".join(['log/awardable',suffix,"tsv"])
-    with open(awardable_fn,'w',newline='') as f:
-        rows = list()
-        writer = csv.writer(f,delimiter='\t')
-        for game_id,awardable_plays in all_awardable_plays_by_game.items():
+    # and, with BGG playing times, plays outside each game's own bounds
+    playtimes_digest = None
+    if cache is not None and playtimes_fn is not None:
+        playtimes_digest = pnw_cache.file_digest(playtimes_fn)
+    def filter_plays():
+        all_plays, plays_key = stage('plays', [plays_digest], parse_plays)
+        progress.phase('filter', unit='plays')
+        playtimes = None
+        if playtimes_fn is not None:
+            playtimes = pnw.GamePlaytimes.from_json(playtimes_fn, *playtime_scales)
+        return pnw.filter_plays_columnar(all_plays, all_pnw_titles_by_id, duration_min, duration_max, playtimes)
+    (all_awardable_plays_by_game, removed_plays), filter_key = stage('filter',
+                                [plays_digest, games_key, duration_min, duration_max,
+                                 playtimes_digest, list(playtime_scales) if playtimes_fn is not None else None], filter_plays)
+
+    awardable_fn = os.path.join(log_dir, ".".join(['awardable',suffix,"tsv"]))
+    filtered_fn = os.path.join(log_dir, ".".join(['filtered',suffix,"tsv"]))
+    def write_plays_logs():
+        progress.phase('write logs')
+        # Output the awardable plays for later use
+        with open(awardable_fn,'w',newline='') as f:
             rows = list()
-            for play in awardable_plays:
-                for row in play.tsv_rows():
-                    row.append(game_id)
-                    rows.append(row)
-            writer.writerows(rows)
-
-    # Output the stuff filtered, just in case
-    filtered_fn = ".".join(['log/filtered',suffix,"tsv"])
-    with open(filtered_fn,'w',newline='') as f:
-        rows = list()
-        writer = csv.writer(f,delimiter='\t')
-        for reason,filtered_plays in removed_plays.items():
+            writer = csv.writer(f,delimiter='\t')
+            for game_id,awardable_plays in all_awardable_plays_by_game.items():
+                rows = list()
+                for play in awardable_plays:
+                    for row in play.tsv_rows():
+                        row.append(game_id)
+                        rows.append(row)
+                writer.writerows(rows)
+
+        # Output the stuff filtered, just in case
+        with open(filtered_fn,'w',newline='') as f:
             rows = list()
-            for play in filtered_plays:
-                for row in play.tsv_rows():
-                    row.append(reason)
-                    rows.append(row)
-            writer.writerows(rows)
+            writer = csv.writer(f,delimiter='\t')
+            for reason,filtered_plays in removed_plays.items():
+                rows = list()
+                for play in filtered_plays:
+                    for row in play.tsv_rows():
+                        row.append(reason)
+                        rows.append(row)
+                writer.writerows(rows)
+    output_stage('plays logs', filter_key, [awardable_fn, filtered_fn], write_plays_logs)
+
+    # Badges that already have the store's maximum wins this year can't win either
+    if draw_rules is not None and draw_rules.ineligible_ids:
+        extra_ineligible_players = list(extra_ineligible_players or [])+draw_rules.ineligible_players()
 
     # Get the starting ineligible players (like staff)
-    if ineligible_players_fn is not None:
-        ineligible_players = pnw.parse_ineligible_players(ineligible_players_fn)
+    def parse_ineligible():
+        if ineligible_players_fn is not None:
+            ineligible_players = pnw.parse_ineligible_players(ineligible_players_fn)
+        else:
+            logger.warning("No filename provided for ineligible players, everyone starts eligible")
+            ineligible_players = list()
+        if extra_ineligible_players is not None:
+            ineligible_players.extend(extra_ineligible_players)
+        return ineligible_players
+    ineligible_digest = None
+    if cache is not None and ineligible_players_fn is not None:
+        ineligible_digest = pnw_cache.file_digest(ineligible_players_fn)
+    extra_ids = sorted(p.player_id for p in extra_ineligible_players) if extra_ineligible_players is not None else None
+    ineligible_players, ineligible_key = stage('ineligible', [ineligible_digest, extra_ids], parse_ineligible)
+
+    # Begin to pick the winners (an unseeded draw is meant to differ every run, so it is never cached)
+    weight = draw_rules.weight if draw_rules is not None and draw_rules.weighted() else None
+    def draw():
+        return draw_winners(all_pnw_titles_by_id, all_awardable_plays_by_game, ineligible_players,
+                            pick_method, schedule, seed, progress, weight)
+    if seed is None:
+        all_wins, problem_plays = draw()
     else:
-        logger.warning("No filename provided for ineligible players, everyone starts eligible")
-        ineligible_players = list()
-    n_ineligible_players_initial = len(ineligible_players)
+        (all_wins, problem_plays), draw_key = stage('draw',
+                                [filter_key, games_key, ineligible_key, pick_method, schedule, seed,
+                                 draw_rules.key() if weight is not None else None], draw)
+
+    # Test the right number of games have been given away
+    n_prizes = sum(g.num_copies() for g in all_pnw_titles_by_id.values())
+    logger.info(f"We have {len(all_wins)} winners!")
+    if len(all_wins)!=n_prizes:
+        logger.error("Something may have gone wrong, not all games have been given away:")
+        logger.error(f"\t{len(all_wins)} prizes, but {n_prizes} were expected")
+
+    output_draw_results(all_wins, problem_plays, out_fn_prefix, suffix, progress)
+
+    # TEMP: output all the plays to TSV:
+    # output_problem_file('output/foo.tsv',all_plays)
+
+    logger.info(f"--- Done awarding games for file stamp {suffix}! ---")
+    return all_wins
+
+def draw_winners(all_pnw_titles_by_id, all_awardable_plays_by_game, ineligible_players,
+                    pick_method='old_school', schedule='random', seed=None, progress=None, weight=None):
+    """Award every P&W copy. ineligible_players is extended with the winners as they are drawn.
+        With a seed, the same inputs always give the same draw. A pnw_progress.Progress counts
+        the games as they are awarded. weight(player), if given, scales each player's chances
+        (see select_game_winners).
 
-    # Begin to pick the winners:
+    RETURNS:
+        (a list of Win objects in draw order, the plays of games that couldn't be fully awarded)
+    """
+    if seed is not None:
+        random.seed(seed)
+    n_ineligible_players_initial = len(ineligible_players)
     all_wins = list()
     n_prizes = sum(g.num_copies() for g in all_pnw_titles_by_id.values())
     logger.info(f"Beginning P&W giveaway for {n_prizes} game copies (after removing ineligibles) using the {pick_method} method:")
 
     # shuffle in place so the games are given away in random order, and give them away one at a time
+    # (or let the games with the fewest eligible players go first)
     awardable_game_ids = list(all_awardable_plays_by_game.keys())
+    if progress is not None:
+        progress.phase('draw', total=len(awardable_game_ids), unit='games')
 
-    random.shuffle(awardable_game_ids)
+    if schedule=='rarest_first' and pick_method=='max_coverage':
+        logger.warning("The max_coverage method awards every game at once, so the rarest_first schedule doesn't apply")
+    elif schedule=='rarest_first':
+        awardable_game_ids = rarest_first_schedule(all_awardable_plays_by_game, ineligible_players)
+    else:
+        random.shuffle(awardable_game_ids)
     problem_plays = list()
-    for game_id in awardable_game_ids:
+    if pick_method=='max_coverage':
+        # all games at once, so there is no game order to schedule
+        if weight is not None:
+            logger.warning("The max_coverage method doesn't weight players: every eligible player counts the same")
+        all_wins = pnw_matching.max_coverage_winners(all_pnw_titles_by_id, all_awardable_plays_by_game, problem_plays, ineligible_players)
+    else:
+        for game_id in awardable_game_ids:
             game = all_pnw_titles_by_id[game_id]
             plays = all_awardable_plays_by_game[game_id]
-            winners = select_game_winners(game,plays,problem_plays,ineligible_players,method=pick_method)
+            winners = select_game_winners(game,plays,problem_plays,ineligible_players,method=pick_method,weight=weight)
             all_wins.extend(winners)
-            logger.debug(f"...{len(all_wins)} games awarded so far, now {len(ineligible_players)-n_ineligible_players_initial} players removed from eligibility")
-
-    # Test the right number of games have been given away
-    logger.info(f"We have {len(all_wins)} winners!")
-    if len(all_wins)!=n_prizes:
-        logger.error("Something may have gone wrong, not all games have been given away:")
-        logger.error(f"\t{len(all_wins)} prizes, but {n_prizes} were expected")
+            if progress is not None:
+                progress.advance()
+            logger.debug("...%d games awarded so far, now %d players removed from eligibility",
+                            len(all_wins), len(ineligible_players)-n_ineligible_players_initial)
+    return all_wins, problem_plays
+
+def output_draw_results(all_wins, problem_plays, out_fn_prefix, suffix, progress=None):
+    """Write every output of a draw at once, each file in its own worker thread:
+        out_fn.[suffix].tsv (by winner), .pdf (labels, by game), .json (all results) and,
+        if there were problems, .unawarded.tsv
+
+    The two orderings come from one key per win, so all_wins itself is left in draw order.
+    Returns when the slowest writer (normally the labels) is done, re-raising its error if any.
+    A pnw_progress.Progress counts the files as they are finished.
+    """
+    keys = [(w.player.player_name, w.game.game_name) for w in all_wins]
+    by_player = [all_wins[i] for i in sorted(range(len(keys)), key=lambda i: keys[i])]
+    by_game = [all_wins[i] for i in sorted(range(len(keys)), key=lambda i: (keys[i][1], keys[i][0]))]
 
-    # Output the winners to TSV, sorted by winner
     out_fn = ".".join([out_fn_prefix,suffix,"tsv"])
-    logger.info(f"Outputting winners to file {out_fn}...")
-    all_wins.sort(key=lambda x: x.player.player_name)
-    pnw.output_winners(all_wins,out_fn)
-
-    # output the winners to labels, sorted by game
     labels_fn = ".".join([out_fn_prefix,suffix,"pdf"])
-    logger.info(f"Outputting winners to labels file {labels_fn}...")
-    all_wins.sort(key=lambda x: x.game.game_name)
-    pnw.output_winners_labels(all_wins,labels_fn)
-
-    # output the plays for problem games, if they exist
+    results_fn = ".".join([out_fn_prefix,suffix,"json"])
+    writers = [(f"winners to file {out_fn}", pnw.output_winners, (by_player,out_fn)),
+               (f"winners to labels file {labels_fn}", pnw.output_winners_labels, (by_game,labels_fn)),
+               (f"results to file {results_fn}", pnw.output_results_json, (all_wins,problem_plays,results_fn,suffix))]
     if len(problem_plays) > 0:
         problem_fn = ".".join([out_fn_prefix,suffix,"unawarded.tsv"])
-        logger.info(f"Some problem games were detected (dagnabbit!); outputting all plays for these games to file {out_fn}...")
-        pnw.output_problem_file(problem_fn,problem_plays)
-
-    # TEMP: output all the plays to TSV:
-    # output_problem_file('output/foo.tsv',all_plays)
+        logger.info(f"Some problem games were detected (dagnabbit!); outputting all plays for these games to file {problem_fn}...")
+        writers.append((f"problem plays to file {problem_fn}", pnw.output_problem_file, (problem_fn,problem_plays)))
+
+    if progress is not None:
+        progress.phase('output', total=len(writers), unit='files')
+    with ThreadPoolExecutor(max_workers=len(writers)) as pool:
+        futures = list()
+        for description,writer,args in writers:
+            logger.info(f"Outputting {description}...")
+            future = pool.submit(writer, *args)
+            if progress is not None:
+                future.add_done_callback(lambda future: progress.advance())
+            futures.append(future)
+        for future in futures:
+            future.result()
+
+def rarest_first_schedule(awardable_plays_by_game, ineligible_players):
+    """Yield game IDs so that the next game is always the one with the fewest eligible players left.
 
-    logger.info(f"--- Done awarding games for file stamp {suffix}! ---")
+    ARGUMENTS:
+        awardable_plays_by_game = a dict of GameCheckout lists keyed by game ID, as returned by filter_plays
+        ineligible_players = the running list of ineligible players that select_game_winners appends winners to
+
+    Each time the caller comes back for the next game, the players appended to ineligible_players
+    since the last game are the new winners. An inverted index from player to games means only
+    the games those winners played get their counts lowered; the priority queue handles the
+    decrease-key by pushing a new entry and skipping stale ones when they surface.
+    Ties are broken randomly, and the draw within each game is untouched.
+    """
+    ineligible_ids = set(p.player_id for p in ineligible_players)
+    games_by_player = defaultdict(set)
+    for game_id,plays in awardable_plays_by_game.items():
+        for play in plays:
+            for p in play.players:
+                if p.wants_to_win==True and p.player_id not in ineligible_ids:
+                    games_by_player[p.player_id].add(game_id)
+
+    n_eligible = defaultdict(int)
+    for player_id,game_ids in games_by_player.items():
+        for game_id in game_ids:
+            n_eligible[game_id] += 1
+
+    tiebreak = {game_id:random.random() for game_id in awardable_plays_by_game}
+    queue = [(n_eligible[game_id], tiebreak[game_id], game_id) for game_id in awardable_plays_by_game]
+    heapq.heapify(queue)
+    awarded = set()
+    n_seen = len(ineligible_players)
+
+    while queue:
+        count,t,game_id = heapq.heappop(queue)
+        if game_id in awarded or count != n_eligible[game_id]:
+            continue    # stale entry, the game was already awarded or its count went down
+        awarded.add(game_id)
+        yield game_id
+
+        # Whoever was just made ineligible can't win their other games any more.
+        for p in ineligible_players[n_seen:]:
+            if p.player_id in ineligible_ids:
+                continue
+            ineligible_ids.add(p.player_id)
+            for other_id in games_by_player.pop(p.player_id, ()):
+                if other_id not in awarded:
+                    n_eligible[other_id] -= 1
+                    heapq.heappush(queue, (n_eligible[other_id], tiebreak[other_id], other_id))
+        n_seen = len(ineligible_players)
+
+def _weighted_shuffle(players, weight):
+    """Shuffle players in place so that each entry comes before the others in proportion to its
+        weight(player) (the Efraimidis-Spirakis keys random()**(1/weight)). With every weight 1
+        this is a uniform shuffle.
+    """
+    players.sort(key=lambda p: random.random()**(1.0/weight(p)), reverse=True)
 
-def select_game_winners(game, plays, problem_plays, ineligible_players=None, method="old_school"):
+def select_game_winners(game, plays, problem_plays, ineligible_players=None, method="old_school", weight=None):
     """Select all the winners of a given game.
 
     ARGUMENTS:
@@ -220,6 +463,8 @@ def select_game_winners(game, plays, problem_plays, ineligible_players=None, met
         problem_plays = a running list of plays for games that had problems with awarding
         ineligible_players = a list of (typically) previous winners, maybe staff (theoretically should be a set?)
         method = "standard" (pick N players randomly) or "old_school" (pick a play, then pick a player)
+        weight = None, or a function giving each Player's weight in (0, 1] (e.g. pnw_winners_db.DrawRules.weight):
+                 a player's chance of being picked from a play, or of coming first in the shuffled entries, is scaled by it
 
     RETURNS:
         a list of winners for the game object, or an empty list if it had no plays
@@ -243,23 +488,25 @@ def select_game_winners(game, plays, problem_plays, ineligible_players=None, met
     n_total_plays = len(this_game_plays)
     eligible_players = [p for p in this_game_players if (p.wants_to_win==True and p not in ineligible_players)]
     eligible_players_unique = set(eligible_players)
-    logger.debug(f"Game {game.game_name}, with {game.num_copies()} copies, has {n_total_plays} plays "+
-                    f"and {n_total_players} non-unique players, {len(eligible_players_unique)} unique players still eligible")
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("Game %s, with %d copies, has %d plays and %d non-unique players, %d unique players still eligible",
+                        game.game_name, game.num_copies(), n_total_plays, n_total_players, len(eligible_players_unique))
 
     winners = list()
     copies_to_award = game.copy_ids()
 
     # Error checking: make sure the game has copies to award
     if len(copies_to_award)==0:
-        logger.warning(f"Why are you trying to award this game? Game {game.game_name}, ID {game.game_id}) had no copies to award!")
+        logger.warning("Why are you trying to award this game? Game %s, ID %s) had no copies to award!", game.game_name, game.game_id)
         problem_flag = True
         return list()
 
     # In the edge case where there are more copies than players, they should all get a copy!
     elif len(copies_to_award) >= len(eligible_players_unique):
-        logger.warning(f"This is embarrassing: Game {game.game_name}, with {game.num_copies()} copies, had {len(eligible_players_unique)} eligible players, so some may go unclaimed!")
+        logger.warning("This is embarrassing: Game %s, with %d copies, had %d eligible players, so some may go unclaimed!",
+                        game.game_name, game.num_copies(), len(eligible_players_unique))
         copies_to_award = copies_to_award[:len(eligible_players_unique)]
-        winners = list(eligible_players_unique)
+        winners = list(dict.fromkeys(eligible_players))     # in order of first play: a set's order changes with PYTHONHASHSEED
         ineligible_players.extend(winners)
         problem_flag = True
 
@@ -270,7 +517,10 @@ def select_game_winners(game, plays, problem_plays, ineligible_players=None, met
         Once an eligible player is found, add them to the winner list,
         then remove them from further consideration, even if they have more plays for this game
         """
-        random.shuffle(eligible_players)            # careful not to use 'unique' here: more plays means more chances
+        if weight is None:
+            random.shuffle(eligible_players)        # careful not to use 'unique' here: more plays means more chances
+        else:
+            _weighted_shuffle(eligible_players, weight)
         problem_flag = True                         # set to false when exit is successful
         for player in eligible_players:
             if player not in ineligible_players:
@@ -292,7 +542,10 @@ def select_game_winners(game, plays, problem_plays, ineligible_players=None, met
             this_play_eligible = [p for p in play.players if (p.wants_to_win==True and p not in ineligible_players)] # should filter before but just in case
 
             if len(this_play_eligible)>0:
-                winner = random.choice(this_play_eligible)
+                if weight is None:
+                    winner = random.choice(this_play_eligible)
+                else:
+                    winner = random.choices(this_play_eligible, weights=[weight(p) for p in this_play_eligible])[0]
                 winners.append(winner)
                 ineligible_players.append(winner)
 
@@ -304,15 +557,19 @@ def select_game_winners(game, plays, problem_plays, ineligible_players=None, met
         # In that case, revert to the 'standard' method
         # Temporary location; refactor this probably so we do it only in one place
         if problem_flag==True:
-            logger.warning(f"Old School method awarded only {len(winners)} of {game.num_copies()} copies of Game {game.game_name}, trying with standard method...")
-            random.shuffle(eligible_players)            # careful not to use 'unique' here: more plays means more chances
+            logger.warning("Old School method awarded only %d of %d copies of Game %s, trying with standard method...",
+                            len(winners), game.num_copies(), game.game_name)
+            if weight is None:
+                random.shuffle(eligible_players)        # careful not to use 'unique' here: more plays means more chances
+            else:
+                _weighted_shuffle(eligible_players, weight)
             for player in eligible_players:
                 if player not in ineligible_players:
                     winners.append(player)
                     ineligible_players.append(player)
                 if len(winners)==len(copies_to_award):  # you've found enough, now stop
                     problem_flag = False
-                    logger.warning(f"...success, the standard method rectified the Old School problem")
+                    logger.warning("...success, the standard method rectified the Old School problem")
                     break
 
 
@@ -338,7 +595,8 @@ def select_game_winners(game, plays, problem_plays, ineligible_players=None, met
     return wins
 
 
-@Gooey
+@Gooey(progress_regex=pnw_progress.progress_regex, progress_expr=pnw_progress.progress_expr,
+        timing_options={'show_time_remaining': True, 'hide_time_remaining_on_complete': True})
 def main():
     p = argparse.ArgumentParser(description='Play & Win Prize Picker')
     p.add_argument('output_fn_prefix', action="store",
@@ -351,15 +609,43 @@ def main():
                     help="local json source of game checkouts and players, if --local is set")
     p.add_argument('--ineligible_players_fn', action="store", default=None,
                     help="a tsv file with ID,Player Name of all ineligible players (such as staff)")
-    p.add_argument('--method', action="store", choices=['standard', 'old_school'],
-                    help="standard (weighted by plays) or old_school (choose play then player)")
+    p.add_argument('--method', action="store", choices=['standard', 'old_school', 'max_coverage'],
+                    help="standard (weighted by plays), old_school (choose play then player), or max_coverage (award every copy that can possibly be awarded)")
     p.add_argument('--duration_min', action="store", default=None, type=float,
                     help="minimum duration (minutes) for a play to count")
     p.add_argument('--duration_max', action="store", default=None, type=float,
                     help="maximum duration (minutes) for a play to count")
+    p.add_argument('--playtimes_fn', action="store", default=None,
+                    help="bgg-playtimes.json: also bound each game's plays by its own BGG playing time")
+    p.add_argument('--playtime_scales', action="store", default=[0.5, 3.0], type=float, nargs=2, metavar=('MIN_SCALE','MAX_SCALE'),
+                    help="a play counts from MIN_SCALE x the BGG minimum time to MAX_SCALE x the maximum, default 0.5 3")
+    p.add_argument('--schedule', action="store", choices=['random', 'rarest_first'], default='random',
+                    help="award games in random order, or rarest_first (fewest eligible players left goes next)")
+    p.add_argument('--refresh_games', action="store_true", default=False,
+                    help="download the games list even if the local HTTP cache has a current copy")
+    p.add_argument('--page_size', action="store", default=None, type=int,
+                    help="fetch plays in pages of this many plays, several at a time (default: one request)")
+    p.add_argument('--seed', action="store", default=None, type=int,
+                    help="seed for the draw: the same inputs and seed always give the same winners")
+    p.add_argument('--no_cache', action="store_false", dest="use_cache", default=True,
+                    help="recompute every stage instead of reusing unchanged results from the stage cache")
+    p.add_argument('--winners_db', action="store", default=None,
+                    help="prior winners store (pnw_winners_db.py) for --max_wins and --prior_weight")
+    p.add_argument('--year', action="store", default=datetime.date.today().year, type=int,
+                    help="the year of this draw, for the prior winners store (default: this year)")
+    p.add_argument('--max_wins', action="store", default=None, type=int,
+                    help="with --winners_db, a badge that already won this many times this year can't win")
+    p.add_argument('--prior_weight', action="store", default=None, type=float,
+                    help="with --winners_db, last year's winners (by name) are drawn with this weight, e.g. 0.5")
+    p.add_argument('--memory_mb', action="store", default=None, type=float,
+                    help="with --local, draw out of core in about this many megabytes (for huge snapshots; see pnw_ooc.py)")
+    p.add_argument('--no_debug_log', action="store_false", dest="debug_log", default=True,
+                    help="skip the per-game debug messages (log/pnw-picker.debug.log gets info and up only)")
 
 
     args = p.parse_args()
+    if not args.debug_log:
+        logger.setLevel(logging.INFO)
 
     # change duration to seconds
     if args.duration_min is not None:
@@ -367,15 +653,34 @@ def main():
     if args.duration_max is not None:
         args.duration_max *= 60.0
 
-    pick_all_winners(out_fn_prefix=args.output_fn_prefix,
+    draw_rules = None
+    if args.winners_db is not None:
+        draw_rules = pnw_winners_db.DrawRules(pnw_winners_db.WinnersDB(args.winners_db), args.year,
+                                              max_wins=args.max_wins, prior_weight=args.prior_weight)
+    elif args.max_wins is not None or args.prior_weight is not None:
+        p.error("--max_wins and --prior_weight need a --winners_db")
+
+    # run in the background, so the progress can be reported (to the GUI's progress bar, or as a status line)
+    job = pnw_progress.Job(pick_all_winners,
+                    out_fn_prefix=args.output_fn_prefix,
                     local_source=args.is_local,
                     all_plays_source=args.plays_source,
                     all_game_copies_source=args.games_source,
                     ineligible_players_fn=args.ineligible_players_fn,
                     pick_method = args.method,
                     duration_min = args.duration_min,
-                    duration_max = args.duration_max
+                    duration_max = args.duration_max,
+                    playtimes_fn = args.playtimes_fn,
+                    playtime_scales = args.playtime_scales,
+                    schedule = args.schedule,
+                    refresh_games = args.refresh_games,
+                    page_size = args.page_size,
+                    seed = args.seed,
+                    use_cache = args.use_cache,
+                    draw_rules = draw_rules,
+                    memory_budget = int(args.memory_mb*2**20) if args.memory_mb is not None else None
                     )
+    job.start().wait(pnw_progress.default_reporter())
 
 if __name__ == '__main__':
     main()
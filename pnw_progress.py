@@ -0,0 +1,172 @@
+"""Progress of a long picker run, and running it in the background so it can be reported.
+
+The pipeline calls Progress.phase() as it moves from one phase to the next (fetch, parse, filter,
+draw, output) and Progress.advance() as it finishes items within one (pages, games, files).
+A Job runs the pipeline in a background thread while the calling thread reports snapshots of
+the progress every interval: as a one-line status on a terminal (StatusLine) or, on a pipe, as
+lines like
+
+    progress: draw 412/855 games (48%) 205.3/s eta 0:00:02
+
+which the GUI's progress bar reads with progress_regex.
+"""
+import sys
+import threading
+import time
+from datetime import timedelta
+
+# Gooey(progress_regex=..., progress_expr=...) to drive its progress bar from format_line()
+progress_regex = r"^progress: .* \((?P<percent>\d+)%\)"
+progress_expr = "percent"
+
+class Progress(object):
+    """The current phase of a run and how far through it the run is. Safe to update from several
+        threads (e.g. page fetches) at once.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.phase_name = None
+        self.unit = None
+        self.done = 0
+        self.total = None
+        self.phase_start = None
+
+    def phase(self, name, total=None, unit=None):
+        """Start a phase of total items (None if not known up front)."""
+        with self._lock:
+            self.phase_name = name
+            self.unit = unit
+            self.done = 0
+            self.total = total
+            self.phase_start = time.time()
+
+    def set_total(self, total):
+        with self._lock:
+            self.total = total
+
+    def advance(self, n=1):
+        with self._lock:
+            self.done += n
+
+    def snapshot(self):
+        """RETURNS: a dict of phase, unit, done, total, elapsed (seconds in this phase),
+            rate (items per second so far) and eta (seconds left at that rate, or None)
+        """
+        with self._lock:
+            elapsed = time.time()-self.phase_start if self.phase_start is not None else 0.0
+            rate = self.done/elapsed if elapsed > 0 else None
+            eta = None
+            if self.total is not None and rate:
+                eta = max(self.total-self.done, 0)/rate
+            return dict(phase=self.phase_name, unit=self.unit, done=self.done, total=self.total,
+                        elapsed=elapsed, rate=rate, eta=eta)
+
+def format_status(snapshot):
+    """e.g. 'draw 412/855 games (48%) 205.3/s eta 0:00:02', or 'parse plays 0:00:03' while a
+        phase has nothing to count.
+    """
+    if snapshot['phase'] is None:
+        return 'starting'
+    parts = [snapshot['phase']]
+    unit = f" {snapshot['unit']}" if snapshot['unit'] else ''
+    if snapshot['total']:
+        percent = min(100, int(100*snapshot['done']/snapshot['total']))
+        parts.append(f"{snapshot['done']}/{snapshot['total']}{unit} ({percent}%)")
+    elif snapshot['done']:
+        parts.append(f"{snapshot['done']}{unit}")
+    if snapshot['done'] and snapshot['rate']:
+        parts.append(f"{snapshot['rate']:.1f}/s")
+    if snapshot['eta'] is not None:
+        parts.append(f"eta {timedelta(seconds=round(snapshot['eta']))}")
+    else:
+        parts.append(str(timedelta(seconds=round(snapshot['elapsed']))))
+    return ' '.join(parts)
+
+def format_line(snapshot):
+    return 'progress: '+format_status(snapshot)
+
+class StatusLine(object):
+    """Reports snapshots on one line of a terminal, rewritten in place. The cursor is left at the
+        start of the line, so a log message printed meanwhile simply writes over the status.
+    """
+    def __init__(self, stream=None):
+        self.stream = stream if stream is not None else sys.stderr
+        self._width = 0
+
+    def __call__(self, snapshot):
+        line = format_status(snapshot)
+        self.stream.write(line.ljust(self._width)+'\r')
+        self.stream.flush()
+        self._width = len(line)
+
+    def close(self):
+        if self._width:
+            self.stream.write('\r'+' '*self._width+'\r')
+            self.stream.flush()
+            self._width = 0
+
+class ProgressLines(object):
+    """Reports snapshots as 'progress: ...' lines (for the GUI), skipping repeats."""
+    def __init__(self, stream=None):
+        self.stream = stream if stream is not None else sys.stdout
+        self._last = None
+
+    def __call__(self, snapshot):
+        line = format_line(snapshot)
+        if line != self._last:
+            print(line, file=self.stream, flush=True)
+            self._last = line
+
+    def close(self):
+        pass
+
+def default_reporter():
+    """A StatusLine on stderr (next to the log) when it's a terminal, otherwise ProgressLines on
+        stdout (e.g. when the GUI is reading it).
+    """
+    if sys.stderr.isatty():
+        return StatusLine(sys.stderr)
+    return ProgressLines(sys.stdout)
+
+class Job(object):
+    """Runs fn(*args, progress=<a Progress>, **kwargs) in a background thread."""
+    def __init__(self, fn, *args, **kwargs):
+        self.progress = Progress()
+        self._fn = fn
+        self._args = args
+        self._kwargs = dict(kwargs, progress=self.progress)
+        self._result = None
+        self._error = None
+        # a daemon, so an interrupted run (Ctrl-C in the calling thread) doesn't keep the process alive
+        self._thread = threading.Thread(target=self._run, name='pnw-job', daemon=True)
+
+    def _run(self):
+        try:
+            self._result = self._fn(*self._args, **self._kwargs)
+        except BaseException as err:
+            self._error = err
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def done(self):
+        return not self._thread.is_alive()
+
+    def wait(self, report=None, interval=1.0):
+        """Block until the job ends, calling report(snapshot) every interval seconds meanwhile.
+            RETURNS: fn's result (re-raising its exception, if it raised one)
+        """
+        try:
+            while True:
+                self._thread.join(interval)
+                if not self._thread.is_alive():
+                    break
+                if report is not None:
+                    report(self.progress.snapshot())
+        finally:
+            if report is not None and hasattr(report, 'close'):
+                report.close()
+        if self._error is not None:
+            raise self._error
+        return self._result
@@ -0,0 +1,375 @@
+"""Local stand-in for the library API, for offline tests and fetch benchmarks.
+
+    python pnw_replay.py record data/games.replay.json data/plays.replay.json --url library.geekway.com
+    python pnw_replay.py serve data/games.replay.json data/plays.replay.json --latency_ms 80 --bandwidth_kbps 4000 --chunked
+
+Serves recorded games and plays payloads (any api/games and api/plays JSON, e.g. the picker's
+data/*.json snapshots or create_mock_plays.py output) and a fake Auth0 token endpoint:
+
+    POST /oauth/token         {"access_token": ...} for any credentials
+    GET  <any path>/games     the games payload, with an ETag (answers 304 to If-None-Match)
+    GET  <any path>/plays     the plays payload, or a page of it with ?offset=N&limit=M
+
+Point the client at it with url='http://127.0.0.1:8323' (pnw_api.connect) and
+auth_url='http://127.0.0.1:8323'. The network can be shaped: a delay before every response,
+a bandwidth cap, chunked transfer encoding, and failures injected at a given rate, either as
+503s or as connections dropped halfway through the body. Failures are drawn from a seeded
+random stream, so a run is repeatable.
+
+It also stands in for BGG's XML API (serve-bgg), from recorded thing XML (the <item>s of any
+thing?id=... responses, concatenated under one <items>):
+
+    GET  <any path>/search?query=Q&type=boardgame[&exact=1]   items whose names match Q
+    GET  <any path>/thing?id=1,2,...                          the recorded items for those IDs
+
+Names are compared by pnw.normalize_name: equal for exact=1, containing Q otherwise. The
+first request for each thing query can be answered 202 (queued), as BGG does.
+"""
+import argparse
+import hashlib
+import json
+import logging
+import random
+import socket
+import threading
+import time
+import xml.etree.ElementTree as ET
+from collections import Counter, OrderedDict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qs
+from xml.sax.saxutils import quoteattr
+
+import pnw
+import pnw_api
+
+logger = logging.getLogger(__name__)
+
+class Fixture(object):
+    """The recorded payloads. Plays pages are sliced from the parsed plays and kept for reuse."""
+    def __init__(self, games_body, plays_body, max_pages=256):
+        self.games_body = games_body
+        self.plays_body = plays_body
+        self.games_etag = '"%s"' % hashlib.sha256(games_body).hexdigest()[:32]
+        self.max_pages = max_pages
+        self._plays = None
+        self._pages = OrderedDict()
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_files(cls, games_fn, plays_fn):
+        with open(games_fn,'rb') as f:
+            games_body = f.read()
+        with open(plays_fn,'rb') as f:
+            plays_body = f.read()
+        return cls(games_body, plays_body)
+
+    def plays_page(self, offset, limit):
+        with self._lock:
+            if (offset,limit) in self._pages:
+                self._pages.move_to_end((offset,limit))
+                return self._pages[(offset,limit)]
+            if self._plays is None:
+                self._plays = json.loads(self.plays_body)['Result']['Plays']
+            body = json.dumps(dict(Errors=[], Result=dict(Plays=self._plays[offset:offset+limit]))).encode('utf-8')
+            self._pages[(offset,limit)] = body
+            if len(self._pages) > self.max_pages:
+                self._pages.popitem(last=False)
+            return body
+
+class Shaping(object):
+    """How the stand-in network behaves.
+        - latency: seconds before each response starts (token and API requests)
+        - bandwidth: bytes per second per response (None: as fast as possible)
+        - chunk_size: send bodies with chunked transfer encoding in pieces of this size (None: Content-Length)
+        - failure_rate: the chance that an API GET fails
+        - failure: 'status' (a 503), 'reset' (drop the connection halfway through the body) or 'mixed'
+    """
+    def __init__(self, latency=0.0, bandwidth=None, chunk_size=None, failure_rate=0.0, failure='status', seed=0):
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.chunk_size = chunk_size
+        self.failure_rate = failure_rate
+        self.failure = failure
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def draw_failure(self):
+        """None, or the failure to inject into this request."""
+        with self._lock:
+            if self.failure_rate <= 0 or self._rng.random() >= self.failure_rate:
+                return None
+            if self.failure=='mixed':
+                return self._rng.choice(['status','reset'])
+            return self.failure
+
+class ReplayServer(ThreadingHTTPServer):
+    """Serves a Fixture through a Shaping; counts requests by kind in self.counts."""
+    daemon_threads = True
+
+    def __init__(self, address, fixture, shaping=None, token='replay-token'):
+        self.fixture = fixture
+        self.shaping = shaping if shaping is not None else Shaping()
+        self.token = token
+        self.counts = Counter()
+        self._counts_lock = threading.Lock()
+        super().__init__(address, ReplayRequestHandler)
+
+    def url(self):
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def count(self, kind):
+        with self._counts_lock:
+            self.counts[kind] += 1
+
+class BGGFixture(object):
+    """Recorded BGG thing items, by BGG ID, with their names for searches."""
+    def __init__(self, items_xml):
+        self.items = OrderedDict()
+        self.names = dict()
+        for item in ET.fromstring(items_xml).iter('item'):
+            bgg_id = int(item.get('id'))
+            self.items[bgg_id] = ET.tostring(item, encoding='unicode')
+            self.names[bgg_id] = [(name.get('type'), name.get('value')) for name in item.iter('name')]
+
+    @classmethod
+    def from_file(cls, items_fn):
+        with open(items_fn,'rb') as f:
+            return cls(f.read())
+
+    def search_body(self, query, exact):
+        query = pnw.normalize_name(query)
+        found = list()
+        for bgg_id,names in self.names.items():
+            for kind,name in names:
+                normalized = pnw.normalize_name(name)
+                if normalized==query if exact else query in normalized:
+                    found.append(f'<item type="boardgame" id="{bgg_id}"><name type="{kind}" value={quoteattr(name)}/></item>')
+                    break
+        return ('<?xml version="1.0" encoding="utf-8"?><items total="%d" termsofuse="https://boardgamegeek.com/xmlapi/termsofuse">%s</items>'
+                % (len(found), ''.join(found))).encode('utf-8')
+
+    def things_body(self, bgg_ids):
+        items = ''.join(self.items[i] for i in bgg_ids if i in self.items)
+        return ('<?xml version="1.0" encoding="utf-8"?><items termsofuse="https://boardgamegeek.com/xmlapi/termsofuse">%s</items>'
+                % items).encode('utf-8')
+
+class BGGReplayServer(ThreadingHTTPServer):
+    """Serves a BGGFixture; counts requests by kind ('search', 'thing', 'queued') in self.counts.
+        queue_first: answer the first request for each thing query with a 202
+    """
+    daemon_threads = True
+
+    def __init__(self, address, fixture, shaping=None, queue_first=False):
+        self.fixture = fixture
+        self.shaping = shaping if shaping is not None else Shaping()
+        self.queue_first = queue_first
+        self.counts = Counter()
+        self._seen = set()
+        self._counts_lock = threading.Lock()
+        super().__init__(address, BGGReplayRequestHandler)
+
+    url = ReplayServer.url
+    count = ReplayServer.count
+
+    def first_time(self, query):
+        with self._counts_lock:
+            if query in self._seen:
+                return False
+            self._seen.add(query)
+            return True
+
+class ReplayRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        if urlsplit(self.path).path != '/oauth/token':
+            self._send_plain(404, b'not found')
+            return
+        time.sleep(self.server.shaping.latency)
+        self.server.count('token')
+        body = json.dumps(dict(access_token=self.server.token, token_type='Bearer', expires_in=86400)).encode('utf-8')
+        self._send(200, body)
+
+    def do_GET(self):
+        shaping = self.server.shaping
+        parts = urlsplit(self.path)
+        resource = parts.path.rstrip('/').rsplit('/',1)[-1]
+        if resource not in ('games','plays'):
+            self._send_plain(404, b'use .../games or .../plays')
+            return
+        if self.headers.get('Authorization') != 'Bearer '+self.server.token:
+            self._send_plain(401, b'unauthorized')
+            return
+
+        time.sleep(shaping.latency)
+        failure = shaping.draw_failure()
+        if failure=='status':
+            self.server.count('failed')
+            self._send_plain(503, b'injected failure')
+            return
+
+        headers = dict()
+        if resource=='games':
+            fixture = self.server.fixture
+            if self.headers.get('If-None-Match')==fixture.games_etag:
+                self.server.count('games_304')
+                self.send_response(304)
+                self.send_header('ETag', fixture.games_etag)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            self.server.count('games')
+            body = fixture.games_body
+            headers['ETag'] = fixture.games_etag
+        else:
+            query = parse_qs(parts.query)
+            if 'offset' in query or 'limit' in query:
+                self.server.count('plays_page')
+                offset = int(query.get('offset',['0'])[0])
+                limit = int(query.get('limit',['1000000000'])[0])
+                body = self.server.fixture.plays_page(offset, limit)
+            else:
+                self.server.count('plays')
+                body = self.server.fixture.plays_body
+        self._send(200, body, headers, reset=(failure=='reset'))
+
+    def _send_plain(self, status, body):
+        self._send(status, body, {'Content-Type': 'text/plain'})
+
+    def _send(self, status, body, headers=None, reset=False):
+        shaping = self.server.shaping
+        self.send_response(status)
+        for name,value in (headers or {}).items():
+            self.send_header(name, value)
+        if 'Content-Type' not in (headers or {}):
+            self.send_header('Content-Type', 'application/json; charset=utf-8')
+        chunked = shaping.chunk_size is not None
+        if chunked:
+            self.send_header('Transfer-Encoding', 'chunked')
+        else:
+            self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+
+        if reset:
+            self.server.count('failed')
+            body = body[:len(body)//2]
+        piece = shaping.chunk_size or 64*1024
+        for start in range(0, len(body), piece):
+            data = body[start:start+piece]
+            if chunked:
+                self.wfile.write(b'%x\r\n%s\r\n' % (len(data), data))
+            else:
+                self.wfile.write(data)
+            if shaping.bandwidth:
+                time.sleep(len(data)/shaping.bandwidth)
+        if reset:
+            # drop the connection without finishing the body
+            self.wfile.flush()
+            self.connection.shutdown(socket.SHUT_RDWR)
+            self.close_connection = True
+            return
+        if chunked:
+            self.wfile.write(b'0\r\n\r\n')
+
+    def log_message(self, format, *args):
+        logger.debug(format % args)
+
+class BGGReplayRequestHandler(ReplayRequestHandler):
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        self._send_plain(404, b'not found')
+
+    def do_GET(self):
+        shaping = self.server.shaping
+        parts = urlsplit(self.path)
+        resource = parts.path.rstrip('/').rsplit('/',1)[-1]
+        query = parse_qs(parts.query)
+        if resource not in ('search','thing'):
+            self._send_plain(404, b'use .../search or .../thing')
+            return
+
+        time.sleep(shaping.latency)
+        if shaping.draw_failure() is not None:
+            self.server.count('failed')
+            self._send_plain(429, b'rate limited')
+            return
+        if resource=='search':
+            self.server.count('search')
+            body = self.server.fixture.search_body(query.get('query',[''])[0], query.get('exact',['0'])[0]=='1')
+        else:
+            if self.server.queue_first and self.server.first_time(parts.query):
+                self.server.count('queued')
+                self._send_plain(202, b'queued')
+                return
+            self.server.count('thing')
+            body = self.server.fixture.things_body(int(i) for i in query.get('id',[''])[0].split(',') if i)
+        self._send(200, body, {'Content-Type': 'text/xml; charset=utf-8'})
+
+def record(games_fn, plays_fn, url, sub_endpoint=None, auth_url=None):
+    """Save the live API's games and plays payloads, byte for byte, as a replay fixture."""
+    access_token = json.loads(pnw_api.get_auth(auth_url))['access_token']
+    for resource,out_fn in (('games',games_fn), ('plays',plays_fn)):
+        payload = pnw_api.get_api_resource(access_token, resource, url, sub_endpoint)
+        with open(out_fn,'w',newline='',encoding='utf-8') as f:
+            f.write(payload)
+        logger.info(f"Recorded {resource} ({len(payload)} characters) to {out_fn}")
+
+def main():
+    p = argparse.ArgumentParser(description='Play & Win API record and replay')
+    sub = p.add_subparsers(dest='command', required=True)
+    r = sub.add_parser('record', help="save the live games and plays payloads")
+    r.add_argument('games_fn')
+    r.add_argument('plays_fn')
+    r.add_argument('--url', default='library.geekway.com', help="API host")
+    r.add_argument('--sub_endpoint', default=None, help="collection path (default pnw_api.default_sub_endpoint)")
+    s = sub.add_parser('serve', help="serve recorded payloads")
+    s.add_argument('games_fn')
+    s.add_argument('plays_fn')
+    s.add_argument('--host', default='127.0.0.1')
+    s.add_argument('--port', default=8323, type=int, help="0 picks a free port")
+    s.add_argument('--latency_ms', default=0.0, type=float, help="delay before every response")
+    s.add_argument('--bandwidth_kbps', default=None, type=float, help="cap each response at this many kilobytes per second")
+    s.add_argument('--chunked', default=None, type=int, nargs='?', const=16*1024, metavar='CHUNK_SIZE',
+                    help="use chunked transfer encoding (default chunks of 16384 bytes)")
+    s.add_argument('--failure_rate', default=0.0, type=float, help="chance that an API GET fails")
+    s.add_argument('--failure', choices=['status','reset','mixed'], default='status',
+                    help="inject failures as 503s, dropped connections, or both")
+    s.add_argument('--seed', default=0, type=int, help="seed for the injected failures")
+    b = sub.add_parser('serve-bgg', help="serve recorded BGG thing XML")
+    b.add_argument('items_fn', help="XML of recorded thing <item>s")
+    b.add_argument('--host', default='127.0.0.1')
+    b.add_argument('--port', default=8324, type=int, help="0 picks a free port")
+    b.add_argument('--latency_ms', default=0.0, type=float, help="delay before every response")
+    b.add_argument('--failure_rate', default=0.0, type=float, help="chance that a GET is answered 429")
+    b.add_argument('--queue_first', action="store_true", default=False, help="answer each new thing query with a 202 first")
+    b.add_argument('--seed', default=0, type=int, help="seed for the injected failures")
+    args = p.parse_args()
+    logging.basicConfig(level=logging.INFO, format='[%(levelname)10s] :\t %(message)s')
+
+    if args.command=='record':
+        record(args.games_fn, args.plays_fn, args.url, args.sub_endpoint)
+        return
+
+    if args.command=='serve-bgg':
+        shaping = Shaping(latency=args.latency_ms/1000.0, failure_rate=args.failure_rate, seed=args.seed)
+        server = BGGReplayServer((args.host, args.port), BGGFixture.from_file(args.items_fn), shaping, args.queue_first)
+    else:
+        shaping = Shaping(latency=args.latency_ms/1000.0,
+                        bandwidth=args.bandwidth_kbps*1000.0 if args.bandwidth_kbps else None,
+                        chunk_size=args.chunked, failure_rate=args.failure_rate,
+                        failure=args.failure, seed=args.seed)
+        server = ReplayServer((args.host, args.port), Fixture.from_files(args.games_fn, args.plays_fn), shaping)
+    # the first line on stdout is the address, for scripts that start the server on port 0
+    print(f"Serving on {server.url()}", flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        logger.info(f"Requests: {dict(server.counts)}")
+        server.server_close()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,336 @@
+import argparse
+import csv
+import json
+import logging
+import os
+from collections import OrderedDict, defaultdict
+import numpy as np
+
+import pnw
+
+logger = logging.getLogger(__name__)
+
+class GameUtilization(object):
+    """How heavily the copies of a single game were used over the con.
+        Contains:
+            - game: the Game object from the games snapshot
+            - n_checkouts: number of checkouts with a positive duration
+            - peak: most copies checked out at the same time
+            - average: mean copies checked out, over the whole con
+            - seconds_at_full: time with every copy checked out (or more, if the data disagrees);
+              always 0 for a game with no copies, which has the status 'no copies' instead
+            - fraction_at_full: seconds_at_full as a fraction of the con
+    """
+
+    _header_row = ['Game_ID','Game_Name','Copies','Checkouts','Peak_Concurrent','Avg_Concurrent',
+                    'Hours_At_Full','Fraction_At_Full','Spare_Copies_At_Peak','Status']
+
+    def __init__(self, game, n_checkouts=0, peak=0, average=0.0, seconds_at_full=0.0, fraction_at_full=0.0):
+        self.game = game
+        self.n_checkouts = n_checkouts
+        self.peak = peak
+        self.average = average
+        self.seconds_at_full = seconds_at_full
+        self.fraction_at_full = fraction_at_full
+
+    def spare_copies(self):
+        """Copies that sat on the shelf even at the busiest moment."""
+        return self.game.num_copies() - self.peak
+
+    def status(self, understocked_fraction=0.1):
+        if self.game.num_copies()==0:
+            return 'no copies'
+        elif self.fraction_at_full >= understocked_fraction:
+            return 'understocked'
+        elif self.spare_copies() > 0:
+            return 'overstocked'
+        return 'ok'
+
+    def tsv_row(self, understocked_fraction=0.1):
+        return [self.game.game_id, self.game.game_name, self.game.num_copies(), self.n_checkouts,
+                self.peak, round(self.average,3), round(self.seconds_at_full/3600.0,2),
+                round(self.fraction_at_full,4), self.spare_copies(), self.status(understocked_fraction)]
+
+def checkout_arrays(all_plays):
+    """Return (game_id, time_out, time_in) int64 arrays for a list of GameCheckout objects.
+        Times are epoch seconds, so a ColumnarPlays snapshot can be used in place of this.
+    """
+    game_id = np.fromiter((p.game.game_id for p in all_plays), dtype=np.int64, count=len(all_plays))
+    time_out = np.fromiter((pnw._epoch_seconds(p.time_out) for p in all_plays), dtype=np.int64, count=len(all_plays))
+    time_in = np.fromiter((pnw._epoch_seconds(p.time_in) for p in all_plays), dtype=np.int64, count=len(all_plays))
+    return game_id, time_out, time_in
+
+def copy_utilization(all_games, game_id, time_out, time_in):
+    """Peak and average concurrent checkouts, and time at full utilization, for every game.
+
+        ARGUMENTS:
+            all_games - a list of Game objects, as returned by parse_games_json (all copies count)
+            game_id, time_out, time_in - parallel arrays, one entry per checkout (see checkout_arrays)
+
+        All games are handled in one O(n log n) sweep: the check-out/check-in events are sorted
+        once by (game, time, check-ins first), and the per-game running counts, peaks and
+        time-weighted sums come from cumulative sums and bincounts over that order.
+
+        RETURNS:
+            A list of GameUtilization objects, most understocked first and most overstocked last,
+            then any games with no copies (checked out anyway, if the data disagrees).
+    """
+    game_index = {g.game_id:i for i,g in enumerate(all_games)}
+    n_games = len(all_games)
+    copies = np.array([g.num_copies() for g in all_games], dtype=np.int64)
+
+    game_id = np.asarray(game_id, dtype=np.int64)
+    time_out = np.asarray(time_out, dtype=np.int64)
+    time_in = np.asarray(time_in, dtype=np.int64)
+
+    # Zero-length checkouts (no check-in time) never tie up a copy.
+    known = np.fromiter((g in game_index for g in game_id), dtype=bool, count=len(game_id))
+    if (~known).any():
+        logger.warning(f"Skipping {int((~known).sum())} checkouts of games not in the games snapshot")
+    keep = known & (time_in > time_out)
+    g = np.fromiter((game_index[x] for x in game_id[keep]), dtype=np.int64, count=int(keep.sum()))
+    time_out, time_in = time_out[keep], time_in[keep]
+
+    utilization = [GameUtilization(game) for game in all_games]
+    if len(g)==0:
+        return utilization
+    window = float(time_in.max() - time_out.min())
+
+    # One sorted event list: (game, time, delta), check-ins (-1) before check-outs (+1) at equal times.
+    n = len(g)
+    ev_game = np.concatenate([g, g])
+    ev_time = np.concatenate([time_out, time_in])
+    ev_delta = np.concatenate([np.ones(n, dtype=np.int64), -np.ones(n, dtype=np.int64)])
+    order = np.lexsort((ev_delta, ev_time, ev_game))
+    ev_game, ev_time, ev_delta = ev_game[order], ev_time[order], ev_delta[order]
+
+    # Running count within each game: a global cumsum is fine, since every game's events sum to zero.
+    count = np.cumsum(ev_delta)
+
+    # The count after event i holds until the game's next event.
+    held = np.zeros(len(ev_time), dtype=np.float64)
+    same_game = ev_game[1:]==ev_game[:-1]
+    held[:-1] = np.where(same_game, ev_time[1:]-ev_time[:-1], 0)
+
+    n_checkouts = np.bincount(g, minlength=n_games)
+    busy = np.bincount(ev_game, weights=count*held, minlength=n_games)
+    # A game with no copies would be "full" at every instant; it gets no time at full instead.
+    full = (count>=copies[ev_game]) & (copies[ev_game]>0)
+    at_full = np.bincount(ev_game, weights=held*full, minlength=n_games)
+    group_starts = np.flatnonzero(np.concatenate([[True], ~same_game]))
+    peak = np.zeros(n_games, dtype=np.int64)
+    peak[ev_game[group_starts]] = np.maximum.reduceat(count, group_starts)
+
+    for i,u in enumerate(utilization):
+        u.n_checkouts = int(n_checkouts[i])
+        u.peak = int(peak[i])
+        u.average = float(busy[i]/window) if window > 0 else 0.0
+        u.seconds_at_full = float(at_full[i])
+        u.fraction_at_full = float(at_full[i]/window) if window > 0 else 0.0
+
+    utilization.sort(key=lambda u: (u.game.num_copies()==0, -u.fraction_at_full, u.spare_copies(), -u.average))
+    return utilization
+
+def output_utilization(utilization, out_fn, understocked_fraction=0.1):
+    """TSV output of a ranked list of GameUtilization objects."""
+    with open(out_fn,'w',newline='',encoding='utf-8') as f:
+        writer = csv.writer(f,delimiter='\t')
+        writer.writerow(GameUtilization._header_row)
+        writer.writerows(u.tsv_row(understocked_fraction) for u in utilization)
+
+class PlayerStats(object):
+    """One badge's plays over a snapshot (SQL Scripts/Most Plays by Player.sql), and wins if known."""
+
+    _header_row = ['Player_ID','Player_Name','Plays','Wins']
+
+    def __init__(self, player_id, player_name):
+        self.player_id = player_id
+        self.player_name = player_name
+        self.n_plays = 0
+        self.n_wins = None
+
+    def tsv_row(self):
+        return [self.player_id, self.player_name, self.n_plays, '' if self.n_wins is None else self.n_wins]
+
+class GameStats(object):
+    """One game's plays, ratings and wins (the first query of SQL Scripts/Play and Win Stats.sql).
+        Contains:
+            - n_plays: checkouts, including ones with no players
+            - n_player_rows: players summed over checkouts
+            - rating_sum, n_ratings: over players who left a rating
+            - players: set of player_ids who played it
+            - n_wins: copies won, or None if no winners file was given
+    """
+
+    _header_row = ['Game_ID','Game_Name','Rating_Average','Ratings_Count','Player_Count','Play_Count',
+                    'Unique_Players','Wins','Win_Rate']
+
+    def __init__(self, game_id, game_name):
+        self.game_id = game_id
+        self.game_name = game_name
+        self.n_plays = 0
+        self.n_player_rows = 0
+        self.rating_sum = 0.0
+        self.n_ratings = 0
+        self.players = set()
+        self.n_wins = None
+
+    def rating_average(self):
+        return self.rating_sum/self.n_ratings if self.n_ratings else None
+
+    def win_rate(self):
+        """Chance a player of this game won a copy of it."""
+        return self.n_wins/len(self.players) if (self.players and self.n_wins is not None) else None
+
+    def tsv_row(self):
+        average = self.rating_average()
+        win_rate = self.win_rate()
+        return [self.game_id, self.game_name, round(average,3) if average is not None else '',
+                self.n_ratings, self.n_player_rows, self.n_plays, len(self.players),
+                '' if self.n_wins is None else self.n_wins,
+                round(win_rate,4) if win_rate is not None else '']
+
+def snapshot_reports(all_plays, wins=None):
+    """The player, game, convention-total and hoarding reports, in one pass over the plays.
+
+        ARGUMENTS:
+            all_plays - an iterable of GameCheckout objects (unfiltered: the SQL counts every checkout)
+            wins - an optional list of Win objects, e.g. from pnw.parse_winners_tsv
+
+        Checkouts that were never checked in have zero duration after parsing, so they count as
+        plays but add no hours and never overlap anything, as in the SQL.
+
+        RETURNS:
+            (a list of PlayerStats, most plays first; a list of GameStats, best rated first;
+             an OrderedDict of convention totals; an OrderedDict hoarding summary)
+    """
+    players = dict()
+    games = dict()
+    totals = OrderedDict([('plays',0), ('player_rows',0), ('checkout_hours',0.0), ('player_hours',0.0)])
+    checkouts_by_player = defaultdict(list)
+
+    for play in all_plays:
+        game = games.get(play.game.game_id)
+        if game is None:
+            game = games[play.game.game_id] = GameStats(play.game.game_id, play.game.game_name)
+        game.n_plays += 1
+        totals['plays'] += 1
+        hours = max(play.duration,0.0)/3600.0
+        totals['checkout_hours'] += hours
+        for p in play.players:
+            player = players.get(p.player_id)
+            if player is None:
+                player = players[p.player_id] = PlayerStats(p.player_id, p.player_name)
+            player.n_plays += 1
+            game.n_player_rows += 1
+            game.players.add(p.player_id)
+            if p.rating is not None:
+                game.rating_sum += p.rating
+                game.n_ratings += 1
+            totals['player_rows'] += 1
+            totals['player_hours'] += hours
+            if play.duration > 0:
+                checkouts_by_player[p.player_id].append((play.time_out, play.time_in, play.checkout_id))
+
+    if wins is not None:
+        for stats in list(players.values())+list(games.values()):
+            stats.n_wins = 0
+        for w in wins:
+            if w.player.player_id in players:
+                players[w.player.player_id].n_wins += 1
+            if w.game.game_id in games:
+                games[w.game.game_id].n_wins += 1
+
+    player_stats = sorted(players.values(), key=lambda p: -p.n_plays)
+    game_stats = sorted(games.values(), key=lambda g: (g.rating_average() is None, -(g.rating_average() or 0)))
+    return player_stats, game_stats, totals, hoarding_summary(checkouts_by_player)
+
+def hoarding_summary(checkouts_by_player):
+    """How many games are out at once for checkouts that overlap another checkout with 2+ of the
+        same players (SQL Scripts/Hoarding Average Group Size.sql).
+
+        Overlapping pairs are found per player, by sweeping that player's checkouts in time
+        order, and counted in a hash table; a pair qualifies when 2+ players share it. Like the
+        SQL, a checkout's count is the larger of its qualifying pairs as the lower ID and as the
+        higher ID (not their sum), plus one for itself.
+
+        ARGUMENTS:
+            checkouts_by_player - (time_out, time_in, checkout_id) per player, checked-in checkouts only
+    """
+    shared = defaultdict(int)
+    for checkouts in checkouts_by_player.values():
+        checkouts.sort()
+        active = list()
+        for time_out, time_in, checkout_id in checkouts:
+            active = [(t_in, other) for t_in,other in active if t_in > time_out]
+            for t_in,other in active:
+                shared[(other,checkout_id) if other < checkout_id else (checkout_id,other)] += 1
+            active.append((time_in, checkout_id))
+
+    as_lower = defaultdict(int)
+    as_higher = defaultdict(int)
+    for (lower,higher),n_players in shared.items():
+        if n_players >= 2:
+            as_lower[lower] += 1
+            as_higher[higher] += 1
+    out_at_once = [max(as_lower.get(c,0), as_higher.get(c,0))+1 for c in set(as_lower)|set(as_higher)]
+
+    return OrderedDict([('avg_games_hoarded_simultaneously', round(sum(out_at_once)/len(out_at_once),1) if out_at_once else None),
+                        ('min_simultaneous', min(out_at_once) if out_at_once else None),
+                        ('max_simultaneous', max(out_at_once) if out_at_once else None),
+                        ('qualifying_checkouts', len(out_at_once))])
+
+def output_reports(out_dir, player_stats, game_stats, totals, hoarding):
+    """players.tsv, games.tsv and summary.json (totals and hoarding) in out_dir."""
+    os.makedirs(out_dir, exist_ok=True)
+    for fn,cls,rows in [('players.tsv',PlayerStats,player_stats), ('games.tsv',GameStats,game_stats)]:
+        with open(os.path.join(out_dir,fn),'w',newline='',encoding='utf-8') as f:
+            writer = csv.writer(f,delimiter='\t')
+            writer.writerow(cls._header_row)
+            writer.writerows(r.tsv_row() for r in rows)
+    with open(os.path.join(out_dir,'summary.json'),'w') as f:
+        json.dump(OrderedDict([('totals',totals), ('hoarding',hoarding)]), f, indent=3)
+
+def load_checkouts(plays_source):
+    """Checkout arrays from either a plays JSON snapshot or a columnar snapshot directory."""
+    if os.path.isdir(plays_source):
+        columnar = pnw.load_plays_columnar(plays_source)
+        return columnar.game_id, columnar.time_out, columnar.time_in
+    return checkout_arrays(pnw.parse_plays_json(plays_source))
+
+def main():
+    p = argparse.ArgumentParser(description='Play & Win library statistics')
+    sub = p.add_subparsers(dest='report', required=True)
+
+    u = sub.add_parser('utilization', help="per-game peak/average concurrent checkouts vs. copies owned")
+    u.add_argument('games_source', help="games JSON snapshot")
+    u.add_argument('plays_source', help="plays JSON snapshot, or a columnar snapshot directory")
+    u.add_argument('out_fn', help="TSV output, most understocked games first")
+    u.add_argument('--understocked_fraction', type=float, default=0.1,
+                    help="fraction of the con at full utilization to call a game understocked (default 0.1)")
+
+    r = sub.add_parser('reports', help="per-player and per-game play, rating and win counts, convention totals and hoarding")
+    r.add_argument('plays_source', help="plays JSON snapshot, or a columnar snapshot directory")
+    r.add_argument('out_dir', help="directory for players.tsv, games.tsv and summary.json")
+    r.add_argument('--winners_fn', default=None, help="winners TSV from pnw_picker, for win counts and rates")
+
+    args = p.parse_args()
+    logging.basicConfig(level=logging.INFO, format='[%(levelname)10s] :\t %(message)s')
+
+    if args.report=='utilization':
+        all_games = pnw.parse_games_json(args.games_source)
+        utilization = copy_utilization(all_games, *load_checkouts(args.plays_source))
+        output_utilization(utilization, args.out_fn, args.understocked_fraction)
+        logger.info(f"Wrote utilization for {len(utilization)} games to {args.out_fn}")
+    elif args.report=='reports':
+        if os.path.isdir(args.plays_source):
+            all_plays = pnw.load_plays_columnar(args.plays_source).to_plays()
+        else:
+            all_plays = pnw.parse_plays_json(args.plays_source)
+        wins = pnw.parse_winners_tsv(args.winners_fn) if args.winners_fn is not None else None
+        player_stats, game_stats, totals, hoarding = snapshot_reports(all_plays, wins)
+        output_reports(args.out_dir, player_stats, game_stats, totals, hoarding)
+        logger.info(f"Wrote reports for {len(player_stats)} players and {len(game_stats)} games to {args.out_dir}")
+
+if __name__ == '__main__':
+    main()
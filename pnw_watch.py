@@ -0,0 +1,269 @@
+"""Live per-game eligibility counts during the con.
+
+    python pnw_watch.py data/games.json --collection 1/273/16 --interval 60 --duration_min 10 --ineligible_players_fn staff.tsv
+
+Polls the plays endpoint (or re-reads a local plays file with --plays_source) and keeps, per
+P&W game, the number of eligible plays and of unique motivated players. Only checkouts that are
+new, changed (e.g. checked back in) or gone since the last poll are parsed and applied, so the
+per-game counts cost O(changes) per refresh rather than a full re-parse and re-filter. The
+same rules as pnw.filter_plays decide what counts.
+
+The counts are served on a local port, least-played games first:
+    GET /            an HTML table
+    GET /status.tsv  the same as TSV
+"""
+import argparse
+import csv
+import html
+import http.client
+import io
+import json
+import logging
+import threading
+import time
+from collections import Counter, OrderedDict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pnw
+import pnw_api
+import pnw_batch
+
+logger = logging.getLogger(__name__)
+
+class GameTally(object):
+    """Running counts for one P&W game.
+        Contains:
+            - game: the Game object (awardable copies only)
+            - n_eligible_plays: plays that pass filter_plays
+            - player_counts: eligible plays per motivated, eligible player_id
+            - n_removed: plays of this game that filter_plays would remove
+    """
+
+    _header_row = ['Game_ID','Game_Name','Copies','Eligible_Plays','Motivated_Players','Removed_Plays']
+
+    def __init__(self, game):
+        self.game = game
+        self.n_eligible_plays = 0
+        self.player_counts = dict()
+        self.n_removed = 0
+
+    def n_motivated_players(self):
+        return len(self.player_counts)
+
+    def add_players(self, player_ids, sign):
+        for player_id in player_ids:
+            n = self.player_counts.get(player_id, 0) + sign
+            if n > 0:
+                self.player_counts[player_id] = n
+            else:
+                del self.player_counts[player_id]
+
+    def tsv_row(self):
+        return [self.game.game_id, self.game.game_name, self.game.num_copies(),
+                self.n_eligible_plays, self.n_motivated_players(), self.n_removed]
+
+def _fingerprint(play_json):
+    """Everything in an api/plays entry that can change what it counts for."""
+    checkout = play_json['Checkout']
+    return (play_json['GameID'], checkout['TimeOut'], checkout['TimeIn'],
+            tuple((p['ID'], p['WantsToWin']) for p in play_json['Players']))
+
+class PlayWatcher(object):
+    """Per-game tallies, kept up to date from successive plays snapshots."""
+    def __init__(self, awardable_games_by_id, duration_min=None, duration_max=None, ineligible_players=None, playtimes=None):
+        """Input: an OrderedDict of awardable Game objects by ID, the duration bounds (seconds),
+            the players (like staff) who don't count towards a game's motivated players, and
+            optionally per-game bounds (a pnw.GamePlaytimes)."""
+        self.awardable_games_by_id = awardable_games_by_id
+        self.duration_min = duration_min
+        self.duration_max = duration_max
+        self.playtimes = playtimes
+        self.ineligible_ids = set(p.player_id for p in ineligible_players) if ineligible_players is not None else set()
+        self.tallies = OrderedDict([(game_id,GameTally(g)) for game_id,g in awardable_games_by_id.items()])
+        self.removed_by_reason = Counter()
+        self._fingerprints = dict()
+        self._applied = dict()      # checkout_id: (game_id, removal reason, counted player_ids)
+
+    def update(self, plays_json):
+        """Bring the tallies up to date with a full list of api/plays entries.
+            RETURNS: (new or changed, removed) checkout counts
+        """
+        fingerprints = dict()
+        changed = list()
+        for play_json in plays_json:
+            checkout_id = int(play_json['CheckoutID'])
+            fp = _fingerprint(play_json)
+            fingerprints[checkout_id] = fp
+            if self._fingerprints.get(checkout_id)!=fp:
+                changed.append(play_json)
+        gone = [checkout_id for checkout_id in self._fingerprints if checkout_id not in fingerprints]
+
+        for checkout_id in gone:
+            self._retract(checkout_id)
+        for play_json in changed:
+            play = pnw.GameCheckout(play_json)
+            self._retract(play.checkout_id)
+            self._apply(play)
+        # only now, so if a play fails to parse the next poll retries everything changed
+        self._fingerprints = fingerprints
+        return len(changed), len(gone)
+
+    def _apply(self, play):
+        reason = pnw.play_removal_reason(play, self.awardable_games_by_id, self.duration_min, self.duration_max, self.playtimes)
+        game_id = play.game.game_id
+        player_ids = tuple()
+        if reason is None:
+            player_ids = tuple(set(p.player_id for p in play.players
+                                    if p.wants_to_win==True and p.player_id not in self.ineligible_ids))
+            self.tallies[game_id].n_eligible_plays += 1
+            self.tallies[game_id].add_players(player_ids, 1)
+        else:
+            self.removed_by_reason[reason] += 1
+            if game_id in self.tallies:
+                self.tallies[game_id].n_removed += 1
+        self._applied[play.checkout_id] = (game_id, reason, player_ids)
+
+    def _retract(self, checkout_id):
+        if checkout_id not in self._applied:
+            return
+        game_id, reason, player_ids = self._applied.pop(checkout_id)
+        if reason is None:
+            self.tallies[game_id].n_eligible_plays -= 1
+            self.tallies[game_id].add_players(player_ids, -1)
+        else:
+            self.removed_by_reason[reason] -= 1
+            if game_id in self.tallies:
+                self.tallies[game_id].n_removed -= 1
+
+    def ranked(self):
+        """Tallies with the least-played games first."""
+        return sorted(self.tallies.values(), key=lambda t: (t.n_motivated_players(), t.n_eligible_plays, t.game.game_name))
+
+    def tsv(self):
+        f = io.StringIO()
+        writer = csv.writer(f, delimiter='\t', lineterminator='\n')
+        writer.writerow(GameTally._header_row)
+        writer.writerows(t.tsv_row() for t in self.ranked())
+        return f.getvalue()
+
+    def html(self, updated=None):
+        rows = ''.join('<tr>'+''.join(f'<td>{html.escape(str(x))}</td>' for x in t.tsv_row())+'</tr>\n'
+                        for t in self.ranked())
+        header = ''.join(f'<th>{h}</th>' for h in GameTally._header_row)
+        removed = ', '.join(f'{reason} {n}' for reason,n in sorted(self.removed_by_reason.items()) if n)
+        return (f'<!DOCTYPE html>\n<html><head><meta charset="utf-8"><meta http-equiv="refresh" content="30">'
+                f'<title>P&amp;W watch</title></head><body>\n'
+                f'<p>Updated {html.escape(str(updated))}. Removed plays: {html.escape(removed) or "none"}</p>\n'
+                f'<table border="1">\n<tr>{header}</tr>\n{rows}</table>\n</body></html>\n')
+
+class WatchServer(ThreadingHTTPServer):
+    """Serves a PlayWatcher; the poll loop calls refresh() to swap in new pages."""
+    daemon_threads = True
+
+    def __init__(self, address, watcher):
+        self.watcher = watcher
+        self.pages = dict()
+        self.refresh()
+        super().__init__(address, WatchRequestHandler)
+
+    def refresh(self):
+        updated = time.strftime('%Y-%m-%d %H:%M:%S')
+        self.pages = {'/': ('text/html', self.watcher.html(updated).encode('utf-8')),
+                      '/status.tsv': ('text/tab-separated-values', self.watcher.tsv().encode('utf-8'))}
+
+class WatchRequestHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        page = self.server.pages.get(self.path.split('?')[0])
+        if page is None:
+            self.send_error(404, "use / or /status.tsv")
+            return
+        content_type, body = page
+        self.send_response(200)
+        self.send_header('Content-Type', content_type+'; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logger.debug(format % args)
+
+def main():
+    p = argparse.ArgumentParser(description='Play & Win live eligibility counts')
+    p.add_argument('games_source', help="games JSON snapshot")
+    p.add_argument('--plays_source', default=None,
+                    help="re-read this local plays JSON on every poll instead of calling the API")
+    p.add_argument('--url', default='library.geekway.com', help="API host")
+    p.add_argument('--collection', default='1/273/16',
+                    help="the collection to poll, as org/con/coll, default 1/273/16 (the P&W games of games_source)")
+    p.add_argument('--interval', default=60.0, type=float, help="seconds between polls")
+    p.add_argument('--ineligible_players_fn', default=None,
+                    help="a tsv file with ID,Player Name of all ineligible players (such as staff)")
+    p.add_argument('--duration_min', default=None, type=float,
+                    help="minimum duration (minutes) for a play to count")
+    p.add_argument('--duration_max', default=None, type=float,
+                    help="maximum duration (minutes) for a play to count")
+    p.add_argument('--playtimes_fn', default=None,
+                    help="bgg-playtimes.json: also bound each game's plays by its own BGG playing time")
+    p.add_argument('--playtime_scales', default=[0.5, 3.0], type=float, nargs=2, metavar=('MIN_SCALE','MAX_SCALE'),
+                    help="a play counts from MIN_SCALE x the BGG minimum time to MAX_SCALE x the maximum, default 0.5 3")
+    p.add_argument('--out_fn', default=None, help="also rewrite this TSV after every poll")
+    p.add_argument('--host', default='127.0.0.1')
+    p.add_argument('--port', default=8322, type=int)
+    args = p.parse_args()
+    logging.basicConfig(level=logging.INFO, format='[%(levelname)10s] :\t %(message)s')
+    try:
+        sub_endpoint = pnw_batch.parse_collection(args.collection, '.').sub_endpoint()
+    except ValueError as err:
+        p.error(str(err))
+
+    all_pnw_titles = pnw.filter_library_games(pnw.parse_games_json(args.games_source))
+    all_pnw_titles_by_id = OrderedDict([(g.game_id,g) for g in all_pnw_titles])
+    ineligible_players = None
+    if args.ineligible_players_fn is not None:
+        ineligible_players = pnw.parse_ineligible_players(args.ineligible_players_fn)
+    playtimes = None
+    if args.playtimes_fn is not None:
+        playtimes = pnw.GamePlaytimes.from_json(args.playtimes_fn, *args.playtime_scales)
+    watcher = PlayWatcher(all_pnw_titles_by_id,
+                            args.duration_min*60.0 if args.duration_min is not None else None,
+                            args.duration_max*60.0 if args.duration_max is not None else None,
+                            ineligible_players, playtimes)
+
+    access_token = [None]
+    def fetch_plays():
+        if args.plays_source is not None:
+            with open(args.plays_source,'r',newline='') as f:
+                return json.load(f)['Result']['Plays']
+        for attempt in range(2):
+            if access_token[0] is None:
+                access_token[0] = json.loads(pnw_api.get_auth())['access_token']
+            try:
+                return json.loads(pnw_api.get_api_resource(access_token[0],'plays',args.url,sub_endpoint))['Result']['Plays']
+            except (http.client.HTTPException, IOError):    # e.g. IncompleteRead, for a body cut short
+                if attempt > 0:
+                    raise
+                access_token[0] = None   # the token may have expired, get a new one and retry
+
+    server = WatchServer((args.host, args.port), watcher)
+    threading.Thread(target=server.serve_forever, name='pnw-watch-http', daemon=True).start()
+    logger.info(f"Watching {len(all_pnw_titles_by_id)} P&W games at http://{args.host}:{args.port}/")
+    try:
+        while True:
+            try:
+                start = time.time()
+                n_changed, n_gone = watcher.update(fetch_plays())
+                server.refresh()
+                if args.out_fn is not None:
+                    with open(args.out_fn,'w',newline='',encoding='utf-8') as f:
+                        f.write(watcher.tsv())
+                logger.info(f"{n_changed} new or changed and {n_gone} removed checkouts applied in {time.time()-start:.2f}s")
+            except (http.client.HTTPException, IOError, ValueError, KeyError) as err:
+                logger.warning(f"Poll failed, keeping the last counts: {err!r}")
+            time.sleep(args.interval)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.shutdown()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,241 @@
+"""A store of past winners, for eligibility rules that reach across draws and years.
+
+    python pnw_winners_db.py add winners/ 2025 output/pnw.1234567.tsv
+    python pnw_winners_db.py player winners/ 1234
+    python pnw_winners_db.py player winners/ --name "Pat O'Brien"
+    python pnw_winners_db.py draws winners/
+
+Each winners TSV (<prefix>.<suffix>.tsv, as written by the picker) is appended once, tagged with
+its year and a draw label (the file name, unless given), to wins.tsv in the store's directory.
+sources.json lists the draws added and where each one's rows end in wins.tsv, so adding the
+same file again does nothing and rows left by an interrupted add are dropped. Nothing already
+stored is ever rewritten.
+
+The store is read once into indexes by badge ID and by normalized name (pnw.normalize_name),
+and adding a draw extends them in place. DrawRules turns it into the lookups a draw needs:
+    - max_wins: a badge that has already won max_wins times this year (e.g. in the weekend's
+      other draws) can't win again
+    - prior_weight: last year's winners (matched by name, since badges are reissued every year)
+      get this weight in the draw, e.g. 0.5 for half the chance of a player with no win
+"""
+import argparse
+import csv
+import hashlib
+import io
+import json
+import logging
+import os
+from collections import defaultdict
+
+import pnw
+
+logger = logging.getLogger(__name__)
+
+_wins_header = ['Year','Draw','Game_ID','Game_Name','Copy_ID','Winner_ID','Winner_Name']
+
+class WinRecord(object):
+    """One stored win."""
+    def __init__(self, year, draw, game_id, game_name, copy_id, player_id, player_name):
+        self.year = year
+        self.draw = draw
+        self.game_id = game_id
+        self.game_name = game_name
+        self.copy_id = copy_id
+        self.player_id = player_id
+        self.player_name = player_name
+
+    def tsv_row(self):
+        return [self.year, self.draw, self.game_id, self.game_name, self.copy_id, self.player_id, self.player_name]
+
+    def __json__(self):
+        return dict(self.__dict__)
+
+    @classmethod
+    def from_row(cls, row):
+        return cls(int(row['Year']), row['Draw'], int(row['Game_ID']), row['Game_Name'], row['Copy_ID'],
+                    row['Winner_ID'], row['Winner_Name'])
+
+class WinnersDB(object):
+    """Past wins, indexed by badge ID and by normalized name.
+        Contains:
+            - records: every WinRecord, in the order added
+            - by_id: record positions per badge ID
+            - by_name: record positions per normalized name
+            - sources: the draws added, by label: year, file, sha256, number of wins, and end
+              (the size of wins.tsv after its rows)
+    """
+    def __init__(self, db_dir):
+        self.db_dir = db_dir
+        self.wins_fn = os.path.join(db_dir, 'wins.tsv')
+        self.sources_fn = os.path.join(db_dir, 'sources.json')
+        self.records = list()
+        self.by_id = defaultdict(list)
+        self.by_name = defaultdict(list)
+        self.sources = dict()
+        if os.path.exists(self.sources_fn):
+            with open(self.sources_fn, encoding='utf-8') as f:
+                self.sources = json.load(f)
+        self._end = max([s['end'] for s in self.sources.values()]+[0])
+        if self._end > 0:
+            with open(self.wins_fn, 'rb') as f:
+                data = f.read(self._end)
+            for row in csv.DictReader(io.StringIO(data.decode('utf-8'), newline=''), delimiter='\t'):
+                self._index(WinRecord.from_row(row))
+        logger.info(f"Read {len(self.records)} wins from {len(self.sources)} draws in {db_dir}")
+
+    def _index(self, record):
+        self.by_id[record.player_id].append(len(self.records))
+        self.by_name[pnw.normalize_name(record.player_name)].append(len(self.records))
+        self.records.append(record)
+
+    def add(self, winners_fn, year, draw=None):
+        """Append a winners TSV (pnw.output_winners) as one draw of the given year.
+            draw defaults to the file name without .tsv. Adding a file already in the store does
+            nothing; a different file under a label already used raises ValueError.
+            RETURNS: the number of wins added
+        """
+        if draw is None:
+            draw = os.path.basename(winners_fn)
+            if draw.endswith('.tsv'):
+                draw = draw[:-len('.tsv')]
+        with open(winners_fn, 'rb') as f:
+            digest = hashlib.sha256(f.read()).hexdigest()
+        if draw in self.sources:
+            if self.sources[draw]['sha256'] == digest:
+                logger.info(f"Draw {draw} is already in {self.db_dir}")
+                return 0
+            raise ValueError(f"a different draw {draw} is already in {self.db_dir}: pass another draw label")
+        for label,source in self.sources.items():
+            if source['sha256'] == digest:
+                logger.info(f"{winners_fn} is already in {self.db_dir}, as draw {label}")
+                return 0
+
+        records = [WinRecord(year, draw, w.game.game_id, w.game.game_name, w.copy_id, w.player.player_id, w.player.player_name)
+                    for w in pnw.parse_winners_tsv(winners_fn)]
+        os.makedirs(self.db_dir, exist_ok=True)
+        with open(self.wins_fn, 'a+b') as f:
+            # rows past the last recorded end are from an add that didn't finish
+            f.truncate(self._end)
+            f.seek(self._end)
+            text = io.StringIO()
+            writer = csv.writer(text, delimiter='\t')
+            if self._end == 0:
+                writer.writerow(_wins_header)
+            writer.writerows(r.tsv_row() for r in records)
+            f.write(text.getvalue().encode('utf-8'))
+            f.flush()
+            os.fsync(f.fileno())
+            end = f.tell()
+
+        self.sources[draw] = dict(year=year, fn=winners_fn, sha256=digest, n_wins=len(records), end=end)
+        tmp_fn = self.sources_fn+'.tmp'
+        with open(tmp_fn, 'w', encoding='utf-8') as f:
+            json.dump(self.sources, f, indent=2)
+        os.replace(tmp_fn, self.sources_fn)
+        self._end = end
+        for record in records:
+            self._index(record)
+        logger.info(f"Added {len(records)} wins from {winners_fn} to {self.db_dir} as {year} draw {draw}")
+        return len(records)
+
+    def wins_by_id(self, player_id, year=None):
+        """RETURNS: the WinRecords of a badge ID (in one year, if given)"""
+        return [self.records[i] for i in self.by_id.get(str(player_id), ())
+                if year is None or self.records[i].year == year]
+
+    def wins_by_name(self, player_name, year=None):
+        """RETURNS: the WinRecords of everyone with this name, once normalized (in one year, if given)"""
+        return [self.records[i] for i in self.by_name.get(pnw.normalize_name(player_name), ())
+                if year is None or self.records[i].year == year]
+
+    def years(self):
+        return sorted(set(s['year'] for s in self.sources.values()))
+
+class DrawRules(object):
+    """What a winners store means for one draw of a given year.
+        - ineligible_ids: the badges (and their names) with max_wins or more wins already this year
+        - prior_names: normalized names of the winners in the prior_years years before this one
+
+        weight(player) is what the draw multiplies a player's chances by: prior_weight for a prior
+        winner, otherwise 1. Both are set and dict lookups, answered once per badge.
+    """
+    def __init__(self, db, year, max_wins=None, prior_weight=None, prior_years=1):
+        if prior_weight is not None and not 0 < prior_weight <= 1:
+            raise ValueError(f"prior_weight must be above 0 and at most 1, not {prior_weight}")
+        self.year = year
+        self.max_wins = max_wins
+        self.prior_weight = prior_weight
+        self.prior_years = prior_years
+
+        self.ineligible_ids = dict()
+        if max_wins is not None:
+            wins_this_year = defaultdict(list)
+            for record in db.records:
+                if record.year == year:
+                    wins_this_year[record.player_id].append(record)
+            self.ineligible_ids = {player_id: records[-1].player_name for player_id,records in wins_this_year.items()
+                                   if len(records) >= max_wins}
+        self.prior_names = frozenset()
+        if prior_weight is not None:
+            self.prior_names = frozenset(name for name,positions in db.by_name.items()
+                                         if any(year-prior_years <= db.records[i].year < year for i in positions))
+        self._weights = dict()
+        logger.info(f"Winners store rules for {year}: {len(self.ineligible_ids)} badges at {max_wins} wins, "+
+                    f"{len(self.prior_names)} winners from the last {prior_years} years weighted {prior_weight}")
+
+    def ineligible_players(self):
+        """RETURNS: Players who can't win this draw, for pick_all_winners' extra_ineligible_players"""
+        return [pnw.Player(player_id=player_id, player_name=name) for player_id,name in sorted(self.ineligible_ids.items())]
+
+    def weight(self, player):
+        weight = self._weights.get(player.player_id)
+        if weight is None:
+            weight = 1.0
+            if self.prior_weight is not None and pnw.normalize_name(player.player_name or '') in self.prior_names:
+                weight = self.prior_weight
+            self._weights[player.player_id] = weight
+        return weight
+
+    def weighted(self):
+        """True if weight() can be anything but 1"""
+        return self.prior_weight is not None and self.prior_weight != 1 and len(self.prior_names) > 0
+
+    def key(self):
+        """The rules' contents, for the stage cache"""
+        return [self.year, sorted(self.ineligible_ids), self.prior_weight, sorted(self.prior_names)]
+
+def main():
+    p = argparse.ArgumentParser(description='Play & Win prior winners store')
+    sub = p.add_subparsers(dest='command', required=True)
+    a = sub.add_parser('add', help="append winners TSVs as draws of a year")
+    a.add_argument('db_dir')
+    a.add_argument('year', type=int)
+    a.add_argument('winners_fns', nargs='+', help="winners TSVs written by the picker (<prefix>.<suffix>.tsv)")
+    a.add_argument('--draw', default=None, help="draw label, with one file (default: the file name)")
+    w = sub.add_parser('player', help="a player's stored wins")
+    w.add_argument('db_dir')
+    w.add_argument('player_id', nargs='?', default=None)
+    w.add_argument('--name', default=None, help="look up by name instead (case, accents and punctuation ignored)")
+    w.add_argument('--year', default=None, type=int)
+    d = sub.add_parser('draws', help="the draws in the store")
+    d.add_argument('db_dir')
+    args = p.parse_args()
+    logging.basicConfig(level=logging.INFO, format='[%(levelname)10s] :\t %(message)s')
+
+    db = WinnersDB(args.db_dir)
+    if args.command=='add':
+        if args.draw is not None and len(args.winners_fns) > 1:
+            p.error("--draw labels one file at a time")
+        for fn in args.winners_fns:
+            db.add(fn, args.year, args.draw)
+    elif args.command=='player':
+        if (args.player_id is None) == (args.name is None):
+            p.error("give a player ID or --name")
+        records = db.wins_by_id(args.player_id, args.year) if args.name is None else db.wins_by_name(args.name, args.year)
+        print(json.dumps(records, cls=pnw.CustomJSONEncoder, indent=2, ensure_ascii=False))
+    else:
+        for label,source in sorted(db.sources.items(), key=lambda item: (item[1]['year'], item[0])):
+            print(f"{source['year']}\t{label}\t{source['n_wins']} wins\t{source['fn']}")
+
+if __name__ == '__main__':
+    main()
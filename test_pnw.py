@@ -1,4 +1,5 @@
 import unittest
+from unittest import mock
 import random 
 import pnw_picker as pnw
 import csv
@@ -7,6 +8,38 @@ import urllib
 import json
 
 import http.client
+import http.server
+import threading
+import logging
+import logging.handlers
+import os
+import tempfile
+import shutil
+import sqlite3
+import subprocess
+import re
+import numpy
+from collections import OrderedDict, Counter
+import pnw as pnw_model
+import pnw_stats
+import pnw_odds
+import pnw_matching
+import pnw_desk
+import pnw_batch
+import pnw_watch
+import pnw_archive
+import pnw_api
+import pnw_replay
+import pnw_cache
+import pnw_progress
+import pnw_bgg
+import pnw_winners_db
+import pnw_ooc
+import create_mock_plays
+import importlib.util
+import argparse
+import io
+from zoneinfo import ZoneInfo
 
 import requests
 import requests_file
@@ -17,6 +50,12 @@ fn_plays_xml = 'test/plays_test.xml'
 fn_games_xml = 'test/games_test.xml'
 fn_plays_json = 'test/plays_test.json'
 fn_games_json = 'test/games_test.json'
+# Random Scripts isn't a package (and has a space in its name), so load the script by path
+_spec = importlib.util.spec_from_file_location('checkouts_over_time',
+            os.path.join(os.path.dirname(os.path.abspath(__file__)), 'Random Scripts', 'checkouts_over_time.py'))
+checkouts_over_time = importlib.util.module_from_spec(_spec)
+_spec.loader.exec_module(checkouts_over_time)
+
 api_plays_json = 'http://93a186b3.ngrok.io/Api/Plays'
 api_games_json = 'http://93a186b3.ngrok.io/Api/Games'
 fn_ineligible_games_tsv = 'test/ineligible_games_test.tsv'
@@ -49,18 +88,20 @@ class TestParsePlays(unittest.TestCase):
         self.assertTrue(n_players==50)
 
     def test_api_request_json(self):
-        """The API now returns JSON format. Note: this is changing constantly, so may often fail for trivial reasons."""
-        s = requests.session()
-        foo = s.get('http://93a186b3.ngrok.io/api/Plays')
-        # print(foo.text)
-        # print(foo.headers.get('content-type'))
-        bar = dict(foo.json())
-        # print(dict(json.loads(foo.text)))
-        # print(bar['Plays'])
-        self.assertTrue(len(bar['Plays'])==12,f"Found {len(bar['Plays'])} Plays, but expected 11. Plays: \n{bar['Plays']}")
-        # baz = urllib.request.urlopen('http://93a186b3.ngrok.io/api/Games')
-        # print(baz.read())
-        
+        """The API returns JSON; fetch it through pnw_api from a local replay server (the old ngrok URL is long gone)."""
+        plays = [_play_json(i, 10, [i]) for i in range(1, 13)]
+        fixture = pnw_replay.Fixture(json.dumps({'Result': {'Games': []}}).encode('utf-8'),
+                                     json.dumps({'Errors': [], 'Result': {'Plays': plays}}).encode('utf-8'))
+        server = pnw_replay.ReplayServer(('127.0.0.1', 0), fixture)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        try:
+            with mock.patch.dict(os.environ, {'AUTH0_CLIENT_ID': 'id', 'AUTH0_CLIENT_SECRET': 'secret'}):
+                bar = pnw_api.retrieve_data_api('plays', server.url(), auth_url=server.url())
+        finally:
+            server.shutdown()
+            server.server_close()
+        self.assertTrue(len(bar['Result']['Plays'])==12,f"Found {len(bar['Result']['Plays'])} Plays, but expected 12.")
+        self.assertEqual(server.counts, Counter(token=1, plays=1))
 
     def test_file_request_json(self):
         """The API now returns JSON format, testing it when parsing file instead."""
@@ -232,6 +273,1076 @@ class TestSelectWinners(unittest.TestCase):
         ineligible_game_copies = pnw.parse_ineligible_library_copies(fn_ineligible_games_tsv, self._game_library)
         self.assertTrue(len(ineligible_game_copies)==25)
 
+def _play_json(checkout_id, game_id, player_ids, minutes=60, wants_to_win=True, time_out='2024-05-17T15:00:00'):
+    """A single api/plays entry, for building GameCheckout objects without a test file."""
+    time_in = (pnw_model.datetime.fromisoformat(time_out)+pnw_model.timedelta(minutes=minutes)).isoformat()
+    return dict(ID=checkout_id, CheckoutID=checkout_id, GameID=game_id, GameName=f"Game {game_id}",
+                Checkout=dict(TimeOut=time_out+'.000', TimeIn=time_in+'.000', Copy=dict(ID=f"{game_id:03d}A")),
+                Players=[dict(ID=p, Name=f"Player {p}", WantsToWin=wants_to_win, Rating=None) for p in player_ids])
+
+class TestColumnarPlays(unittest.TestCase):
+    def setUp(self):
+        self._dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self._dir)
+
+    def test_round_trip(self):
+        """Plays written to the columnar format should load back unchanged."""
+        all_plays = [pnw_model.GameCheckout(_play_json(1, 10, [1,2,3])),
+                     pnw_model.GameCheckout(_play_json(2, 11, [], minutes=5)),
+                     pnw_model.GameCheckout(_play_json(3, 10, [3,4], minutes=90, wants_to_win=False))]
+        out_dir = os.path.join(self._dir,'plays.columnar')
+        pnw_model.output_plays_columnar(all_plays, out_dir)
+        columnar = pnw_model.load_plays_columnar(out_dir)
+        self.assertEqual(columnar.num_plays(), 3)
+        self.assertEqual(columnar.num_player_rows(), 5)
+        self.assertEqual(list(columnar.play_index()), [0,0,0,2,2])
+        for before,after in zip(all_plays, columnar.to_plays()):
+            self.assertEqual(before.tsv_rows(), after.tsv_rows())
+            self.assertEqual(before.copy_id, after.copy_id)
+
+    def test_filter_matches_filter_plays(self):
+        """The columnar filter should give the same plays, order and removal reasons as filter_plays."""
+        plays_json = [_play_json(1, 11, [1,2]),
+                      _play_json(2, 10, [3], minutes=5),
+                      _play_json(3, 12, [4]),
+                      _play_json(4, 10, [], minutes=90),
+                      _play_json(5, 10, [5], minutes=600),
+                      _play_json(6, 11, [6,7], wants_to_win=False),
+                      _play_json(7, 10, [8,9])]
+        plays_json[0]['Players'][1]['WantsToWin'] = False
+        plays_json[0]['Players'][0]['Rating'] = 3
+        plays_json[6]['Players'][0]['Rating'] = 4.5
+        plays_json[3]['Checkout']['TimeIn'] = None
+        plays_fn = os.path.join(self._dir,'plays.json')
+        with open(plays_fn,'w') as f:
+            json.dump({'Result': {'Plays': plays_json}}, f)
+        awardable = OrderedDict([(10,None), (11,None)])
+
+        all_plays = pnw_model.parse_plays_json(plays_fn)
+        columnar = pnw_model.parse_plays_json_columnar(plays_fn)
+        columns, strings = pnw_model.plays_to_columns(all_plays)
+        self.assertEqual(columnar.strings, strings)
+        for name,values in columns.items():
+            self.assertTrue(numpy.array_equal(getattr(columnar, name), values, equal_nan=True), name)
+
+        expected = pnw_model.filter_plays(all_plays, awardable, 10*60, 300*60)
+        actual = pnw_model.filter_plays_columnar(columnar, awardable, 10*60, 300*60)
+        for before,after in zip(expected, actual):
+            self.assertEqual(list(before), list(after))
+            for key in before:
+                self.assertEqual([[str(x) for x in r] for p in before[key] for r in p.tsv_rows()],
+                                 [[str(x) for x in r] for p in after[key] for r in p.tsv_rows()])
+        self.assertEqual(list(actual[0]), [11, 10])
+        self.assertEqual(list(actual[1]), ['min_duration', 'not_awardable', 'no_players', 'max_duration', 'no_motivated_players'])
+
+    def test_per_game_bounds(self):
+        """BGG playing times bound each game's plays; games without a time only get the global bounds."""
+        playtimes_fn = os.path.join(self._dir,'bgg-playtimes.json')
+        with open(playtimes_fn,'w') as f:
+            json.dump([{'gameId': 10, 'name': 'Filler', 'bggId': 1, 'minTime': 15, 'maxTime': 20},
+                       {'gameId': 11, 'name': 'Epic', 'bggId': 2, 'minTime': 180, 'maxTime': 240},
+                       {'gameId': 12, 'name': 'Unknown', 'bggId': None, 'minTime': None, 'maxTime': 0}], f)
+        playtimes = pnw_model.GamePlaytimes.from_json(playtimes_fn, min_scale=0.5, max_scale=3.0)
+        plays_json = [_play_json(1, 10, [1], minutes=5),      # under 7.5 minutes
+                      _play_json(2, 10, [2], minutes=45),
+                      _play_json(3, 10, [3], minutes=90),     # over 60 minutes
+                      _play_json(4, 11, [4], minutes=60),     # under 90 minutes
+                      _play_json(5, 11, [5], minutes=600),
+                      _play_json(6, 12, [6], minutes=1),
+                      _play_json(7, 13, [7], minutes=2000),   # no BGG entry at all
+                      _play_json(8, 11, [8], minutes=800)]    # over the global maximum first
+        plays_fn = os.path.join(self._dir,'plays.json')
+        with open(plays_fn,'w') as f:
+            json.dump({'Result': {'Plays': plays_json}}, f)
+        awardable = OrderedDict([(10,None), (11,None), (12,None), (13,None)])
+
+        expected = pnw_model.filter_plays(pnw_model.parse_plays_json(plays_fn), awardable, None, 2500*60, playtimes)
+        actual = pnw_model.filter_plays_columnar(pnw_model.parse_plays_json_columnar(plays_fn), awardable, None, 700*60, playtimes)
+        self.assertEqual({reason: [p.checkout_id for p in plays] for reason,plays in actual[1].items()},
+                         {'game_min_duration': [1,4], 'game_max_duration': [3], 'max_duration': [7,8]})
+        actual = pnw_model.filter_plays_columnar(pnw_model.parse_plays_json_columnar(plays_fn), awardable, None, 2500*60, playtimes)
+        for before,after in zip(expected, actual):
+            self.assertEqual({k: [p.checkout_id for p in v] for k,v in before.items()},
+                             {k: [p.checkout_id for p in v] for k,v in after.items()})
+        self.assertEqual(list(actual[1]), ['game_min_duration', 'game_max_duration'])
+        self.assertEqual([p.checkout_id for p in actual[1]['game_max_duration']], [3,8])
+
+class TestCheckoutsOverTime(unittest.TestCase):
+    csv_text = '\n'.join([
+        'checkOut,checkIn,count',
+        '2024-05-17T15:00:00Z,2024-05-17T16:00:00Z,3',
+        '2024-05-17T16:00:00,2024-05-17T17:00:00,2',          # checked out as the first is checked in
+        '2024-05-17T16:00:00,2024-05-17T16:30:00,4',          # and another at the same instant
+        '2024-05-17T11:00:00-05:00,2024-05-17T18:00:00+00:00,1',
+        '2024-05-17T15:30:00,,5',                             # never checked in
+        ',2024-05-17T15:30:00,5',                             # no checkout
+        'not a time,2024-05-17T15:30:00,1',
+        '2024-05-17T15:10:00,2024-05-17T15:20:00,lots',
+        '',
+        '2024-05-17T15:10:00,2024-05-17T15:20:00,',           # blank count is 0 players
+        ''])
+
+    def _read(self, vectorized):
+        args = argparse.Namespace(checkout_col='checkOut', checkin_col='checkIn', count_col='count', time_format=None)
+        reader = csv.DictReader(io.StringIO(self.csv_text, newline=''))
+        with mock.patch('sys.stderr'):
+            if vectorized:
+                return checkouts_over_time.read_events_vectorized(reader, args, True)
+            return checkouts_over_time.read_events(reader, args, True, ZoneInfo('America/Chicago'))
+
+    def test_vectorized_matches_row_sweep(self):
+        """Same events, counts and skipped rows both ways; checkins go before checkouts at the same time."""
+        rows = self._read(False)
+        fast = self._read(True)
+        row_times = numpy.array([t.astimezone(checkouts_over_time.UTC).replace(tzinfo=None) for t in rows[0]],
+                                dtype='datetime64[us]')
+        self.assertTrue(numpy.array_equal(row_times, fast[0]))
+        self.assertEqual(list(rows[1]), fast[1].tolist())
+        self.assertEqual(list(rows[2]), fast[2].tolist())
+        self.assertEqual(rows[3:], fast[3:])
+        self.assertEqual(fast[3:], (9, 5, 1, 3))
+        self.assertEqual(fast[1].tolist(), [1,2,1,0,1,2,3,2,1,0])
+        self.assertEqual(fast[2].tolist(), [3,3,3,0,2,6,7,3,1,0])
+
+        raw = ['2024-05-17T15:00:00', '', '2024-05-17T16:00:00Z', 'nope', '2024-05-17T11:00:00-05:00']
+        times, bad = checkouts_over_time.parse_times_array(raw, None)
+        self.assertEqual(bad.tolist(), [False, False, False, True, False])
+        self.assertEqual(numpy.isnat(times).tolist(), [False, True, False, True, False])
+        self.assertEqual(times[4], numpy.datetime64('2024-05-17T16:00:00'))
+        chunked, chunked_bad = checkouts_over_time.parse_times_array(raw, None, chunk_size=2)   # first chunk in bulk
+        self.assertTrue(numpy.array_equal(times, chunked, equal_nan=True))
+        self.assertEqual(bad.tolist(), chunked_bad.tolist())
+
+    def test_downsample_keeps_peak(self):
+        """Downsampling keeps the global peak's value and (first) time, the last point, and only real points."""
+        rng = numpy.random.default_rng(2)
+        times = numpy.datetime64('2024-05-17T00:00:00') + numpy.arange(5000)*numpy.timedelta64(7, 's')
+        values = rng.integers(0, 100, 5000)
+        values[[1234, 4000]] = 150
+        kept_times, kept_values = checkouts_over_time.downsample_max(times, values, 40)
+        self.assertLessEqual(len(kept_times), 41)
+        self.assertEqual(kept_values.max(), 150)
+        self.assertEqual(kept_times[kept_values.argmax()], times[1234])
+        self.assertEqual((kept_times[-1], kept_values[-1]), (times[-1], values[-1]))
+        positions = numpy.searchsorted(times, kept_times)
+        self.assertTrue(numpy.array_equal(values[positions], kept_values))
+        short_times, short_values = checkouts_over_time.downsample_max(times[:10], values[:10], 40)
+        self.assertEqual((short_times.tolist(), short_values.tolist()), (times[:10].tolist(), values[:10].tolist()))
+
+class TestCopyUtilization(unittest.TestCase):
+    def test_peak_and_full_time(self):
+        """Two overlapping checkouts of a one-copy game are over capacity; a two-copy game never fills."""
+        all_games = [pnw_model.Game(10, 'Game 10', [pnw_model.Copy(10,'010A',True)]),
+                     pnw_model.Game(11, 'Game 11', [pnw_model.Copy(11,'011A',True), pnw_model.Copy(11,'011B',True)])]
+        all_plays = [pnw_model.GameCheckout(_play_json(1, 10, [1], minutes=60, time_out='2024-05-17T15:00:00')),
+                     pnw_model.GameCheckout(_play_json(2, 10, [2], minutes=60, time_out='2024-05-17T15:30:00')),
+                     pnw_model.GameCheckout(_play_json(3, 11, [3], minutes=30, time_out='2024-05-17T15:00:00'))]
+        utilization = pnw_stats.copy_utilization(all_games, *pnw_stats.checkout_arrays(all_plays))
+        self.assertEqual([u.game.game_id for u in utilization], [10, 11])
+        self.assertEqual(utilization[0].peak, 2)
+        self.assertEqual(utilization[0].seconds_at_full, 90*60)
+        self.assertAlmostEqual(utilization[0].average, 120/90)
+        self.assertEqual(utilization[1].peak, 1)
+        self.assertEqual(utilization[1].status(), 'overstocked')
+
+    def test_no_copies(self):
+        """A game with no copies is never at full utilization, and ranks below the games that have some."""
+        all_games = [pnw_model.Game(10, 'Game 10', []),
+                     pnw_model.Game(11, 'Game 11', [pnw_model.Copy(11,'011A',True), pnw_model.Copy(11,'011B',True)])]
+        all_plays = [pnw_model.GameCheckout(_play_json(1, 10, [1], minutes=60, time_out='2024-05-17T15:00:00')),
+                     pnw_model.GameCheckout(_play_json(2, 11, [2], minutes=30, time_out='2024-05-17T15:00:00'))]
+        utilization = pnw_stats.copy_utilization(all_games, *pnw_stats.checkout_arrays(all_plays))
+        self.assertEqual([u.game.game_id for u in utilization], [11, 10])
+        self.assertEqual(utilization[1].seconds_at_full, 0)
+        self.assertEqual(utilization[1].fraction_at_full, 0)
+        self.assertEqual(utilization[1].status(), 'no copies')
+
+class TestWinOdds(unittest.TestCase):
+    def test_one_copy(self):
+        """Plays [1,2] and [1]: old_school gives player 1 a 3/4 chance, standard gives 2/3."""
+        game = pnw_model.Game(10, 'Game 10', [pnw_model.Copy(10,'010A',True)])
+        all_plays = [pnw_model.GameCheckout(_play_json(1, 10, [1,2])), pnw_model.GameCheckout(_play_json(2, 10, [1]))]
+        old_school = pnw_odds.game_win_odds(game, all_plays, method='old_school')
+        standard = pnw_odds.game_win_odds(game, all_plays, method='standard')
+        self.assertTrue(old_school.exact and standard.exact)
+        self.assertAlmostEqual(old_school.probabilities['1'], 3/4)
+        self.assertAlmostEqual(standard.probabilities['1'], 2/3)
+        self.assertAlmostEqual(standard.probabilities['2'], 1/3)
+
+    def test_simulation_matches_exact(self):
+        """Forcing the simulation should land within its error bound of the exact answer."""
+        game = pnw_model.Game(10, 'Game 10', [pnw_model.Copy(10,'010A',True), pnw_model.Copy(10,'010B',True)])
+        all_plays = [pnw_model.GameCheckout(_play_json(i, 10, players))
+                        for i,players in enumerate([[1,2,3],[1,4],[2,5,6],[6],[3,4,5]])]
+        for method in ['standard','old_school']:
+            exact = pnw_odds.game_win_odds(game, all_plays, method=method)
+            approx = pnw_odds.game_win_odds(game, all_plays, method=method, max_work=0, seed=1)
+            self.assertTrue(exact.exact)
+            self.assertFalse(approx.exact)
+            self.assertAlmostEqual(exact.expected_winners(), 2)
+            for player_id,p in exact.probabilities.items():
+                self.assertLess(abs(p-approx.probabilities[player_id]), approx.error_bound)
+
+class TestRarestFirstSchedule(unittest.TestCase):
+    def test_fewest_eligible_goes_first(self):
+        """Game 12 only has player 1, so it goes first; then game 10 has one player left to game 11's two."""
+        plays_by_game = {10: [pnw_model.GameCheckout(_play_json(1, 10, [1,2]))],
+                         11: [pnw_model.GameCheckout(_play_json(2, 11, [3,4]))],
+                         12: [pnw_model.GameCheckout(_play_json(3, 12, [1]))]}
+        ineligible_players = list()
+        order = list()
+        for game_id in pnw.rarest_first_schedule(plays_by_game, ineligible_players):
+            order.append(game_id)
+            ineligible_players.append(plays_by_game[game_id][0].players[0])
+        self.assertEqual(order, [12, 10, 11])
+
+    def test_not_with_max_coverage(self):
+        """max_coverage has no game order, so rarest_first is only warned about, not computed."""
+        games = OrderedDict([(10, pnw_model.Game(10, 'Game 10', [pnw_model.Copy(10,'010A',True)]))])
+        plays_by_game = {10: [pnw_model.GameCheckout(_play_json(1, 10, [1,2]))]}
+        with mock.patch.object(pnw, 'rarest_first_schedule') as schedule, self.assertLogs(pnw.logger, 'WARNING') as logs:
+            wins, problem_plays = pnw.draw_winners(games, plays_by_game, list(), pick_method='max_coverage', schedule='rarest_first')
+        schedule.assert_not_called()
+        self.assertEqual(len(wins), 1)
+        self.assertIn('rarest_first', '\n'.join(logs.output))
+
+class TestMaxCoverage(unittest.TestCase):
+    def test_every_copy_awarded(self):
+        """Player 1 played both games but player 2 only game 10, so both copies can only be
+            awarded if player 1 wins game 11, however the random draw goes."""
+        games = OrderedDict([(10, pnw_model.Game(10, 'Game 10', [pnw_model.Copy(10,'010A',True)])),
+                             (11, pnw_model.Game(11, 'Game 11', [pnw_model.Copy(11,'011A',True)]))])
+        plays_by_game = {10: [pnw_model.GameCheckout(_play_json(1, 10, [1,2]))],
+                         11: [pnw_model.GameCheckout(_play_json(2, 11, [1]))]}
+        for trial in range(10):
+            problem_plays = list()
+            wins = pnw_matching.max_coverage_winners(games, plays_by_game, problem_plays)
+            winners = {w.game.game_id:w.player.player_id for w in wins}
+            self.assertEqual(winners, {10:'2', 11:'1'})
+            self.assertEqual(problem_plays, [])
+
+class _GamesHandler(http.server.BaseHTTPRequestHandler):
+    """Serves one JSON body with an ETag, answering 304 to a matching If-None-Match."""
+    body = json.dumps({'Result': {'Games': []}}).encode('utf-8')
+    etag = '"v1"'
+    statuses = list()
+
+    def do_GET(self):
+        if self.headers.get('If-None-Match')==self.etag:
+            self.statuses.append(304)
+            self.send_response(304)
+            self.send_header('ETag', self.etag)
+            self.end_headers()
+            return
+        self.statuses.append(200)
+        self.send_response(200)
+        self.send_header('ETag', self.etag)
+        self.send_header('Content-Length', str(len(self.body)))
+        self.end_headers()
+        self.wfile.write(self.body)
+
+    def log_message(self, format, *args):
+        pass
+
+class TestHTTPCache(unittest.TestCase):
+    def setUp(self):
+        self._dir = tempfile.mkdtemp()
+        _GamesHandler.statuses = list()
+        self._server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), _GamesHandler)
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        self._host = '127.0.0.1:%d' % self._server.server_address[1]
+
+    def tearDown(self):
+        self._server.shutdown()
+        self._server.server_close()
+        shutil.rmtree(self._dir)
+
+    def _get(self, cache, refresh=False, sub_endpoint=None):
+        conn = http.client.HTTPConnection(self._host)
+        try:
+            return pnw_api.get_api_resource('token', 'games', self._host, sub_endpoint, conn=conn, cache=cache, refresh=refresh)
+        finally:
+            conn.close()
+
+    def test_conditional_get(self):
+        """The second request is conditional and the 304 reuses the cached body; refresh skips the cache."""
+        cache = pnw_api.HTTPCache(self._dir)
+        first = self._get(cache)
+        self.assertEqual(self._get(cache), first)
+        self._get(cache, refresh=True)
+        self.assertEqual(_GamesHandler.statuses, [200, 304, 200])
+        self.assertEqual(json.loads(first), {'Result': {'Games': []}})
+
+    def test_ttl_and_eviction(self):
+        """Expired entries are downloaded again, and the least recently used entry is evicted when over size."""
+        self._get(pnw_api.HTTPCache(self._dir, ttl=-1))
+        self._get(pnw_api.HTTPCache(self._dir, ttl=-1))
+        self.assertEqual(_GamesHandler.statuses, [200, 200])
+
+        cache = pnw_api.HTTPCache(self._dir, max_bytes=len(_GamesHandler.body)*2)
+        for sub_endpoint in ['/a/', '/b/', '/c/']:
+            self._get(cache, sub_endpoint=sub_endpoint)
+        self.assertIsNone(cache.lookup(cache.key(self._host, '/a/games')))
+        self.assertIsNotNone(cache.lookup(cache.key(self._host, '/c/games')))
+
+class _PlaysHandler(http.server.BaseHTTPRequestHandler):
+    """A stand-in plays endpoint with offset/limit paging, which can fail or garble a page once, cap limit or ignore paging."""
+    plays = [_play_json(i, 10, [i]) for i in range(1, 24)]
+    paged = True
+    cap = None
+    fail_once = set()
+    garble_once = set()
+    requests = list()
+
+    def do_GET(self):
+        query = urllib.parse.parse_qs(urllib.parse.urlsplit(self.path).query)
+        offset, limit = int(query['offset'][0]), int(query['limit'][0])
+        if self.cap is not None:
+            limit = min(limit, self.cap)
+        self.requests.append(offset)
+        if offset in self.fail_once:
+            self.fail_once.discard(offset)
+            self.send_error(503)
+            return
+        plays = self.plays[offset:offset+limit] if self.paged else self.plays
+        body = json.dumps({'Errors': [], 'Result': {'Plays': plays}}).encode('utf-8')
+        if offset in self.garble_once:
+            self.garble_once.discard(offset)
+            body = body[:len(body)//2]
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+class TestPagedPlays(unittest.TestCase):
+    def setUp(self):
+        _PlaysHandler.paged = True
+        _PlaysHandler.cap = None
+        _PlaysHandler.fail_once = set()
+        _PlaysHandler.garble_once = set()
+        _PlaysHandler.requests = list()
+        self._server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), _PlaysHandler)
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        self._url = 'http://127.0.0.1:%d' % self._server.server_address[1]
+
+    def tearDown(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def _checkout_ids(self, page_size):
+        self._page_lengths = list()
+        plays = pnw_api.retrieve_plays_paged('token', self._url, page_size=page_size, max_workers=3, retries=2,
+                                                on_page=self._page_lengths.append)
+        return [p['CheckoutID'] for p in plays['Result']['Plays']]
+
+    def test_pages_merge_in_order(self):
+        """Pages come back in order, a failed page is retried alone, and an exact multiple ends on an empty page."""
+        _PlaysHandler.fail_once = {10}
+        self.assertEqual(self._checkout_ids(5), list(range(1, 24)))
+        self.assertEqual(sum(self._page_lengths), 23)   # pages past the end come back empty
+        self.assertEqual(_PlaysHandler.requests.count(10), 2)
+        self.assertEqual(_PlaysHandler.requests.count(5), 1)
+        _PlaysHandler.plays = _PlaysHandler.plays[:20]
+        try:
+            self.assertEqual(self._checkout_ids(4), list(range(1, 21)))
+        finally:
+            _PlaysHandler.plays = [_play_json(i, 10, [i]) for i in range(1, 24)]
+
+    def test_garbled_page_retried(self):
+        """A page whose body doesn't parse as JSON is retried like a failed request."""
+        _PlaysHandler.garble_once = {0, 15}
+        with mock.patch.object(pnw_api.time, 'sleep'):
+            self.assertEqual(self._checkout_ids(5), list(range(1, 24)))
+        self.assertEqual(_PlaysHandler.requests.count(0), 2)
+        self.assertEqual(_PlaysHandler.requests.count(15), 2)
+
+    def test_unpaged_server(self):
+        """A server that ignores offset/limit is used as is once it repeats the first page, whatever its length."""
+        _PlaysHandler.paged = False
+        for page_size in (5, 23, 30):
+            _PlaysHandler.requests = list()
+            self.assertEqual(self._checkout_ids(page_size), list(range(1, 24)))
+            self.assertEqual(_PlaysHandler.requests[0], 0)
+            self.assertLessEqual(len(_PlaysHandler.requests), 4)   # page 0, then one round of 3 workers
+
+    def test_capped_limit(self):
+        """A server that sends fewer plays than asked for is stepped through by what it sends, to the end."""
+        _PlaysHandler.cap = 4
+        self.assertEqual(self._checkout_ids(10), list(range(1, 24)))
+        self.assertEqual(sorted(set(_PlaysHandler.requests))[:3], [0, 4, 8])
+
+class TestReplayServer(unittest.TestCase):
+    def test_paged_fetch_through_failures(self):
+        """Paged plays come back whole through chunked transfer, 503s and dropped connections."""
+        plays = [_play_json(i, 10, [i]) for i in range(1, 101)]
+        fixture = pnw_replay.Fixture(json.dumps({'Result': {'Games': []}}).encode('utf-8'),
+                                     json.dumps({'Errors': [], 'Result': {'Plays': plays}}).encode('utf-8'))
+        shaping = pnw_replay.Shaping(chunk_size=512, failure_rate=0.3, failure='mixed', seed=4)
+        server = pnw_replay.ReplayServer(('127.0.0.1', 0), fixture, shaping)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        try:
+            with mock.patch.object(pnw_api.time, 'sleep'):   # no backoff waits
+                result = pnw_api.retrieve_plays_paged(server.token, server.url(), page_size=10, retries=8)
+        finally:
+            server.shutdown()
+            server.server_close()
+        self.assertEqual([p['CheckoutID'] for p in result['Result']['Plays']], list(range(1, 101)))
+        self.assertGreater(server.counts['failed'], 0)
+
+class TestDeskIndex(unittest.TestCase):
+    def test_lookups(self):
+        """Badge 2 opted out of one play, badge 3's only play was too short, and badge 1 won."""
+        all_games = [pnw_model.Game(10, 'Game 10', [pnw_model.Copy(10,'010A',True)])]
+        all_plays = [pnw_model.GameCheckout(_play_json(1, 10, [1,2])),
+                     pnw_model.GameCheckout(_play_json(2, 10, [2], wants_to_win=False)),
+                     pnw_model.GameCheckout(_play_json(3, 10, [3], minutes=5))]
+        wins = [pnw_model.Win(all_games[0], '010A', all_plays[0].players[0], None, n_plays=1)]
+        index = pnw_desk.DeskIndex(all_games, all_plays, wins, duration_min=10*60)
+
+        badge = json.loads(index.badge(2))
+        self.assertEqual(badge['eligibility'], 'eligible')
+        self.assertEqual([p['reason'] for p in badge['plays']], ['counted','no_motivated_players'])
+        self.assertEqual(json.loads(index.badge(3))['eligibility'], 'no_counted_plays')
+        self.assertEqual(json.loads(index.badge(3))['plays'][0]['reason'], 'min_duration')
+        self.assertEqual(json.loads(index.copy('010A'))['win']['player_id'], '1')
+        self.assertEqual(index.name_search('PLAYER'), [('1','Player 1'),('2','Player 2'),('3','Player 3')])
+        self.assertEqual(index.name_search('3'), [('3','Player 3')])
+        self.assertIsNone(index.badge(4))
+
+        # with BGG playing times (15-20 minutes), badge 1's hour-long play is over the game's own maximum
+        playtimes = pnw_model.GamePlaytimes({10: 15}, {10: 20}, min_scale=0.5, max_scale=2.0)
+        index = pnw_desk.DeskIndex(all_games, all_plays, wins, duration_min=10*60, playtimes=playtimes)
+        self.assertEqual(json.loads(index.badge(1))['plays'][0]['reason'], 'game_max_duration')
+        self.assertEqual(json.loads(index.badge(1))['eligibility'], 'no_counted_plays')
+
+    def test_latest_winners_file(self):
+        """The winners glob also matches each draw's unawarded TSV, which is never the one loaded."""
+        out_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, out_dir)
+        for i,fn in enumerate(['games.json', 'plays.json', 'pnw.1.tsv', 'pnw.2.tsv', 'pnw.2.unawarded.tsv']):
+            with open(os.path.join(out_dir, fn), 'w') as f:
+                f.write('Game_ID\tGame_Name\n' if 'unawarded' in fn else '')
+            os.utime(os.path.join(out_dir, fn), (i, i))
+        pattern = os.path.join(out_dir, 'pnw.*.tsv')
+        self.assertEqual(pnw_desk._latest(pattern), os.path.join(out_dir, 'pnw.2.tsv'))
+        files, signature = pnw_desk.DeskSources(os.path.join(out_dir, 'games.json'), os.path.join(out_dir, 'plays.json'),
+                                                pattern).resolve()
+        self.assertEqual(files['winners'], os.path.join(out_dir, 'pnw.2.tsv'))
+        os.remove(os.path.join(out_dir, 'pnw.1.tsv'))
+        os.remove(os.path.join(out_dir, 'pnw.2.tsv'))
+        self.assertIsNone(pnw_desk._latest(pattern))
+
+    def test_bad_query(self):
+        """A limit that isn't a whole number gets a 400 with a JSON error, not a dropped connection."""
+        all_games = [pnw_model.Game(10, 'Game 10', [pnw_model.Copy(10,'010A',True)])]
+        index = pnw_desk.DeskIndex(all_games, [pnw_model.GameCheckout(_play_json(1, 10, [1,2]))], [])
+        sources = mock.Mock(resolve=mock.Mock(return_value=(dict(), 'same')), load=mock.Mock(return_value=index))
+        server = pnw_desk.DeskServer(('127.0.0.1', 0), sources)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        try:
+            conn = http.client.HTTPConnection('127.0.0.1', server.server_address[1])
+            conn.request('GET', '/name?prefix=player&limit=abc')
+            response = conn.getresponse()
+            self.assertEqual(response.status, 400)
+            self.assertIn('limit', json.loads(response.read())['error'])
+            conn.request('GET', '/name?prefix=player&limit=1')
+            response = conn.getresponse()
+            self.assertEqual(response.status, 200)
+            self.assertEqual(json.loads(response.read()), [dict(player_id='1', player_name='Player 1')])
+            conn.close()
+        finally:
+            server.shutdown()
+            server.server_close()
+
+class TestBatchDraw(unittest.TestCase):
+    def setUp(self):
+        self._dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self._dir)
+
+    def test_exclusive(self):
+        """Player 1 is the only player in both collections, so with --exclusive only the first awards its copy."""
+        collections = [pnw_batch.parse_collection(spec, self._dir) for spec in ['1/273/16','1/273/17']]
+        for c in collections:
+            os.makedirs(c.out_dir)
+            with open(c.games_source,'w') as f:
+                json.dump({'Result':{'Games':[{'ID':10,'Name':'Game 10','Copies':[{'ID':'010A','Winnable':True}]}]}}, f)
+            with open(c.plays_source,'w') as f:
+                json.dump({'Result':{'Plays':[_play_json(1, 10, [1])]}}, f)
+        picker_args = dict(ineligible_players_fn=None, pick_method='standard', use_cache=False, log_dir=self._dir)
+        shared = pnw_batch.draw_collections(collections, picker_args, exclusive=False, max_workers=2)
+        self.assertEqual([len(wins) for wins in shared], [1,1])
+        exclusive = pnw_batch.draw_collections(collections, picker_args, exclusive=True)
+        self.assertEqual([len(wins) for wins in exclusive], [1,0])
+
+class TestPlayWatcher(unittest.TestCase):
+    def test_incremental_matches_filter_plays(self):
+        """After checkouts are added, checked in and deleted, the tallies match a full filter_plays."""
+        games = OrderedDict([(10, pnw_model.Game(10, 'Game 10', [pnw_model.Copy(10,'010A',True)])),
+                             (11, pnw_model.Game(11, 'Game 11', [pnw_model.Copy(11,'011A',True)]))])
+        watcher = pnw_watch.PlayWatcher(games, duration_min=10*60)
+        snapshot = [_play_json(1, 10, [1,2]), _play_json(2, 10, [2,3], minutes=5), _play_json(3, 11, [4])]
+        self.assertEqual(watcher.update(snapshot), (3,0))
+        self.assertEqual(watcher.update(snapshot), (0,0))
+        snapshot = [_play_json(1, 10, [1,2]), _play_json(2, 10, [2,3], minutes=50), _play_json(4, 12, [5])]
+        self.assertEqual(watcher.update(snapshot), (2,1))
+
+        filtered_plays, removed_plays = pnw_model.filter_plays([pnw_model.GameCheckout(p) for p in snapshot], games, 10*60)
+        for game_id,tally in watcher.tallies.items():
+            self.assertEqual(tally.n_eligible_plays, len(filtered_plays[game_id]))
+            self.assertEqual(tally.n_motivated_players(), len(set(p.player_id for play in filtered_plays[game_id] for p in play.players)))
+        self.assertEqual(+watcher.removed_by_reason, Counter({'not_awardable':1}))
+        self.assertEqual([t.game.game_id for t in watcher.ranked()], [11,10])
+
+        # per-game BGG bounds apply as in filter_plays: game 10 plays count from 20 to 54 minutes
+        playtimes = pnw_model.GamePlaytimes({10: 40}, {10: 18}, min_scale=0.5, max_scale=3.0)
+        watcher = pnw_watch.PlayWatcher(games, duration_min=10*60, playtimes=playtimes)
+        watcher.update(snapshot)
+        filtered_plays, removed_plays = pnw_model.filter_plays([pnw_model.GameCheckout(p) for p in snapshot], games, 10*60,
+                                                               playtimes=playtimes)
+        self.assertEqual(watcher.tallies[10].n_eligible_plays, len(filtered_plays[10]))
+        self.assertEqual(+watcher.removed_by_reason, Counter({k: len(v) for k,v in removed_plays.items()}))
+        self.assertEqual(watcher.removed_by_reason['game_max_duration'], 1)
+
+class TestArchive(unittest.TestCase):
+    def setUp(self):
+        self._dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self._dir)
+
+    def test_queries_across_snapshots(self):
+        """Two snapshots in blocks of two plays: counts come from the indexes, plays from the blocks that can match."""
+        games_fn = os.path.join(self._dir,'games.json')
+        plays_fn = os.path.join(self._dir,'plays.json')
+        with open(games_fn,'w') as f:
+            json.dump({'Result':{'Games':[{'ID':10,'Name':'Game 10','Copies':[{'ID':'010A','Winnable':True}]},
+                                          {'ID':11,'Name':'Game 11','Copies':[{'ID':'011A','Winnable':False}]}]}}, f)
+        with open(plays_fn,'w') as f:
+            json.dump({'Result':{'Plays':[_play_json(1, 10, [1,2], time_out='2024-05-17T18:00:00'),
+                                          _play_json(2, 11, [2], time_out='2024-05-17T15:00:00'),
+                                          _play_json(3, 10, [2,3], time_out='2024-05-18T15:00:00')]}}, f)
+        archive = pnw_archive.Archive(os.path.join(self._dir,'archive'))
+        archive.add_snapshot('2024', games_fn, plays_fn, block_plays=2)
+        archive.add_snapshot('2025', games_fn, plays_fn, block_plays=2)
+        with self.assertRaises(ValueError):
+            archive.add_snapshot('2025', games_fn, plays_fn)
+
+        archive = pnw_archive.Archive(os.path.join(self._dir,'archive'))
+        self.assertEqual(list(archive.player_history('2').values()), [3,3])
+        self.assertEqual(archive.player_history('4')['2024'], 0)
+        self.assertEqual(archive.games_everyone_plays(1), [(10, 'Game 10', 2, 6, 1.0)])
+        snapshot = archive.snapshot('2024')
+        self.assertEqual([p.checkout_id for p in snapshot.plays(player_id='2')], [2,1,3])
+        self.assertEqual(list(snapshot.candidate_blocks(player_id='3')), [1])
+        self.assertEqual([p.checkout_id for p in snapshot.plays(game_id=10, time_max=pnw_model.datetime(2024,5,18))], [1])
+
+def _sql_fixture(all_plays, collection_id):
+    """An in-memory database with the tables the SQL Scripts read, holding all_plays."""
+    db = sqlite3.connect(':memory:')
+    db.executescript('''create table "Game" (id integer, name text);
+        create table "Copy" (id integer, "gameId" integer, "collectionId" integer);
+        create table "Attendee" (id integer, "badgeNumber" text, "badgeName" text, "conventionId" integer);
+        create table "CheckOut" (id integer, "copyId" integer, "attendeeId" integer, "checkOut" text, "checkIn" text);
+        create table "Player" (id integer, "checkOutId" integer, "attendeeId" integer, rating real, "wantToWin" boolean);''')
+    attendees = dict()
+    for play in all_plays:
+        db.execute('insert into "Game" select ?,? where not exists (select 1 from "Game" where id=?)',
+                    (play.game.game_id, play.game.game_name, play.game.game_id))
+        db.execute('insert into "Copy" values (?,?,?)', (play.checkout_id, play.game.game_id, collection_id))
+        time_in = play.time_in.isoformat() if play.duration > 0 else None
+        db.execute('insert into "CheckOut" values (?,?,?,?,?)', (play.checkout_id, play.checkout_id, 0, play.time_out.isoformat(), time_in))
+        for p in play.players:
+            if p.player_id not in attendees:
+                attendees[p.player_id] = len(attendees)+1
+                db.execute('insert into "Attendee" values (?,?,?,273)', (attendees[p.player_id], p.player_id, p.player_name))
+            db.execute('insert into "Player" values (null,?,?,?,?)', (play.checkout_id, attendees[p.player_id], p.rating, p.wants_to_win))
+    return db
+
+def _sql_script(fn):
+    """The first statement of a SQL Script, with any hard-coded collection made a parameter and Postgres casts dropped."""
+    with open(os.path.join('SQL Scripts', fn)) as f:
+        sql = re.sub(r'--.*', '', f.read()).split(';')[0]
+    return re.sub(r'"collectionId" = \d+', '"collectionId" = :collection_id', sql).replace('::numeric','')
+
+class TestSnapshotReports(unittest.TestCase):
+    def test_matches_sql_scripts(self):
+        """Same answers as Most Plays by Player, Play and Win Stats and Hoarding Average Group Size on a random fixture."""
+        rng = random.Random(3)
+        all_plays = list()
+        for i in range(60):
+            time_out = pnw_model.datetime(2024,5,17,12) + pnw_model.timedelta(minutes=rng.randrange(0,600,15))
+            play = pnw_model.GameCheckout(_play_json(i+1, rng.randint(1,4), rng.sample(range(1,7), rng.randint(0,4)),
+                                            minutes=rng.choice([0,30,60,120]), time_out=time_out.isoformat()))
+            for p in play.players:
+                p.rating = rng.choice([None,1,2,3,4,5])
+            all_plays.append(play)
+        db = _sql_fixture(all_plays, 16)
+        player_stats, game_stats, totals, hoarding = pnw_stats.snapshot_reports(all_plays)
+
+        sql_players = {row[0]:row[2] for row in db.execute(_sql_script('Most Plays by Player.sql'), dict(collection_id=16)) if row[0] is not None}
+        self.assertEqual(sql_players, {p.player_id:p.n_plays for p in player_stats})
+
+        sql_games = {row[0]:row[1:] for row in db.execute(_sql_script('Play and Win Stats.sql'), dict(collection_id=16))}
+        for g in game_stats:
+            rating_average, ratings_count, player_count, play_count = sql_games[g.game_name]
+            self.assertAlmostEqual(rating_average, g.rating_average())
+            self.assertEqual((ratings_count, player_count, play_count), (g.n_ratings, g.n_player_rows, g.n_plays))
+
+        sql_hoarding = db.execute(_sql_script('Hoarding Average Group Size.sql'), dict(collection_id=16)).fetchone()
+        self.assertGreater(sql_hoarding[3], 0)
+        self.assertEqual(sql_hoarding, tuple(hoarding.values()))
+
+class TestOutputStage(unittest.TestCase):
+    def setUp(self):
+        self._dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self._dir)
+
+    def test_all_outputs(self):
+        """Every file is written, the TSV is by winner, and a name utf-8 can't hold doesn't stop the TSV."""
+        games = [pnw_model.Game(g, f'Game {g}', [pnw_model.Copy(g,f'{g:03d}A',True)]) for g in (10,11,12)]
+        players = [pnw_model.Player(1,'Zed'), pnw_model.Player(2,'Amy \udc80'), pnw_model.Player(3,'Bob')]
+        all_wins = [pnw_model.Win(g, g.copy_ids()[0], p, None, n_plays=1) for g,p in zip(games,players)]
+        problem_plays = [pnw_model.GameCheckout(_play_json(1, 13, [4]))]
+        prefix = os.path.join(self._dir,'pnw')
+        pnw.output_draw_results(all_wins, problem_plays, prefix, '1')
+
+        self.assertEqual([w.player.player_id for w in all_wins], ['1','2','3'])
+        winners = pnw_model.parse_winners_tsv(prefix+'.1.tsv')
+        self.assertEqual([w.player.player_name for w in winners], ['Amy ?','Bob','Zed'])
+        with open(prefix+'.1.json') as f:
+            results = json.load(f)
+        self.assertEqual(results['n_wins'], 3)
+        self.assertEqual(results['problem_games'], [{'game_id':13, 'game_name':'Game 13'}])
+        self.assertTrue(os.path.exists(prefix+'.1.pdf'))
+        self.assertTrue(os.path.exists(prefix+'.1.unawarded.tsv'))
+
+class TestLabelBackends(unittest.TestCase):
+    def setUp(self):
+        self._dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self._dir)
+
+    def test_font_size_matches_shrink_loop(self):
+        """The closed-form font size should be the one the 0.8x shrink loop found."""
+        rng = random.Random(3)
+        for _ in range(2000):
+            text = ''.join(rng.choice('abcdefgWM (0123)') for _ in range(rng.randint(0,120)))
+            area_width, font_size = rng.uniform(20,200), rng.choice([14, 11.2, rng.uniform(3,14)])
+            width = pnw_model.stringWidth(text, 'Helvetica', font_size)
+            expected = font_size
+            while width > area_width:
+                expected *= 0.8
+                width = pnw_model.stringWidth(text, 'Helvetica', expected)
+            self.assertAlmostEqual(pnw_model._label_font_size(text, 'Helvetica', area_width, font_size), expected, places=9)
+
+    def test_canvas_draws_like_pylabels(self):
+        """Both backends should draw the same strings, at the same places, sizes and colors, on the same pages."""
+        wins = [pnw_model.Win(pnw_model.Game(i, "Twilight Imperium: Fourth Edition" if i%3 else "Catan"), f"{i:03d}A",
+                              pnw_model.Player(i, "Bartholomew Maximilian Featherstonehaugh-Smythe" if i%4 else "Ann Lee"), None)
+                for i in range(65)]
+        drawn = list()
+        draw_string = pnw_model.canvas.Canvas.drawString
+        def recording_draw_string(c, x, y, text, *args, **kwargs):
+            m = c._currentMatrix
+            drawn.append((round(m[0]*x+m[2]*y+m[4],3), round(m[1]*x+m[3]*y+m[5],3), text,
+                          round(c._fontsize,6), str(c._fillColorObj), c._pageNumber))
+            return draw_string(c, x, y, text, *args, **kwargs)
+
+        results = dict()
+        with mock.patch.object(pnw_model.canvas.Canvas, 'drawString', recording_draw_string):
+            for backend in ['pylabels', 'canvas']:
+                del drawn[:]
+                pnw_model.output_winners_labels(wins, os.path.join(self._dir, backend+'.pdf'), backend=backend)
+                results[backend] = list(drawn)
+        self.assertEqual(len(results['canvas']), 2*len(wins))
+        self.assertEqual(results['canvas'][-1][-1], 3)
+        self.assertEqual(results['pylabels'], results['canvas'])
+
+class TestMockPlays(unittest.TestCase):
+    def setUp(self):
+        self._dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self._dir)
+
+    def _write(self, prefix, seed):
+        games = create_mock_plays.mock_games(30, numpy.random.default_rng(seed))
+        players = create_mock_plays.mock_players(50)
+        create_mock_plays.write_games_json(games, prefix+'.games.json')
+        plays = create_mock_plays.generate_plays(games, players, 500, seed=seed, chunk_size=128, hoard_rate=0.05)
+        return create_mock_plays.write_plays_json(plays, prefix+'.plays.json')
+
+    def test_parses_and_is_deterministic(self):
+        """Mock snapshots should parse like API snapshots and be the same for the same seed."""
+        prefix = os.path.join(self._dir,'mock')
+        self.assertEqual(self._write(prefix, 7), 500)
+        with open(prefix+'.plays.json','rb') as f:
+            first = f.read()
+        self._write(prefix, 7)
+        with open(prefix+'.plays.json','rb') as f:
+            self.assertEqual(f.read(), first)
+        self._write(prefix, 8)
+        with open(prefix+'.plays.json','rb') as f:
+            self.assertNotEqual(f.read(), first)
+
+        all_games = pnw_model.parse_games_json(prefix+'.games.json')
+        copies = set(c.copy_id for g in all_games for c in g.copies)
+        all_plays = pnw_model.parse_plays_json(prefix+'.plays.json')
+        self.assertEqual([p.checkout_id for p in all_plays], list(range(1,501)))
+        self.assertTrue(all(p.copy_id in copies for p in all_plays))
+        self.assertEqual(sorted(p.time_out for p in all_plays), [p.time_out for p in all_plays])
+        # popular games get far more than their share, and the injected hoarding shows up
+        counts = Counter(p.game.game_id for p in all_plays)
+        self.assertGreater(counts.most_common(1)[0][1], 3*500/30)
+        hoarding = pnw_stats.snapshot_reports(all_plays)[3]
+        self.assertGreater(hoarding['qualifying_checkouts'], 0)
+
+class TestStageCache(unittest.TestCase):
+    def setUp(self):
+        self._dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self._dir)
+
+    def test_keys_and_eviction(self):
+        """Keys change with any part, and the least recently used entries are evicted first."""
+        cache = pnw_cache.StageCache(os.path.join(self._dir,'cache'), max_bytes=2500, salt='v1')
+        self.assertNotEqual(cache.key('filter', 'abc', 10), cache.key('filter', 'abc', 20))
+        self.assertNotEqual(cache.key('filter', 'abc', 10), pnw_cache.StageCache(salt='v2').key('filter', 'abc', 10))
+        calls = list()
+        def compute(i):
+            calls.append(i)
+            return bytes(1000)
+        for i in range(2):
+            cache.run('s', [i], lambda: compute(i))
+            os.utime(cache._fn(cache.key('s', i)), (i, i))
+        self.assertEqual(cache.run('s', [0], lambda: compute(0))[2], True)   # now 0 is newer than 1
+        cache.run('s', [2], lambda: compute(2))
+        self.assertEqual(calls, [0,1,2])
+        self.assertEqual([cache.get(cache.key('s', i))[0] for i in range(3)], [True, False, True])
+
+    def test_picker_reruns_only_changed_stages(self):
+        """Changing the method only reruns the draw; changing a duration bound reruns the filter too."""
+        prefix = os.path.join(self._dir,'mock')
+        games = create_mock_plays.mock_games(20, numpy.random.default_rng(3))
+        create_mock_plays.write_games_json(games, prefix+'.games.json')
+        create_mock_plays.write_plays_json(create_mock_plays.generate_plays(games, create_mock_plays.mock_players(40), 300, seed=3),
+                                            prefix+'.plays.json')
+        ran = list()
+        real_run = pnw_cache.StageCache.run
+        def recording_run(cache, stage, parts, compute):
+            result = real_run(cache, stage, parts, compute)
+            if not result[2]:
+                ran.append(stage)
+            return result
+        def pick(**kwargs):
+            del ran[:]
+            args = dict(local_source=True, all_plays_source=prefix+'.plays.json', all_game_copies_source=prefix+'.games.json',
+                        pick_method='standard', seed=5, log_dir=self._dir)
+            args.update(kwargs)
+            wins = pnw.pick_all_winners(None, os.path.join(self._dir,'out'), **args)
+            return [(w.copy_id, w.player.player_id) for w in wins]
+
+        with mock.patch.object(pnw_cache, 'default_cache_dir', os.path.join(self._dir,'cache')), \
+                mock.patch.object(pnw_cache.StageCache, 'run', recording_run):
+            first = pick()
+            self.assertEqual(ran, ['games','plays','filter','ineligible','draw'])
+            self.assertEqual(pick(), first)
+            self.assertEqual(ran, [])
+            pick(pick_method='old_school')
+            self.assertEqual(ran, ['draw'])
+            pick(duration_min=20*60)
+            self.assertEqual(ran, ['filter','draw'])
+            self.assertEqual(pick(use_cache=False), first)
+            self.assertEqual(ran, [])
+
+    def test_seeded_draw_across_processes(self):
+        """The same seed gives the same copy for each winner whatever the process's string hash seed."""
+        games_fn = os.path.join(self._dir,'games.json')
+        plays_fn = os.path.join(self._dir,'plays.json')
+        with open(games_fn,'w') as f:
+            json.dump({'Result':{'Games':[{'ID':10,'Name':'Game 10','Copies':[{'ID':f'010{c}','Winnable':True} for c in 'ABCDEF']},
+                                          {'ID':11,'Name':'Game 11','Copies':[{'ID':'011A','Winnable':True}]}]}}, f)
+        with open(plays_fn,'w') as f:
+            json.dump({'Result':{'Plays':[_play_json(1, 10, [1,2,3]), _play_json(2, 10, [4,5]), _play_json(3, 11, list(range(1,9)))]}}, f)
+        script = ("import sys, pnw_picker\n"
+                  "wins = pnw_picker.pick_all_winners(None, sys.argv[1], local_source=True, all_plays_source=sys.argv[2],\n"
+                  "        all_game_copies_source=sys.argv[3], pick_method='standard', seed=5, use_cache=False, log_dir=sys.argv[4])\n"
+                  "print(sorted((w.copy_id, w.player.player_id) for w in wins))\n")
+        draws = set()
+        for hash_seed in ('1','2','3'):
+            env = dict(os.environ, PYTHONHASHSEED=hash_seed)
+            out = subprocess.run([sys.executable, '-c', script, os.path.join(self._dir,'out'), plays_fn, games_fn, self._dir],
+                                 env=env, cwd=os.path.dirname(os.path.abspath(__file__)), capture_output=True, text=True, check=True)
+            draws.add(out.stdout.strip().splitlines()[-1])
+        self.assertEqual(len(draws), 1)
+
+class TestQueuedLogging(unittest.TestCase):
+    def setUp(self):
+        self._dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self._dir)
+
+    def test_files_written_by_listener(self):
+        """Queued records reach the debug and warning files, each at its own level, once flushed."""
+        with mock.patch('sys.stderr'):
+            logger = pnw_model.setup_logger('test-queued', log_dir=self._dir)
+        self.assertTrue(all(isinstance(h, logging.handlers.QueueHandler) for h in logger.handlers))
+        logger.debug("Game %s has %d plays", 'Catan', 12)
+        logger.warning("Game %s had no copies", 'Azul')
+        pnw_model.flush_logger('test-queued')
+        with open(os.path.join(self._dir,'test-queued.debug.log')) as f:
+            debug = f.read()
+        with open(os.path.join(self._dir,'test-queued.warning.log')) as f:
+            warning = f.read()
+        self.assertIn("Game Catan has 12 plays", debug)
+        self.assertIn("Game Azul had no copies", debug)
+        self.assertNotIn("Catan", warning)
+        self.assertIn("Game Azul had no copies", warning)
+
+class TestProgress(unittest.TestCase):
+    def setUp(self):
+        self._dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self._dir)
+
+    def test_status_and_eta(self):
+        """The status line shows the count, the percentage (for the GUI's regex) and an ETA from the throughput."""
+        progress = pnw_progress.Progress()
+        with mock.patch.object(pnw_progress.time, 'time', return_value=100.0):
+            progress.phase('draw', total=200, unit='games')
+        progress.advance(50)
+        with mock.patch.object(pnw_progress.time, 'time', return_value=110.0):
+            snapshot = progress.snapshot()
+        self.assertEqual(snapshot['rate'], 5.0)
+        self.assertEqual(snapshot['eta'], 30.0)
+        line = pnw_progress.format_line(snapshot)
+        self.assertEqual(line, 'progress: draw 50/200 games (25%) 5.0/s eta 0:00:30')
+        self.assertEqual(re.match(pnw_progress.progress_regex, line).group('percent'), '25')
+
+    def test_job_reports_draw(self):
+        """A background pick_all_winners reports each phase, ends with every game drawn, and passes errors on."""
+        games_fn = os.path.join(self._dir,'games.json')
+        plays_fn = os.path.join(self._dir,'plays.json')
+        with open(games_fn,'w') as f:
+            json.dump({'Result':{'Games':[{'ID':i,'Name':f'Game {i}','Copies':[{'ID':f'{i:03d}A','Winnable':True}]}
+                                          for i in range(10,15)]}}, f)
+        with open(plays_fn,'w') as f:
+            json.dump({'Result':{'Plays':[_play_json(i, 10+i%5, [i, i+1]) for i in range(1,30)]}}, f)
+        snapshots = list()
+        job = pnw_progress.Job(pnw.pick_all_winners, None, os.path.join(self._dir,'out'), local_source=True,
+                                all_plays_source=plays_fn, all_game_copies_source=games_fn, use_cache=False,
+                                log_dir=self._dir)
+        wins = job.start().wait(snapshots.append, interval=0.001)
+        self.assertEqual(len(wins), 5)
+        final = job.progress.snapshot()
+        self.assertEqual((final['phase'], final['done'], final['total']), ('output', 3, 3))
+        self.assertTrue(all(s['phase'] in ('parse games','parse plays','filter','write logs','draw','output') for s in snapshots))
+
+        job = pnw_progress.Job(pnw.pick_all_winners, None, os.path.join(self._dir,'out'), local_source=True,
+                                all_plays_source=os.path.join(self._dir,'missing.json'), all_game_copies_source=games_fn,
+                                use_cache=False, log_dir=self._dir)
+        with self.assertRaises(IOError):
+            job.start().wait()
+
+class TestBGG(unittest.TestCase):
+    things_xml = """<items>
+        <item type="boardgame" id="13"><name type="primary" sortindex="1" value="Catan"/>
+            <name type="alternate" sortindex="1" value="Die Siedler von Catan"/><yearpublished value="1995"/>
+            <minplayers value="3"/><maxplayers value="4"/><playingtime value="120"/>
+            <minplaytime value="60"/><maxplaytime value="120"/></item>
+        <item type="boardgame" id="230802"><name type="primary" sortindex="1" value="Azul"/><yearpublished value="2017"/>
+            <minplayers value="2"/><maxplayers value="4"/><playingtime value="45"/>
+            <minplaytime value="30"/><maxplaytime value="45"/></item>
+        <item type="boardgame" id="1563"><name type="primary" sortindex="1" value="Café International"/>
+            <minplayers value="2"/><maxplayers value="5"/><playingtime value="0"/>
+            <minplaytime value="0"/><maxplaytime value="0"/></item>
+        <item type="boardgame" id="9209"><name type="primary" sortindex="1" value="Ticket to Ride"/>
+            <minplayers value="2"/><maxplayers value="5"/><playingtime value="60"/>
+            <minplaytime value="30"/><maxplaytime value="60"/></item>
+        </items>"""
+
+    def setUp(self):
+        self._dir = tempfile.mkdtemp()
+        self.server = pnw_replay.BGGReplayServer(('127.0.0.1', 0), pnw_replay.BGGFixture(self.things_xml.encode('utf-8')),
+                                                 queue_first=True)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self._dir)
+
+    def client(self):
+        cache = pnw_bgg.BGGCache(os.path.join(self._dir,'bgg_cache.json'))
+        return pnw_bgg.BGGClient(self.server.url(), prefix='/xmlapi2', token='', interval=0.0, retry_wait=0.0,
+                                 batch_size=2, cache=cache)
+
+    def test_resolve_and_refresh(self):
+        """Games are matched by exact then fuzzy name, and a refresh only asks BGG about new titles."""
+        self.assertEqual(pnw_model.normalize_name("  CAFÉ   International! "), 'cafe international')
+        games = [pnw_model.Game(1, 'Catan'), pnw_model.Game(2, 'azul'), pnw_model.Game(3, 'Cafe International'),
+                 pnw_model.Game(4, 'Not A Real Game')]
+        client = self.client()
+        resolved = client.resolve(games)
+        self.assertEqual({i: r.bgg_id if r else None for i,r in resolved.items()}, {1: 13, 2: 230802, 3: 1563, 4: None})
+        self.assertEqual((games[0].bgg.min_playtime, games[0].bgg.max_playtime, games[0].bgg.year), (60, 120, 1995))
+        self.assertIsNone(games[2].bgg.max_playtime)
+        # 3 exact hits, 1 miss searched fuzzily too; 3 records in batches of 2, each queued (202) once
+        self.assertEqual(client.requests['search'], 5)
+        self.assertEqual(self.server.counts['thing'], 2)
+        self.assertEqual(self.server.counts['queued'], 2)
+
+        playtimes = pnw_model.GamePlaytimes.from_games(games)
+        self.assertEqual(playtimes.game_bounds(1), (1800.0, 21600.0))
+        self.assertTrue(all(numpy.isnan(playtimes.game_bounds(3))))
+
+        # a new process: the cache on disk answers for known titles, even under another game ID
+        games = [pnw_model.Game(1, 'Catan'), pnw_model.Game(5, 'Die Siedler von Catan'), pnw_model.Game(2, 'Azul'),
+                 pnw_model.Game(6, 'Ticket to Ride'), pnw_model.Game(4, 'Not A Real Game')]
+        client = self.client()
+        resolved = client.resolve(games)
+        self.assertEqual(resolved[6].bgg_id, 9209)
+        self.assertEqual(resolved[5].bgg_id, 13)
+        self.assertEqual((client.requests['search'], client.requests['thing']), (2, 2))   # the new IDs 5 and 6, and 1 batch queued once
+        self.assertIsNone(resolved[4])
+
+        out_fn = os.path.join(self._dir,'bgg-playtimes.json')
+        pnw_bgg.output_playtimes_json(games, out_fn)
+        playtimes = pnw_model.GamePlaytimes.from_json(out_fn, 1.0, 1.0)
+        self.assertEqual(playtimes.game_bounds(6), (1800.0, 3600.0))
+
+        # entries past the ttl are looked up again
+        client = self.client()
+        client.cache.ttl = 0
+        client.resolve(games[:1])
+        self.assertEqual(client.requests['search'], 1)
+
+class TestWinnersDB(unittest.TestCase):
+    def setUp(self):
+        self._dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self._dir)
+
+    def winners_tsv(self, name, wins):
+        fn = os.path.join(self._dir, name)
+        pnw_model.output_winners([pnw_model.Win(pnw_model.Game(game_id, f'Game {game_id}'), f'{game_id}A',
+                                                pnw_model.Player(player_id, player_name), None)
+                                  for game_id,player_id,player_name in wins], fn)
+        return fn
+
+    def test_store_and_rules(self):
+        """Draws append once, survive a reopen and an interrupted add, and give the cap and weight lookups."""
+        db_dir = os.path.join(self._dir, 'winners')
+        last_year = self.winners_tsv('pnw.2024.tsv', [(10, '7', 'Pat O\'Brien'), (11, '8', 'Sam Lee')])
+        friday = self.winners_tsv('pnw.friday.tsv', [(12, '101', 'Chris Doe'), (13, '102', 'Sam Lee')])
+        saturday = self.winners_tsv('pnw.saturday.tsv', [(14, '101', 'Chris Doe')])
+        db = pnw_winners_db.WinnersDB(db_dir)
+        self.assertEqual(db.add(last_year, 2024), 2)
+        self.assertEqual(db.add(friday, 2025), 2)
+        self.assertEqual(db.add(friday, 2025), 0)
+        with self.assertRaises(ValueError):
+            db.add(saturday, 2025, draw='pnw.friday')
+        # rows written without their sources.json entry are dropped by the next add
+        with open(db.wins_fn, 'a', encoding='utf-8') as f:
+            f.write('2025\tlost\t1\tGame 1\t1A\t999\tNobody\r\n')
+        self.assertEqual(db.add(saturday, 2025), 1)
+
+        db = pnw_winners_db.WinnersDB(db_dir)
+        self.assertEqual(len(db.records), 5)
+        self.assertEqual([r.game_id for r in db.wins_by_id('101')], [12, 14])
+        self.assertEqual([r.year for r in db.wins_by_name('sam  LEE')], [2024, 2025])
+        self.assertEqual(db.wins_by_name('Pat OBrien'), [])
+        self.assertEqual([r.player_id for r in db.wins_by_name('pat o brien', year=2024)], ['7'])
+        self.assertEqual(db.wins_by_id('999'), [])
+
+        rules = pnw_winners_db.DrawRules(db, 2025, max_wins=2, prior_weight=0.25)
+        self.assertEqual([p.player_id for p in rules.ineligible_players()], ['101'])
+        self.assertEqual(rules.weight(pnw_model.Player('55', "PAT O'BRIEN")), 0.25)
+        self.assertEqual(rules.weight(pnw_model.Player('102', 'Chris Doe')), 1.0)
+        self.assertTrue(rules.weighted())
+        with self.assertRaises(ValueError):
+            pnw_winners_db.DrawRules(db, 2025, prior_weight=0)
+
+        # a last-year winner with a tiny weight only wins when nobody else is left to win
+        game = pnw_model.Game(20, 'Azul', [pnw_model.Copy(20, '20A', True)])
+        play = pnw_model.GameCheckout(_play_json(1, 20, [55, 56]))
+        play.players[0].player_name = "Pat O'Brien"
+        weight = pnw_winners_db.DrawRules(db, 2025, prior_weight=1e-9).weight
+        for method in ('old_school', 'standard'):
+            random.seed(3)
+            winners = [pnw.select_game_winners(game, [play], list(), list(), method=method, weight=weight)[0].player.player_id
+                       for i in range(20)]
+            self.assertEqual(set(winners), {'56'})
+        wins = pnw.select_game_winners(game, [play], list(), [pnw_model.Player('56')], method='standard', weight=weight)
+        self.assertEqual(wins[0].player.player_id, '55')
+
+class TestOutOfCore(unittest.TestCase):
+    def setUp(self):
+        self._dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self._dir)
+
+    def test_streaming_pieces(self):
+        """Plays stream out of the JSON across chunk boundaries, and the external sort is stable across runs."""
+        plays = [_play_json(i, 10+i%4, [i, i+1]) for i in range(1, 60)]
+        plays_fn = os.path.join(self._dir,'plays.json')
+        with open(plays_fn,'w') as f:
+            json.dump({'Errors': [], 'Result': {'Plays': plays}}, f, indent=3)
+        self.assertEqual(list(pnw_ooc.iter_plays_json(plays_fn, chunk_size=100)), plays)
+        with open(plays_fn,'w') as f:
+            json.dump({'Result': {'Plays': []}}, f)
+        self.assertEqual(list(pnw_ooc.iter_plays_json(plays_fn, chunk_size=7)), [])
+
+        records = [[i%5, i] for i in range(200)]
+        merged = list(pnw_ooc.external_sort(iter(records), lambda r: r[0], self._dir, memory_budget=2000))
+        self.assertEqual(merged, sorted(records, key=lambda r: r[0]))
+        self.assertEqual(os.listdir(self._dir), ['plays.json'])
+
+    def test_same_draw_as_in_memory(self):
+        """With a seed, a draw spilled through many runs awards exactly what the in-memory draw does."""
+        games_fn = os.path.join(self._dir,'games.json')
+        plays_fn = os.path.join(self._dir,'plays.json')
+        with open(games_fn,'w') as f:
+            json.dump({'Result':{'Games':[{'ID':i,'Name':f'Game {i}','Copies':[{'ID':f'{i:03d}{c}','Winnable':True} for c in 'AB']}
+                                          for i in range(10,20)]}}, f)
+        rng = random.Random(1)
+        with open(plays_fn,'w') as f:
+            json.dump({'Result':{'Plays':[_play_json(i, rng.randrange(10,21), rng.sample(range(1,40), rng.randint(1,4)),
+                                                     minutes=rng.choice([3,30,90]), wants_to_win=rng.random()<0.9)
+                                          for i in range(1,400)]}}, f)
+        results = list()
+        for i,budget in enumerate([None, 3000]):
+            out_prefix = os.path.join(self._dir, f'out{i}')
+            wins = pnw.pick_all_winners(None, out_prefix, suffix='t', local_source=True, all_plays_source=plays_fn,
+                                        all_game_copies_source=games_fn, pick_method='old_school', duration_min=300,
+                                        seed=9, use_cache=False, memory_budget=budget, log_dir=self._dir)
+            self.assertEqual(len(wins), 20)
+            with open(out_prefix+'.t.tsv') as f:
+                tsv = f.read()
+            with open(out_prefix+'.t.json') as f:
+                results.append((tsv, json.load(f)))
+        self.assertEqual(results[0], results[1])
+
+        with self.assertRaises(ValueError):
+            pnw.pick_all_winners(None, os.path.join(self._dir,'out'), local_source=True, all_plays_source=plays_fn,
+                                 all_game_copies_source=games_fn, pick_method='max_coverage', memory_budget=3000,
+                                 log_dir=self._dir)
+
 class TestMainFunction(unittest.TestCase):
 
     def test_main_function_local_2018(self):